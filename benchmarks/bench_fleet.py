@@ -0,0 +1,368 @@
+"""Fleet load test of the integration, against a fake Ecovacs cloud replaying a session.
+
+Run from the repository root, with the integration requirements installed. Home Assistant does not install
+the requirements of its own components here, so include the ones of http and camera:
+
+    pip install homeassistant ozmo==1.0.4 pillow aiohttp_cors PyTurboJPEG
+
+    python benchmarks/bench_fleet.py --robots 20 --output fleet-20.json
+    for robots in 1 5 10 20 40; do python benchmarks/bench_fleet.py --robots $robots --output fleet-$robots.json; done
+
+The integration is set up in a local Home Assistant instance, with the ozmo API and iotmq client replaced by
+the fakes of fake_vacbot.py. Every robot answers the commands from the same session (a recorded one with
+--session, a synthetic one otherwise), and pushes its live cleaning stream (MapP, Trace, Pos) once all the
+robots are added. While they run, the event loop lag and the process memory are sampled. The results
+include them, with the time each robot took to get its full map and the integration metrics.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from fixtures import REPO_PATH, generate_session
+
+from fake_vacbot import FakeCloud, load_session, save_session
+
+_LOGGER = logging.getLogger(__name__)
+
+RESULTS_VERSION = 1
+
+# Interval of the event loop lag probe
+LOOP_LAG_INTERVAL = 0.05
+
+# Interval of the memory samples and of the map readiness checks
+SAMPLE_INTERVAL = 1
+
+# Max time waited for all the robots to be added
+SETUP_TIMEOUT = 300
+
+
+def summarize(samples):
+    """Return the distribution of the samples."""
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'avg': statistics.mean(ordered),
+        'p50': ordered[int(0.5 * (len(ordered) - 1))],
+        'p95': ordered[int(0.95 * (len(ordered) - 1))],
+        'p99': ordered[int(0.99 * (len(ordered) - 1))],
+        'max': ordered[-1],
+    }
+
+
+def get_rss():
+    """Return the resident memory of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak usage only, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH, stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class FleetMonitor:
+    """Samples of the event loop lag and of the memory, taken from the event loop itself."""
+
+    def __init__(self, trace_allocations):
+        self.trace_allocations = trace_allocations
+
+        self.loop_lags = []
+        self.rss = []
+        self.traced_peak = None
+        self.threads_peak = 0
+
+        self._tasks = []
+
+    def start(self):
+        if self.trace_allocations:
+            tracemalloc.start()
+
+        self._tasks = [
+            asyncio.ensure_future(self._probe_loop_lag()),
+            asyncio.ensure_future(self._sample_memory()),
+        ]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+        if self.trace_allocations:
+            _, self.traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    async def _probe_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lags.append(max(0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+    async def _sample_memory(self):
+        while True:
+            self.rss.append(get_rss())
+            self.threads_peak = max(self.threads_peak, threading.active_count())
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    def get_results(self):
+        return {
+            'loop_lag_s': summarize(self.loop_lags),
+            'memory': {
+                'rss_start_bytes': self.rss[0] if self.rss else None,
+                'rss_peak_bytes': max(self.rss) if self.rss else None,
+                'rss_end_bytes': self.rss[-1] if self.rss else None,
+                'traced_peak_bytes': self.traced_peak,
+            },
+            'threads_peak': self.threads_peak,
+        }
+
+
+def create_hass(config_dir):
+    from homeassistant.core import HomeAssistant
+
+    try:
+        hass = HomeAssistant(config_dir)
+    except TypeError:
+        # Versions before the config directory argument
+        hass = HomeAssistant()
+        hass.config.config_dir = config_dir
+
+    hass.config.skip_pip = True
+    return hass
+
+
+async def async_setup_hass(hass, config):
+    """Set up the core of Home Assistant (auth, registries) as on start, with the integrations of the configuration.
+
+    Startup waits for all the pending work: the integration under test is set up afterwards, so that its setup
+    time does not include the first fetch of its maps.
+    """
+    from homeassistant.bootstrap import async_from_config_dict
+
+    if await async_from_config_dict(config, hass) is None:
+        raise RuntimeError('Unable to set up Home Assistant')
+
+    for domain in config:
+        if domain not in hass.config.components:
+            raise RuntimeError('Unable to set up %s' % domain)
+
+
+def get_vacuum_entities(hass):
+    from homeassistant.components.vacuum import DOMAIN as VACUUM_DOMAIN
+    from custom_components.ecovac_ext.vacuum import LiveMapEcovacsDeebotVacuum
+
+    component = hass.data.get(VACUUM_DOMAIN)
+    if component is None:
+        return []
+    return [entity for entity in component.entities if isinstance(entity, LiveMapEcovacsDeebotVacuum)]
+
+
+def is_map_ready(entity):
+    """Return True once the entity drew all the pieces of its map."""
+    map_info = entity._map_info
+    canvas = entity._map_canvas
+    return (map_info is not None) and (canvas is not None) and \
+        (len(canvas.grid_hashes) == len(map_info['grid_piece_hashes'])) and (entity.get_map_pieces_pending() == 0)
+
+
+async def async_wait_robots(hass, robots):
+    """Wait for all the robots to be added, returning their entities."""
+    deadline = time.monotonic() + SETUP_TIMEOUT
+    while True:
+        entities = [entity for entity in get_vacuum_entities(hass) if entity.entity_id is not None]
+        if len(entities) >= robots:
+            return entities
+        if time.monotonic() > deadline:
+            raise RuntimeError('Only %d of %d robots added in %s seconds' % (len(entities), robots, SETUP_TIMEOUT))
+        await asyncio.sleep(0.1)
+
+
+async def async_track_maps_ready(entities, start, maps_ready):
+    """Record the time each entity took to get its full map, since the start."""
+    while len(maps_ready) < len(entities):
+        for entity in entities:
+            if (entity.entity_id not in maps_ready) and is_map_ready(entity):
+                maps_ready[entity.entity_id] = time.monotonic() - start
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def async_run_client(entity, interval, fetch_times):
+    """Fetch the map of an entity periodically, as an open map card does through the websocket API."""
+    canvas_id = version = None
+    while True:
+        start = time.monotonic()
+        result = None
+        if version is not None:
+            result = await entity.async_get_map_patches(version, canvas_id)
+        if result is None:
+            result = await entity.async_get_map_background()
+        fetch_times.append(time.monotonic() - start)
+
+        canvas_id = result['map_canvas_id']
+        version = result['map_version']
+        await asyncio.sleep(interval)
+
+
+async def async_run_fleet(args, session):
+    from homeassistant.setup import async_setup_component
+    from custom_components.ecovac_ext import DOMAIN, ECOVACS_SCHEDULER, ECOVACS_STATS
+
+    cloud = FakeCloud(session, args.robots, args.latency, args.jitter, args.failure_rate)
+
+    hass = create_hass(tempfile.mkdtemp(prefix='ecovac_ext_fleet_'))
+    monitor = FleetMonitor(args.tracemalloc)
+    monitor.start()
+
+    tasks = []
+    try:
+        with cloud.patch_ozmo():
+            # The camera platform depends on http: keep it on a local free port
+            await async_setup_hass(hass, {'http': {'server_host': '127.0.0.1', 'server_port': get_free_port()}})
+
+            start = time.monotonic()
+            if not await async_setup_component(hass, DOMAIN, {
+                    DOMAIN: {
+                        'username': 'fake',
+                        'password': 'fake',
+                        'country': 'it',
+                        'continent': 'eu',
+                        'process_workers': args.process_workers,
+                        'update_workers': args.update_workers,
+                        'pull_workers': args.pull_workers,
+                        'cloud_rate': args.cloud_rate,
+                    }}):
+                raise RuntimeError('Unable to set up %s' % DOMAIN)
+
+            await hass.async_start()
+            entities = await async_wait_robots(hass, args.robots)
+        setup_time = time.monotonic() - start
+        _LOGGER.info('%d robots added in %.1fs', len(entities), setup_time)
+
+        cloud.start_streams()
+
+        maps_ready = {}
+        fetch_times = []
+        tasks.append(asyncio.ensure_future(async_track_maps_ready(entities, start, maps_ready)))
+        if args.client_interval:
+            for entity in entities:
+                tasks.append(asyncio.ensure_future(async_run_client(entity, args.client_interval, fetch_times)))
+
+        await asyncio.sleep(args.duration)
+
+        def get_integration_metrics():
+            return {
+                'queues': hass.data[ECOVACS_SCHEDULER].get_queue_metrics(),
+                'devices': {did: stats.as_dict() for did, stats in hass.data[ECOVACS_STATS].items()},
+            }
+
+        integration = await hass.async_add_executor_job(get_integration_metrics)
+    finally:
+        for task in tasks:
+            task.cancel()
+        monitor.stop()
+        await hass.async_stop()
+
+    results = {
+        'setup_s': setup_time,
+        'map_ready_s': summarize(list(maps_ready.values())),
+        'maps_not_ready': len(entities) - len(maps_ready),
+        'client_fetch_s': summarize(fetch_times),
+        'cloud': cloud.get_metrics(),
+        'integration': integration,
+    }
+    results.update(monitor.get_results())
+    return results
+
+
+def print_results(results):
+    fleet = results['fleet']
+    print('robots: %d, duration: %ss, latency: %ss +/- %ss' % (
+        results['config']['robots'], results['config']['duration'], results['config']['latency'],
+        results['config']['jitter']))
+    print('setup: %.1fs, full maps: %d (p50 %s, max %s), not ready: %d' % (
+        fleet['setup_s'], fleet['map_ready_s']['count'], fleet['map_ready_s'].get('p50'),
+        fleet['map_ready_s'].get('max'), fleet['maps_not_ready']))
+    print('loop lag: p50 %.1fms, p99 %.1fms, max %.1fms' % (
+        fleet['loop_lag_s']['p50'] * 1000, fleet['loop_lag_s']['p99'] * 1000, fleet['loop_lag_s']['max'] * 1000))
+    print('rss: start %.1fMiB, peak %.1fMiB, threads peak: %d' % (
+        fleet['memory']['rss_start_bytes'] / (1 << 20), fleet['memory']['rss_peak_bytes'] / (1 << 20),
+        fleet['threads_peak']))
+    print('cloud: %d requests, %d failures, %d pushes' % (
+        sum(fleet['cloud']['requests'].values()), fleet['cloud']['failures'], fleet['cloud']['pushes']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--robots', type=int, default=20, help='number of fake robots')
+    parser.add_argument('--duration', type=float, default=120, help='seconds of live cleaning, after the setup')
+    parser.add_argument('--latency', type=float, default=0.3, help='mean latency of the cloud requests (seconds)')
+    parser.add_argument('--jitter', type=float, default=0.1, help='max deviation of the latency (seconds)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of the requests without response')
+    parser.add_argument('--session', help='replay this session (JSON) instead of a synthetic one')
+    parser.add_argument('--save-session', help='write the replayed session to this JSON file')
+    parser.add_argument('--client-interval', type=float, default=0,
+                        help='fetch the map of every robot at this interval (seconds), as open map cards do')
+    parser.add_argument('--process-workers', type=int, default=0)
+    parser.add_argument('--update-workers', type=int, default=4)
+    parser.add_argument('--pull-workers', type=int, default=8)
+    parser.add_argument('--cloud-rate', type=float, default=5)
+    parser.add_argument('--tracemalloc', action='store_true', help='trace the allocations (slower)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    _LOGGER.setLevel(logging.INFO)
+
+    if args.session:
+        session = load_session(args.session)
+    else:
+        session = generate_session(duration=int(args.duration))
+    if args.save_session:
+        save_session(session, args.save_session)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': get_git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'save_session', 'verbose')},
+        'fleet': asyncio.run(async_run_fleet(args, session)),
+    }
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Benchmark of the map piece drawing: legacy per-pixel RGBA drawing vs class indexed canvas.
+
+Run from the repository root:
+
+    python benchmarks/bench_map_piece.py
+
+Besides timings, the script checks that both implementations produce pixel-identical maps.
+"""
+import sys
+import time
+
+from PIL import Image
+
+from fixtures import MAP_INFO, generate_map_pieces
+
+from custom_components.ecovac_ext import map_engine
+
+
+def legacy_draw_map_grid_piece(img, piece_data, map_info, grid_idx, clean_empty):
+    """Per-pixel implementation used before the bulk rasterizer."""
+    grid_c = map_info['grid_columns']
+    grid_r = map_info['grid_rows']
+    piece_w = map_info['grid_piece_w']
+    piece_h = map_info['grid_piece_h']
+
+    img_w = img.size[1]
+
+    x = int(grid_idx % grid_c) * piece_w
+    y = int(grid_idx / grid_r) * piece_h
+
+    for idx, value in enumerate(piece_data):
+        lx = int(idx % piece_w)
+        ly = int(idx / piece_h)
+
+        mx = y + ly
+        my = img_w - 1 - (x + lx)
+
+        if value == 0x00:
+            if clean_empty:
+                img.putpixel((mx, my), 0)
+        elif value == 0x01:
+            img.putpixel((mx, my), (186, 218, 255, 255))
+        elif value == 0x02:
+            img.putpixel((mx, my), (84, 147, 214, 255))
+
+
+def render_legacy(map_info, pieces, clean_empty):
+    map_w = map_info['grid_columns'] * map_info['grid_piece_w']
+    map_h = map_info['grid_rows'] * map_info['grid_piece_h']
+
+    img = Image.new('RGBA', (map_w, map_h))
+    if clean_empty:
+        # Pre-draw the map to verify that empty cells are cleared
+        for grid_idx in range(len(pieces)):
+            legacy_draw_map_grid_piece(img, bytes([0x02]) * len(pieces[grid_idx]), map_info, grid_idx, False)
+
+    start = time.perf_counter()
+    for grid_idx, piece_data in enumerate(pieces):
+        legacy_draw_map_grid_piece(img, piece_data, map_info, grid_idx, clean_empty)
+    return img, time.perf_counter() - start
+
+
+def render_canvas(map_info, pieces, clean_empty):
+    map_w = map_info['grid_columns'] * map_info['grid_piece_w']
+    map_h = map_info['grid_rows'] * map_info['grid_piece_h']
+
+    canvas = map_engine.MapCanvas(map_w, map_h)
+    if clean_empty:
+        for grid_idx in range(len(pieces)):
+            canvas.draw_grid_piece(bytes([0x02]) * len(pieces[grid_idx]), map_info, grid_idx, False)
+
+    start = time.perf_counter()
+    for grid_idx, piece_data in enumerate(pieces):
+        canvas.draw_grid_piece(piece_data, map_info, grid_idx, clean_empty)
+    elapsed = time.perf_counter() - start
+
+    return canvas.to_rgba(), elapsed
+
+
+def main():
+    pieces = generate_map_pieces(MAP_INFO)
+
+    for clean_empty in (False, True):
+        legacy_img, legacy_time = render_legacy(MAP_INFO, pieces, clean_empty)
+        bulk_img, bulk_time = render_canvas(MAP_INFO, pieces, clean_empty)
+
+        identical = legacy_img.tobytes() == bulk_img.tobytes()
+
+        print('clean_empty=%s: legacy %.3fs, bulk %.4fs (x%.0f), pixel identical: %s' % (
+            clean_empty, legacy_time, bulk_time, legacy_time / bulk_time, identical))
+
+        if not identical:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Benchmark of the CPU heavy map work run inline (threads) or through a process pool.
+
+Run from the repository root:
+
+    python benchmarks/bench_offload.py
+
+Several vacuums rebuilding their map at the same time are simulated with one thread each: every thread
+decodes and rasterizes all the pieces of a map, then encodes the map PNG.
+"""
+import concurrent.futures
+import time
+
+from fixtures import MAP_INFO, compress_7z_base64, generate_map_pieces
+
+from custom_components.ecovac_ext.codec import decompress_7z_base64_data
+from custom_components.ecovac_ext.map_engine import MapCanvas, rasterize_map_piece_data
+from custom_components.ecovac_ext.offload import CpuOffload
+
+VACUUMS = 3
+ROUNDS = 3
+
+
+def rebuild_map(offload, payloads):
+    canvas = MapCanvas(
+        MAP_INFO['grid_columns'] * MAP_INFO['grid_piece_w'], MAP_INFO['grid_rows'] * MAP_INFO['grid_piece_h'])
+
+    for grid_idx, payload in enumerate(payloads):
+        piece_data = offload.run(decompress_7z_base64_data, payload)
+        tile_data = offload.run(rasterize_map_piece_data, piece_data, MAP_INFO['grid_piece_w'], MAP_INFO['grid_piece_h'])
+        canvas.draw_grid_tile(tile_data, MAP_INFO, grid_idx, False)
+
+    return canvas.encode_png(canvas.getbbox(), offload)
+
+
+def measure(workers, payloads):
+    offload = CpuOffload(workers)
+    try:
+        # Warm up the worker processes
+        rebuild_map(offload, payloads)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=VACUUMS) as executor:
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                list(executor.map(lambda _: rebuild_map(offload, payloads), range(VACUUMS)))
+            elapsed = time.perf_counter() - start
+    finally:
+        offload.shutdown()
+
+    return (VACUUMS * ROUNDS * len(payloads)) / elapsed
+
+
+def main():
+    payloads = [compress_7z_base64(piece) for piece in generate_map_pieces(MAP_INFO)]
+
+    for workers in (0, 1, 2, 4):
+        mode = 'inline (threads)' if workers == 0 else '%s worker processes' % workers
+        print('%-20s %8.0f pieces/s' % (mode, measure(workers, payloads)))
+
+
+if __name__ == '__main__':
+    main()
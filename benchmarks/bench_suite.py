@@ -0,0 +1,396 @@
+"""Offline benchmark suite of the map and trace hot paths, with machine readable results.
+
+Run from the repository root:
+
+    python benchmarks/bench_suite.py --output results.json
+    python benchmarks/bench_suite.py --compare results.json
+
+Every case runs the integration code on synthetic protocol payloads (see fixtures.py), without network
+access: the throughput is measured over several rounds, the allocations over a separate run traced by
+tracemalloc.
+
+Only the decoding case runs with the standard library alone. The other cases measure the entity methods, so
+they import the integration with its requirements, reported as skipped when missing:
+
+    pip install homeassistant ozmo==1.0.4 pillow
+
+Home Assistant is only imported: the entities are created without it, with no configuration nor network.
+"""
+import argparse
+from collections import OrderedDict
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from fixtures import MAP_INFO, REPO_PATH, generate_map_m_event, generate_map_pieces, generate_map_set_polygons,\
+    generate_pull_m_p_events, generate_trace_events, generate_trace_records, get_piece_crc
+
+from custom_components.ecovac_ext.codec import decompress_7z_base64_data
+
+RESULTS_VERSION = 1
+
+DEFAULT_ROUNDS = 10
+
+# Size of the synthetic trace (about a 1 hour cleaning)
+TRACE_POINTS = 10000
+
+# Case name -> (setup function, unit of the measured operations)
+CASES = OrderedDict()
+
+
+class SkipCase(Exception):
+    """The case cannot run in this environment."""
+
+
+def case(name, unit):
+    """Register a benchmark case: its setup returns the function to measure and the operations it runs."""
+    def decorator(setup):
+        CASES[name] = (setup, unit)
+        return setup
+    return decorator
+
+
+def import_integration():
+    """Import the integration entity modules, or skip the case if their requirements are not installed."""
+    try:
+        from custom_components.ecovac_ext import camera, map_engine, offload, piece_store, stats, trace, vacuum
+    except ImportError as ex:
+        raise SkipCase('integration not importable: %s, see the requirements in bench_suite.py' % ex)
+
+    return {
+        'camera': camera,
+        'map_engine': map_engine,
+        'offload': offload,
+        'piece_store': piece_store,
+        'stats': stats,
+        'trace': trace,
+        'vacuum': vacuum,
+    }
+
+
+class Fixtures:
+    """Protocol payloads and their decoded data, generated once for all the cases."""
+
+    def __init__(self):
+        self.pieces = generate_map_pieces(MAP_INFO)
+        self.map_m_event = generate_map_m_event(self.pieces)
+        self.pull_m_p_events = generate_pull_m_p_events(self.pieces)
+
+        self.trace_records = generate_trace_records(TRACE_POINTS)
+        self.trace_events = generate_trace_events(self.trace_records)
+        self.trace_chunks = [decompress_7z_base64_data(event['tr']) for event in self.trace_events]
+
+        self.walls = generate_map_set_polygons(3, 4, seed=1)
+        self.rooms = generate_map_set_polygons(8, 24, seed=2)
+
+
+def new_entity(modules, cls, fixtures, cleanups):
+    """Create an entity without Home Assistant, with only the state used by the map and trace methods."""
+    entity = cls.__new__(cls)
+
+    piece_cache = modules['piece_store'].MapPieceCache(
+        modules['piece_store'].MapPieceStore(tempfile.mkdtemp(prefix='ecovac_ext_bench_')))
+    for piece_data in fixtures.pieces:
+        piece_cache.put(MAP_INFO['id'], get_piece_crc(piece_data), piece_data)
+    cleanups.append(piece_cache.shutdown)
+
+    event = fixtures.map_m_event
+    entity._map_info = {
+        'id': event['i'],
+        'grid_rows': int(event['r']),
+        'grid_columns': int(event['c']),
+        'grid_piece_w': int(event['w']),
+        'grid_piece_h': int(event['h']),
+        'grid_piece_hashes': event['m'].split(','),
+    }
+    entity._map_info_timestamp = None
+    entity._map_canvas = None
+    entity._map_pieces = piece_cache
+    entity._map_pull_pending = None
+    entity._map_partial_update_timestamp = None
+
+    entity._stats = modules['stats'].DeviceStats()
+    entity._offload = modules['offload'].CpuOffload(0)
+
+    entity._trace_points = None
+
+    entity._map_set_info = {'vw': None, 'sa': None}
+    entity._map_set_data = {
+        'vw': {str(idx): list(map(int, polygon.replace(';', ',').split(','))) for idx, polygon in enumerate(fixtures.walls)},
+        'sa': {str(idx): list(map(int, polygon.replace(';', ',').split(','))) for idx, polygon in enumerate(fixtures.rooms)},
+    }
+
+    entity._device_pos = {'x': 1200, 'y': -800, 'a': 90}
+    entity._charger_pos = {'x': 0, 'y': 0, 'a': 0}
+    return entity
+
+
+def new_vacuum(fixtures, cleanups):
+    modules = import_integration()
+    return modules, new_entity(modules, modules['vacuum'].LiveMapEcovacsDeebotVacuum, fixtures, cleanups)
+
+
+def new_camera(fixtures, cleanups):
+    modules = import_integration()
+    camera = new_entity(modules, modules['camera'].EcovacsMapCamera, fixtures, cleanups)
+
+    camera._map_tiles = {}
+    camera._map_tiles_version = None
+    camera._camera_image_last_device_pos = None
+    camera._frame_interval = 1 / 2
+    return modules, camera
+
+
+def draw_full_map(entity):
+    entity._map_canvas = None
+    entity.update_map()
+
+
+@case('piece_decode', 'pieces')
+def setup_piece_decode(fixtures, cleanups):
+    payloads = [event['p'] for event in fixtures.pull_m_p_events]
+
+    def run():
+        for payload in payloads:
+            decompress_7z_base64_data(payload)
+
+    return run, len(payloads)
+
+
+@case('draw_map_grid_piece', 'pieces')
+def setup_draw_map_grid_piece(fixtures, cleanups):
+    modules, vacuum = new_vacuum(fixtures, cleanups)
+    draw_full_map(vacuum)
+    hashes = vacuum._map_info['grid_piece_hashes']
+
+    def run():
+        for grid_idx, piece_data in enumerate(fixtures.pieces):
+            vacuum.draw_map_grid_piece(vacuum._map_canvas, piece_data, grid_idx, True, hashes[grid_idx])
+
+    return run, len(fixtures.pieces)
+
+
+@case('update_map_full', 'maps')
+def setup_update_map_full(fixtures, cleanups):
+    modules, vacuum = new_vacuum(fixtures, cleanups)
+
+    return (lambda: draw_full_map(vacuum)), 1
+
+
+@case('update_map_changed_pieces', 'maps')
+def setup_update_map_changed_pieces(fixtures, cleanups):
+    modules, vacuum = new_vacuum(fixtures, cleanups)
+    draw_full_map(vacuum)
+
+    # Swap two different pieces at each update, as a MapM with changed hashes does
+    hashes = vacuum._map_info['grid_piece_hashes']
+    first = hashes.index(next(crc for crc in hashes if crc != hashes[0]))
+
+    def run():
+        hashes[0], hashes[first] = hashes[first], hashes[0]
+        vacuum.update_map()
+
+    return run, 1
+
+
+@case('add_trace_data', 'points')
+def setup_add_trace_data(fixtures, cleanups):
+    modules, vacuum = new_vacuum(fixtures, cleanups)
+    trace_store_cls = modules['trace'].TraceStore
+
+    def run():
+        vacuum._trace_points = trace_store_cls()
+        for chunk in fixtures.trace_chunks:
+            vacuum.add_trace_data(chunk)
+
+    return run, TRACE_POINTS
+
+
+@case('websocket_map_background', 'maps')
+def setup_websocket_map_background(fixtures, cleanups):
+    modules, vacuum = new_vacuum(fixtures, cleanups)
+    draw_full_map(vacuum)
+
+    return vacuum.encode_map_background, 1
+
+
+@case('websocket_map_patches', 'maps')
+def setup_websocket_map_patches(fixtures, cleanups):
+    modules, vacuum = new_vacuum(fixtures, cleanups)
+    draw_full_map(vacuum)
+    hashes = vacuum._map_info['grid_piece_hashes']
+
+    # A piece patched (MapP) since the map version of the client
+    def run():
+        since_version = vacuum.get_map_version()
+        vacuum.draw_map_grid_piece(vacuum._map_canvas, fixtures.pieces[9], 9, True, hashes[9])
+        vacuum.encode_map_patches(since_version, vacuum._map_canvas.canvas_id)
+
+    return run, 1
+
+
+def new_svg_camera(fixtures, cleanups):
+    modules, camera = new_camera(fixtures, cleanups)
+    draw_full_map(camera)
+
+    camera._trace_points = modules['trace'].TraceStore()
+    for chunk in fixtures.trace_chunks:
+        camera.add_trace_data(chunk)
+    return camera
+
+
+@case('generate_camera_image_svg', 'images')
+def setup_generate_camera_image_svg(fixtures, cleanups):
+    camera = new_svg_camera(fixtures, cleanups)
+    camera.generate_camera_image_svg()
+
+    # Steady state: the map tiles are already encoded, the device moved
+    def run():
+        camera._device_pos['x'] += 1
+        camera.generate_camera_image_svg()
+
+    return run, 1
+
+
+@case('generate_camera_image_svg_cold', 'images')
+def setup_generate_camera_image_svg_cold(fixtures, cleanups):
+    camera = new_svg_camera(fixtures, cleanups)
+
+    # First image of a map: all the tiles are encoded
+    def run():
+        camera._map_tiles_version = None
+        camera.generate_camera_image_svg()
+
+    return run, 1
+
+
+def measure(run, ops, rounds):
+    """Return the timings of the rounds of a case, and its allocations in a single traced run."""
+    # Warm up (caches, lazy imports)
+    run()
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        base_current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median = statistics.median(timings)
+    return {
+        'ops_per_run': ops,
+        'rounds': rounds,
+        'best_s': min(timings),
+        'median_s': median,
+        'ops_per_s': ops / median if median else None,
+        'alloc_peak_bytes': peak - base_current,
+        'alloc_retained_bytes': current - base_current,
+    }
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH, stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_cases(names, rounds):
+    fixtures = Fixtures()
+
+    results = OrderedDict()
+    for name in names:
+        setup, unit = CASES[name]
+        cleanups = []
+        try:
+            run, ops = setup(fixtures, cleanups)
+            result = measure(run, ops, rounds)
+            result['unit'] = unit
+        except SkipCase as ex:
+            result = {'skipped': str(ex)}
+        finally:
+            for cleanup in cleanups:
+                cleanup()
+
+        results[name] = result
+        print_result(name, result)
+
+    return {
+        'version': RESULTS_VERSION,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': get_git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fixtures': {
+            'map_info': MAP_INFO,
+            'trace_points': TRACE_POINTS,
+        },
+        'results': results,
+    }
+
+
+def print_result(name, result):
+    if 'skipped' in result:
+        print('%-32s skipped (%s)' % (name, result['skipped']))
+        return
+
+    # No throughput when the rounds are too fast for the timer
+    ops_per_s = result['ops_per_s'] if result['ops_per_s'] is not None else float('nan')
+    print('%-32s %12.1f %-7s/s  median %9.3fms  peak alloc %9.1fKiB' % (
+        name, ops_per_s, result['unit'], result['median_s'] * 1000, result['alloc_peak_bytes'] / 1024))
+
+
+def print_comparison(baseline, current):
+    print()
+    print('Compared to %s (%s):' % (baseline.get('revision'), baseline.get('timestamp')))
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if (previous is None) or ('skipped' in previous) or ('skipped' in result):
+            print('%-32s not comparable' % name)
+            continue
+
+        print('%-32s speed x%.2f  peak alloc x%.2f' % (
+            name,
+            (result['ops_per_s'] / previous['ops_per_s']) if result['ops_per_s'] and previous['ops_per_s'] else float('nan'),
+            (result['alloc_peak_bytes'] / previous['alloc_peak_bytes']) if previous['alloc_peak_bytes'] else float('nan')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cases', nargs='*', help='cases to run (default: all): %s' % ', '.join(CASES))
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS, help='measured rounds per case')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results to a previous JSON results file')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error('unknown cases: %s' % ', '.join(unknown))
+
+    results = run_cases(args.cases or list(CASES), args.rounds)
+
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print_comparison(json.load(baseline_file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Local stand-in for the Ecovacs cloud: ozmo API and iotmq client answering from a replay session.
+
+The fakes subclass the ozmo classes and replace only the network: the VacBots are the ozmo ones, and the
+responses and pushes go through the ozmo handlers (as patched by the integration) exactly as the cloud ones,
+after the configured latency. Sessions are described in fixtures.generate_session.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import random
+import threading
+import time
+
+import ozmo
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def load_session(path):
+    with open(path) as session_file:
+        return json.load(session_file)
+
+
+def save_session(session, path):
+    with open(path, 'w') as session_file:
+        json.dump(session, session_file)
+
+
+def _args_match(recorded_args, args):
+    return all(str(args.get(key)) == value for key, value in recorded_args.items())
+
+
+def _update_responses(responses, changed):
+    """Replace the responses with the same args of the changed ones, adding the new ones."""
+    for name, entries in changed.items():
+        current = responses.setdefault(name, [])
+        for entry in entries:
+            for idx, current_entry in enumerate(current):
+                if current_entry['args'] == entry['args']:
+                    current[idx] = entry
+                    break
+            else:
+                current.append(entry)
+
+
+class FakeMqttMessage:
+    """MQTT message, as delivered by paho."""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeCloud:
+    """Fake Ecovacs account: its devices all replay the same session, with a random latency per request.
+
+    Requests fail (no response, as on cloud timeouts) with the given rate, or when the session has no
+    response for them.
+    """
+
+    def __init__(self, session, devices=1, latency=0.3, jitter=0.1, failure_rate=0.0, seed=0):
+        self.session = session
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+        self.devices = [{
+            'did': 'fake%04d' % idx,
+            'class': 'ls1ok3',
+            'resource': 'fake',
+            'nick': 'Fake %d' % idx,
+            'company': 'eco-ng',
+            'iotmq': True,
+        } for idx in range(devices)]
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._iotmqs = []
+
+        self.requests = Counter()
+        self.failures = 0
+        self.unrecorded = Counter()
+        self.pushes = 0
+        self.push_errors = 0
+
+    def get_latency(self):
+        with self._lock:
+            return max(0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def is_failed_request(self, name):
+        with self._lock:
+            self.requests[name] += 1
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.failures += 1
+                return True
+            return False
+
+    def count_unrecorded(self, name):
+        with self._lock:
+            self.unrecorded[name] += 1
+
+    def count_push(self, failed):
+        with self._lock:
+            self.pushes += 1
+            if failed:
+                self.push_errors += 1
+
+    def register(self, iotmq):
+        with self._lock:
+            self._iotmqs.append(iotmq)
+
+    def start_streams(self):
+        """Start the live pushes of all the connected devices."""
+        with self._lock:
+            iotmqs = list(self._iotmqs)
+        for iotmq in iotmqs:
+            iotmq.start_stream()
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'requests': dict(self.requests.most_common()),
+                'failures': self.failures,
+                'unrecorded': dict(self.unrecorded.most_common()),
+                'pushes': self.pushes,
+                'push_errors': self.push_errors,
+            }
+
+    @contextmanager
+    def patch_ozmo(self):
+        """Replace the ozmo API and iotmq client with the fake ones, for the integration set up meanwhile.
+
+        VacBot creates its iotmq client from the ozmo module: the VacBots must be created in the context.
+        """
+        cloud = self
+        api_cls = type('FakeEcoVacsAPI', (FakeEcoVacsAPI,), {'cloud': cloud})
+        iotmq_cls = type('FakeIotMq', (FakeIotMq,), {'cloud': cloud})
+
+        original = (ozmo.EcoVacsAPI, ozmo.EcoVacsIOTMQ)
+        ozmo.EcoVacsAPI, ozmo.EcoVacsIOTMQ = api_cls, iotmq_cls
+        try:
+            yield
+        finally:
+            ozmo.EcoVacsAPI, ozmo.EcoVacsIOTMQ = original
+
+
+class FakeEcoVacsAPI(ozmo.EcoVacsAPI):
+    """Account API logged in without the network, listing the devices of the fake cloud."""
+
+    cloud = None
+
+    def __init__(self, device_id, account_id, password_hash, country, continent, verify_ssl=True):
+        self.meta = {'deviceId': device_id}
+        self.resource = device_id
+        self.country = country
+        self.continent = continent
+        self.verify_ssl = verify_ssl
+
+        self.uid = account_id
+        self.login_access_token = 'fake'
+        self.auth_code = 'fake'
+        self.user_access_token = 'fake'
+
+    def devices(self):
+        return [dict(device) for device in self.cloud.devices]
+
+
+class FakeIotMq(ozmo.EcoVacsIOTMQ):
+    """iotmq client answering the commands from the session, and pushing its stream as MQTT messages.
+
+    Commands block their caller for the request latency, as the cloud REST calls do. Pushes are delivered
+    by a thread of the device, as by the paho network thread.
+    """
+
+    cloud = None
+
+    def __init__(self, user, domain, resource, secret, continent, vacuum, server_address=None, verify_ssl=True):
+        super().__init__(user, domain, resource, secret, continent, vacuum, server_address, verify_ssl)
+
+        # The device state changes with the pushes of the stream
+        self._responses_lock = threading.Lock()
+        self._responses = {name: list(entries) for name, entries in self.cloud.session['responses'].items()}
+
+        self._stream_stop = threading.Event()
+        self._stream_thread = None
+
+        self.cloud.register(self)
+
+    def connect_and_wait_until_ready(self):
+        self._on_message = self._handle_ctl_mqtt
+
+        time.sleep(self.cloud.get_latency())
+        self.ready_flag.set()
+
+    def send_ping(self):
+        return True
+
+    def _disconnect(self):
+        self._stream_stop.set()
+        self.scheduler.empty()
+
+    def send_command(self, action, recipient):
+        time.sleep(self.cloud.get_latency())
+        self._handle_ctl_api(action, self._get_response(action))
+
+    def _get_response(self, action):
+        if self.cloud.is_failed_request(action.name):
+            return {}
+
+        with self._responses_lock:
+            resp = next((
+                entry['resp'] for entry in self._responses.get(action.name, ())
+                if _args_match(entry['args'], action.args)), None)
+
+        if resp is None:
+            _LOGGER.debug('No recorded response to %s %s', action.name, action.args)
+            self.cloud.count_unrecorded(action.name)
+            return {}
+
+        return {'ret': 'ok', 'resp': resp}
+
+    def start_stream(self):
+        if self._stream_thread is None:
+            self._stream_thread = threading.Thread(
+                target=self._run_stream, daemon=True, name='fake_mqtt_%s' % self.vacuum['did'])
+            self._stream_thread.start()
+
+    def _run_stream(self):
+        topic = 'iot/atr/%s/%s/%s/x' % (self.vacuum['did'], self.vacuum['class'], self.vacuum['resource'])
+        start = time.monotonic()
+        for push in self.cloud.session.get('stream', ()):
+            if self._stream_stop.wait(max(0, start + push['at'] - time.monotonic())):
+                return
+
+            with self._responses_lock:
+                _update_responses(self._responses, push.get('responses', {}))
+
+            failed = False
+            try:
+                self._on_message(self, None, FakeMqttMessage(topic, push['payload'].encode('utf-8')))
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception('Push to %s not handled', self.vacuum['did'])
+                failed = True
+            self.cloud.count_push(failed)
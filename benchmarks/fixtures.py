@@ -0,0 +1,275 @@
+"""Synthetic protocol payloads shared by the benchmarks."""
+import base64
+import lzma
+import os
+import random
+import struct
+import sys
+import types
+from xml.sax.saxutils import quoteattr
+import zlib
+
+# Repository root, to import the integration package. It is appended: the integration modules (trace, codec...)
+# are only imported through their package, not to shadow the standard library modules of the same name
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if REPO_PATH not in sys.path:
+    sys.path.append(REPO_PATH)
+
+try:
+    import custom_components.ecovac_ext  # noqa: F401
+except ImportError:
+    # The package __init__ requires Home Assistant and ozmo, while the codec and map modules do not: register the
+    # package without executing __init__ to benchmark them anyway
+    import custom_components
+
+    _package = types.ModuleType('custom_components.ecovac_ext')
+    _package.__path__ = [os.path.join(REPO_PATH, 'custom_components', 'ecovac_ext')]
+    sys.modules['custom_components.ecovac_ext'] = _package
+    custom_components.ecovac_ext = _package
+
+
+MAP_INFO = {
+    'id': '1',
+    'grid_rows': 8,
+    'grid_columns': 8,
+    'grid_piece_w': 100,
+    'grid_piece_h': 100,
+}
+
+
+def compress_7z_base64(data):
+    """Compress data as the devices do: LZMA properties, little-endian size and raw LZMA stream, base64 encoded."""
+    filters = [{'id': lzma.FILTER_LZMA1, 'dict_size': 1 << 16}]
+    properties = lzma._encode_filter_properties(filters[0])
+    stream = lzma.compress(data, format=lzma.FORMAT_RAW, filters=filters)
+
+    return base64.b64encode(properties + struct.pack('<i', len(data)) + stream).decode('ascii')
+
+
+def generate_map_pieces(map_info=MAP_INFO, seed=0):
+    """Generate pieces with floor areas, wall borders and empty cells, like real maps."""
+    rnd = random.Random(seed)
+    piece_len = map_info['grid_piece_w'] * map_info['grid_piece_h']
+    pieces = []
+    for _ in range(map_info['grid_rows'] * map_info['grid_columns']):
+        kind = rnd.random()
+        if kind < 0.3:
+            pieces.append(bytes(piece_len))
+        else:
+            pieces.append(bytes(rnd.choice((0, 1, 1, 1, 2)) for _ in range(piece_len)))
+    return pieces
+
+
+def get_piece_crc(piece_data):
+    """Return the hash of a piece, as listed in MapM events."""
+    return str(zlib.crc32(piece_data) & 0xffffffff)
+
+
+def generate_map_m_event(pieces, map_info=MAP_INFO):
+    """Generate the MapM event of a map made of the given pieces."""
+    return {
+        'event': 'map_m',
+        'i': map_info['id'],
+        'r': str(map_info['grid_rows']),
+        'c': str(map_info['grid_columns']),
+        'w': str(map_info['grid_piece_w']),
+        'h': str(map_info['grid_piece_h']),
+        'm': ','.join(get_piece_crc(piece_data) for piece_data in pieces),
+    }
+
+
+def generate_pull_m_p_events(pieces, map_info=MAP_INFO):
+    """Generate the PullMP responses of the distinct pieces of a map (pieces are pulled once per hash)."""
+    payloads = {}
+    for piece_data in pieces:
+        crc = get_piece_crc(piece_data)
+        if crc not in payloads:
+            payloads[crc] = compress_7z_base64(piece_data)
+
+    return [{'event': 'pull_m_p', 'i': map_info['id'], 'p': payload} for payload in payloads.values()]
+
+
+def generate_trace_records(count, seed=0):
+    """Generate packed trace records (y, x as int16 LE and flags), as a random walk of the device.
+
+    Points are in trace units (tenths of the device position units): mostly short connected steps, with a
+    move (not connected point) from time to time.
+    """
+    rnd = random.Random(seed)
+    x = y = 0
+    records = bytearray()
+    for idx in range(count):
+        flags = 0
+        if idx and rnd.random() < 0.005:
+            flags |= 0x80
+            x += rnd.randint(-20, 20)
+            y += rnd.randint(-20, 20)
+        else:
+            x += rnd.choice((-1, 0, 1, 1, 2))
+            y += rnd.choice((-1, 0, 0, 1))
+        x = max(-350, min(350, x))
+        y = max(-350, min(350, y))
+        records += struct.pack('<hhB', y, x, flags)
+    return bytes(records)
+
+
+def generate_trace_events(records, chunk_size=200):
+    """Generate the Trace events of the given records, in chunks as requested by GetTr."""
+    record_size = 5
+    events = []
+    for first in range(0, len(records) // record_size, chunk_size):
+        chunk = records[first * record_size:(first + chunk_size) * record_size]
+        events.append({
+            'event': 'trace',
+            'trid': '1',
+            'tf': str(first),
+            'tt': str(first + len(chunk) // record_size - 1),
+            'tr': compress_7z_base64(chunk),
+        })
+    return events
+
+
+def generate_map_set_polygons(count, vertices, seed=0):
+    """Generate the PullM responses of a map set: polygons as 'x,y;x,y;...' in device position units."""
+    rnd = random.Random(seed)
+    polygons = []
+    for _ in range(count):
+        center_x = rnd.randint(-15000, 15000)
+        center_y = rnd.randint(-15000, 15000)
+        points = []
+        for _ in range(vertices):
+            points.append('%d,%d' % (center_x + rnd.randint(-3000, 3000), center_y + rnd.randint(-3000, 3000)))
+        polygons.append(';'.join(points))
+    return polygons
+
+
+def _ctl(children=(), **attrs):
+    """Build a ctl element as sent by the cloud, with the given attributes and child elements."""
+    attrs_xml = ''.join(' %s=%s' % (key, quoteattr(str(value))) for key, value in attrs.items())
+    if not children:
+        return '<ctl%s/>' % attrs_xml
+    return '<ctl%s>%s</ctl>' % (attrs_xml, ''.join(children))
+
+
+def _element(tag, **attrs):
+    return '<%s%s/>' % (tag, ''.join(' %s=%s' % (key, quoteattr(str(value))) for key, value in attrs.items()))
+
+
+def _patch_piece(piece_data, rnd):
+    """Return a copy of a piece with a few changed cells, as cleaned areas patched by MapP."""
+    patched = bytearray(piece_data)
+    start = rnd.randrange(len(patched))
+    for idx in range(start, min(len(patched), start + 200)):
+        patched[idx] = rnd.choice((1, 1, 2))
+    return bytes(patched)
+
+
+def generate_session(duration=120, trace_points=2000, seed=0, map_info=MAP_INFO):
+    """Generate a replay session of a device in the middle of a cleaning.
+
+    A session holds the cloud responses to the commands, as 'responses': command name -> list of
+    {'args': ..., 'resp': ...} (the first entry whose args are all in the command ones answers), and the live
+    pushes of the cleaning, as 'stream': list of {'at': seconds from the stream start, 'payload': MQTT ctl,
+    'responses': responses changed by the push}.
+    """
+    rnd = random.Random(seed)
+    responses = {}
+    stream = []
+
+    def add_response(target, name, resp, **args):
+        target.setdefault(name, []).append({'args': args, 'resp': resp})
+
+    # Map and its pieces, pulled by the index of the first piece with the same hash
+    pieces = generate_map_pieces(map_info, seed)
+    hashes = [get_piece_crc(piece_data) for piece_data in pieces]
+
+    def map_m_response():
+        return _ctl(
+            ret='ok', i=map_info['id'], r=map_info['grid_rows'], c=map_info['grid_columns'],
+            w=map_info['grid_piece_w'], h=map_info['grid_piece_h'], m=','.join(hashes))
+
+    payloads = {}
+    add_response(responses, 'GetMapM', map_m_response())
+    for pid, piece_data in enumerate(pieces):
+        payload = payloads.setdefault(hashes[pid], compress_7z_base64(piece_data))
+        add_response(responses, 'PullMP', _ctl(ret='ok', i=map_info['id'], p=payload), pid=str(pid))
+
+    # Trace, fetched in chunks
+    trace_id = str(rnd.randint(1, 1 << 30))
+    trace_pushes = duration // 3
+    records = generate_trace_records(trace_points + trace_pushes * 10, seed)
+    add_response(responses, 'GetTrM', _ctl(ret='ok', trid=trace_id, c=trace_points))
+    for first in range(0, trace_points, 200):
+        last = min(trace_points, first + 200) - 1
+        add_response(
+            responses, 'GetTr', _ctl(ret='ok', tr=compress_7z_base64(records[first * 5:(last + 1) * 5])),
+            tf=str(first), tt=str(last))
+
+    # Map sets: virtual walls and rooms
+    for tp, msid, polygons in (
+            ('vw', '11', generate_map_set_polygons(3, 4, seed + 1)),
+            ('sa', '12', generate_map_set_polygons(8, 24, seed + 2))):
+        add_response(
+            responses, 'GetMapSet',
+            _ctl([_element('m', mid=str(mid), p='1') for mid in range(len(polygons))], ret='ok', tp=tp, msid=msid),
+            tp=tp)
+        for mid, polygon in enumerate(polygons):
+            add_response(responses, 'PullM', _ctl(ret='ok', m=polygon), tp=tp, mid=str(mid))
+
+    def get_pos(point):
+        y, x = struct.unpack_from('<hh', records, point * 5)
+        return '%d,%d' % (x * 10, y * 10)
+
+    add_response(responses, 'GetPos', _ctl(ret='ok', p=get_pos(trace_points - 1), a='90'))
+    add_response(responses, 'GetChargerPos', _ctl(ret='ok', p='0,0', a='0'))
+
+    # Statuses and components polled by ozmo
+    add_response(responses, 'GetCleanState', _ctl([_element('clean', type='auto', speed='standard', st='s')], ret='ok'))
+    add_response(responses, 'GetChargeState', _ctl([_element('charge', type='Idle')], ret='ok'))
+    add_response(responses, 'GetBatteryInfo', _ctl([_element('battery', power='082')], ret='ok'))
+    add_response(responses, 'GetCleanSpeed', _ctl(ret='ok', speed='standard'))
+    for component in ('Brush', 'SideBrush', 'DustCaseHeap'):
+        add_response(responses, 'GetLifeSpan', _ctl(ret='ok', type=component, val='75', total='100'), type=component)
+
+    # Live cleaning: position every second, new trace points every 3 seconds, a patched piece every 10 seconds
+    trace_count = trace_points
+    for at in range(1, duration + 1):
+        if at % 3 == 0:
+            changed = {}
+            add_response(changed, 'GetTrM', _ctl(ret='ok', trid=trace_id, c=trace_count + 10))
+            stream.append({
+                'at': at,
+                'payload': _ctl(
+                    td='Trace', trid=trace_id, tf=trace_count, tt=trace_count + 9,
+                    tr=compress_7z_base64(records[trace_count * 5:(trace_count + 10) * 5])),
+                'responses': changed,
+            })
+            trace_count += 10
+
+        if at % 10 == 0:
+            pid = rnd.choice([pid for pid, piece_data in enumerate(pieces) if any(piece_data)])
+            pieces[pid] = _patch_piece(pieces[pid], rnd)
+            hashes[pid] = get_piece_crc(pieces[pid])
+            payload = compress_7z_base64(pieces[pid])
+
+            changed = {}
+            add_response(changed, 'GetMapM', map_m_response())
+            add_response(changed, 'PullMP', _ctl(ret='ok', i=map_info['id'], p=payload), pid=str(pid))
+            stream.append({
+                'at': at,
+                'payload': _ctl(td='MapP', i=map_info['id'], pid=pid, p=payload),
+                'responses': changed,
+            })
+
+        changed = {}
+        add_response(changed, 'GetPos', _ctl(ret='ok', p=get_pos(trace_count - 1), a='90'))
+        stream.append({
+            'at': at,
+            'payload': _ctl(td='Pos', p=get_pos(trace_count - 1), a='90', t='p'),
+            'responses': changed,
+        })
+
+    return {
+        'responses': responses,
+        'stream': stream,
+    }
@@ -1,4 +1,5 @@
 """Support for Ecovacs Deebot vacuums with advanced features"""
+import asyncio
 import logging
 import random
 import string
@@ -11,6 +12,7 @@ from datetime import timedelta
 from homeassistant.const import CONF_PASSWORD, CONF_USERNAME, EVENT_HOMEASSISTANT_STOP,\
     ATTR_COMMAND
 from homeassistant.helpers import discovery
+from homeassistant.helpers.dispatcher import async_dispatcher_send
 import homeassistant.helpers.config_validation as cv
 from homeassistant.components.vacuum import (
     SUPPORT_BATTERY,
@@ -43,6 +45,13 @@ CONF_COUNTRY = "country"
 CONF_CONTINENT = "continent"
 CONF_SUPPORTED_FEATURES = "supported_features"
 CONF_UNSUPPORTED_FEATURES = "unsupported_features"
+CONF_PROCESS_WORKERS = "process_workers"
+CONF_TRACE_FETCH_WINDOW = "trace_fetch_window"
+CONF_UPDATE_WORKERS = "update_workers"
+CONF_PULL_WORKERS = "pull_workers"
+CONF_CONNECT_TIMEOUT = "connect_timeout"
+CONF_CLOUD_RATE = "cloud_rate"
+CONF_DIAGNOSTIC_SENSORS = "diagnostic_sensors"
 
 SERVICE_TO_STRING = {
     SUPPORT_START: "start",
@@ -73,6 +82,13 @@ CONFIG_SCHEMA = vol.Schema(
                 vol.Required(CONF_CONTINENT): vol.All(vol.Lower, cv.string),
                 vol.Optional(CONF_SUPPORTED_FEATURES, default=[]): vol.All(cv.ensure_list, [vol.In(STRING_TO_SERVICE.keys())]),
                 vol.Optional(CONF_UNSUPPORTED_FEATURES, default=[]): vol.All(cv.ensure_list, [vol.In(STRING_TO_SERVICE.keys())]),
+                vol.Optional(CONF_PROCESS_WORKERS, default=0): cv.positive_int,
+                vol.Optional(CONF_TRACE_FETCH_WINDOW, default=4): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_UPDATE_WORKERS, default=4): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_PULL_WORKERS, default=8): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_CONNECT_TIMEOUT, default=60): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_CLOUD_RATE, default=5): vol.All(vol.Coerce(float), vol.Range(min=0.1)),
+                vol.Optional(CONF_DIAGNOSTIC_SENSORS, default=False): cv.boolean,
                 vol.Optional("custom_zones", default=[]): vol.All(cv.ensure_list, 
                     [vol.Schema(
                         {
@@ -88,6 +104,13 @@ CONFIG_SCHEMA = vol.Schema(
 
 ECOVACS_DEVICES = "ecovacs_devices"
 ECOVACS_CONFIG = "ecovacs_config"
+ECOVACS_OFFLOAD = "ecovacs_offload"
+ECOVACS_SCHEDULER = "ecovacs_scheduler"
+ECOVACS_STATS = "ecovacs_stats"
+ECOVACS_CONNECT_TASKS = "ecovacs_connect_tasks"
+
+# Dispatched with the VacBot of each device once connected
+SIGNAL_ECOVACS_DEVICE_READY = "ecovac_ext_device_ready"
 
 SCAN_INTERVAL = timedelta(seconds=10)
 
@@ -107,6 +130,21 @@ async def async_setup(hass, config):
 
     hass.data[ECOVACS_DEVICES] = []
     hass.data[ECOVACS_CONFIG] = []
+    
+    # Metrics of each device, by device id
+    hass.data[ECOVACS_STATS] = {}
+    
+    # Devices still connecting (the loop keeps only weak references to its tasks)
+    hass.data[ECOVACS_CONNECT_TASKS] = set()
+    
+    # Optional process pool for CPU heavy map work (decompression, rasterization, encoding)
+    from .offload import CpuOffload
+    hass.data[ECOVACS_OFFLOAD] = CpuOffload(config[DOMAIN].get(CONF_PROCESS_WORKERS))
+    
+    # Threads running the blocking device commands, shared by all the devices (and paced for the whole account)
+    from .scheduler import WorkScheduler
+    hass.data[ECOVACS_SCHEDULER] = WorkScheduler(
+        config[DOMAIN].get(CONF_UPDATE_WORKERS), config[DOMAIN].get(CONF_PULL_WORKERS), config[DOMAIN].get(CONF_CLOUD_RATE))
 
     from ozmo import EcoVacsAPI, VacBot
 
@@ -121,38 +159,33 @@ async def async_setup(hass, config):
     devices = await hass.async_add_executor_job(ecovacs_api.devices)
     _LOGGER.debug("Ecobot devices: %s", devices)
 
-    for device in devices:
-        _LOGGER.info(
-            "Discovered Ecovacs device on account: %s with nickname %s",
-            device["did"],
-            device["nick"],
-        )
-        vacbot = VacBot(
-            ecovacs_api.uid,
-            ecovacs_api.REALM,
-            ecovacs_api.resource,
-            ecovacs_api.user_access_token,
-            device,
-            config[DOMAIN].get(CONF_CONTINENT).lower(),
-            monitor=True,
-        )
-        
-        await hass.async_add_executor_job(vacbot.connect_and_wait_until_ready)
-        
-        hass.data[ECOVACS_DEVICES].append(vacbot)
+    stopping = False
 
     def stop(event: object) -> None:
         """Shut down open connections to Ecovacs XMPP server."""
+        nonlocal stopping
+        stopping = True
+        
         for device in hass.data[ECOVACS_DEVICES]:
             _LOGGER.info(
                 "Shutting down connection to Ecovacs device %s", device.vacuum["did"]
             )
             device.disconnect()
+        
+        hass.data[ECOVACS_OFFLOAD].shutdown()
+        hass.data[ECOVACS_SCHEDULER].shutdown()
+
+    @callback
+    def async_cancel_connects(event: object) -> None:
+        """Stop waiting for the devices still connecting."""
+        for task in list(hass.data[ECOVACS_CONNECT_TASKS]):
+            task.cancel()
 
     # Listen for HA stop to disconnect.
     hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, stop)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_cancel_connects)
 
-    if hass.data[ECOVACS_DEVICES]:
+    if devices:
         _LOGGER.debug("Starting vacuum components")
 
         dconfig = config[DOMAIN]
@@ -172,19 +205,88 @@ async def async_setup(hass, config):
 
         deebot_config = {
             CONF_SUPPORTED_FEATURES: strings_to_services(dconfig.get(CONF_SUPPORTED_FEATURES), STRING_TO_SERVICE),
-            "custom_zones": dconfig.get("custom_zones")
+            "custom_zones": dconfig.get("custom_zones"),
+            CONF_TRACE_FETCH_WINDOW: dconfig.get(CONF_TRACE_FETCH_WINDOW),
         }
 
         hass.data[ECOVACS_CONFIG].append(deebot_config)
 
         _LOGGER.debug(hass.data[ECOVACS_CONFIG])
 
+    async def async_connect_device(device):
+        vacbot = VacBot(
+            ecovacs_api.uid,
+            ecovacs_api.REALM,
+            ecovacs_api.resource,
+            ecovacs_api.user_access_token,
+            device,
+            config[DOMAIN].get(CONF_CONTINENT).lower(),
+            monitor=True,
+        )
+        
+        def disconnect_when_connected(future):
+            if (not future.cancelled()) and (future.exception() is None):
+                vacbot.disconnect()
+        
+        # The connection can not be cancelled: after the timeout, the device is still added once connected.
+        # Not tracked by HA either, so that startup and stop do not wait for it.
+        connect_future = hass.loop.run_in_executor(None, vacbot.connect_and_wait_until_ready)
+        try:
+            try:
+                await asyncio.wait_for(asyncio.shield(connect_future), config[DOMAIN].get(CONF_CONNECT_TIMEOUT))
+            except asyncio.TimeoutError:
+                _LOGGER.warning(
+                    "Ecovacs device %s is not ready after %s seconds, it will be added once connected",
+                    device["did"],
+                    config[DOMAIN].get(CONF_CONNECT_TIMEOUT),
+                )
+                await connect_future
+        except asyncio.CancelledError:
+            # Stopping: the device is not added, and its connection is closed once open
+            connect_future.add_done_callback(disconnect_when_connected)
+            raise
+        except Exception:
+            _LOGGER.exception("Unable to connect to Ecovacs device %s", device["did"])
+            return
+        
+        if stopping:
+            vacbot.disconnect()
+            return
+        
+        hass.data[ECOVACS_DEVICES].append(vacbot)
+        
+        # Add the device entities to the platforms already loaded
+        async_dispatcher_send(hass, SIGNAL_ECOVACS_DEVICE_READY, vacbot)
+
+    def connect_done(task, device):
+        hass.data[ECOVACS_CONNECT_TASKS].discard(task)
+        if (not task.cancelled()) and (task.exception() is not None):
+            _LOGGER.error("Unable to connect to Ecovacs device %s", device["did"], exc_info=task.exception())
+
+    # Connect all the devices concurrently, without waiting for them: platforms add each device once ready.
+    # Plain loop tasks are used, not tracked by HA, so that slow devices do not hold the startup: they are
+    # kept here until done, and cancelled on stop.
+    for device in devices:
+        _LOGGER.info(
+            "Discovered Ecovacs device on account: %s with nickname %s",
+            device["did"],
+            device["nick"],
+        )
+        task = hass.loop.create_task(async_connect_device(device))
+        hass.data[ECOVACS_CONNECT_TASKS].add(task)
+        task.add_done_callback(lambda task, device=device: connect_done(task, device))
+
+    if devices:
         hass.async_create_task(
             discovery.async_load_platform(hass, "vacuum", DOMAIN, {}, config)
         )
         hass.async_create_task(
             discovery.async_load_platform(hass, "camera", DOMAIN, {}, config)
         )
+        if config[DOMAIN].get(CONF_DIAGNOSTIC_SENSORS):
+            hass.async_create_task(
+                discovery.async_load_platform(hass, "sensor", DOMAIN, {}, config)
+            )
         
         ## Load websocket commands for custom UI
         from .websocket_api import async_load_websocket_api
@@ -1,15 +1,9 @@
 """Support for IP Cameras."""
 import ast
 import base64
-import concurrent.futures
-import io
 import logging
-import lzma
-import os
 import re
-import struct
-import tempfile
-from threading import local
+import threading
 import time
 import types
 import xml
@@ -17,26 +11,36 @@ import zlib
 
 from datetime import datetime
 
-from PIL import Image
 from homeassistant.components.camera import (
     Camera,
 )
 from homeassistant.const import (
     EVENT_HOMEASSISTANT_STOP,
 )
-import stringcase
 
-from . import ECOVACS_DEVICES
+from . import DOMAIN, ECOVACS_DEVICES, CONF_TRACE_FETCH_WINDOW, ECOVACS_CONFIG, ECOVACS_OFFLOAD, ECOVACS_SCHEDULER
+from .codec import decompress_7z_base64_data
+from .map_engine import MapCanvas, rasterize_map_piece_data
+from .piece_store import MapPieceCache, MapPieceStore
+from .commands import CommandError, DeviceCommands, set_command_failed, set_command_responded, async_wait_command_futures, wait_command_futures
+from .events import EventCounters, element_to_dict, find_mqtt_td, get_command_event_name, get_event_handlers, get_event_name, get_ozmo_api_event_name, to_ozmo_api_dict, to_ozmo_mqtt_dict
+from .scheduler import DeviceExecutor, WORK_COMMAND, WORK_UPDATES, WORK_PULL, WORK_TRACE, WORK_STORE
+from .stats import get_device_stats, TIMING_DECOMPRESS, TIMING_RASTERIZE, TIMING_PNG_ENCODE, TIMING_SVG
+from .trace import TraceChunkAssembler, TraceStore
 
 import xml.etree.cElementTree as ET
 from ozmo import VacBotCommand
 from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import STORAGE_DIR
 from _datetime import timedelta
 import asyncio
 
 
 UPDATE_INTERVAL = 60 * 5
 
+# Min interval between map update notifications while a map is being pulled
+MAP_PARTIAL_UPDATE_INTERVAL = 1
+
 _LOGGER = logging.getLogger(__name__)
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
@@ -61,24 +65,36 @@ class EcovacsMapCamera(Camera):
         
         self.hass = hass
         
-        self._thread_local = local()
+        self._offload = hass.data[ECOVACS_OFFLOAD]
         
         self._device = device
         
         self._update_interval = 30
         self._update_lock = asyncio.Lock()
         
-        self.updates_executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-        self.pull_executor = concurrent.futures.ThreadPoolExecutor(max_workers=15)
+        # Device views of the integration executors: updates wait for pulls, so they never share the same workers
+        scheduler = hass.data[ECOVACS_SCHEDULER]
+        did = self._device.vacuum['did']
+        self.updates_executor = DeviceExecutor(scheduler.updates, did, WORK_UPDATES, 2)
+        self.pull_executor = DeviceExecutor(scheduler.pulls, did, WORK_PULL, 4)
+        self.trace_executor = DeviceExecutor(scheduler.pulls, did, WORK_TRACE, hass.data[ECOVACS_CONFIG][0][CONF_TRACE_FETCH_WINDOW])
+        self._stats = get_device_stats(hass, did)
+        self._commands = DeviceCommands(device, DeviceExecutor(scheduler.commands, did, WORK_COMMAND, 1), stats=self._stats)
         
         self._stopped = False
         
+        # Local and ozmo handlers of the received events, and the received events count
+        self._event_handlers = get_event_handlers(type(self))
+        self._ozmo_event_handlers = get_event_handlers(type(self._device))
+        self._event_counters = EventCounters()
+        
         self._map_info = None
         self._map_info_timestamp = None
         
         self._trace_info = None
         self._trace_info_timestamp = None
         self._trace_points = None
+        self._trace_chunks = None
         
         self._device_pos = None
         self._device_pos_timestamp = None
@@ -86,7 +102,16 @@ class EcovacsMapCamera(Camera):
         self._charger_pos = None
         self._charger_pos_timestamp = None
 
-        self._map_image = None
+        self._map_canvas = None
+        
+        # Encoded map tiles (tile box -> (content box, base64 png)), refreshed only for dirty tiles
+        self._map_tiles = {}
+        self._map_tiles_version = None
+        
+        # Map pieces being pulled for the current map update
+        self._map_pull_lock = threading.Lock()
+        self._map_pull_pending = None
+        self._map_partial_update_timestamp = None
         
         self._camera_image = b"<svg/>"
         self._camera_image_timestamp = None
@@ -105,7 +130,8 @@ class EcovacsMapCamera(Camera):
             'vw': None,
             'sa': None,
         }
-        self._current_map_set_type = None
+        # (map set type, map set id) -> elements being pulled
+        self._map_set_pulls = {}
         
         self._device_update_timestamp = None
 
@@ -118,57 +144,77 @@ class EcovacsMapCamera(Camera):
         if not self._device.vacuum['iotmq']:
             self._device.xmpp.subscribe_to_ctls(self._handle_ctl)
         else:
-            # Patch api responses handling (disable base64 patching for local logic and implement children handling)
+            # Patch api responses handling (disable base64 patching for local logic and implement children handling).
+            # Messages are parsed once: only the ones with a local handler are parsed here, and shared with the 
+            # ozmo handler when it handles them too. The others are left to the ozmo handler.
             original_handle_ctl_api = self._device.iotmq._handle_ctl_api
             
-            def convert_to_dict(xml):
-                result = xml.attrib.copy()
+            def notify_ozmo(_self, ozmo_event, to_ozmo_dict, *args):
+                # VacBot subscribes its own handler: it is skipped for the events VacBot does not handle, but the
+                # other subscribers get all the events, as from the ozmo handler
+                subscribers = [subscriber for subscriber in _self.ctl_subscribers
+                    if (ozmo_event in self._ozmo_event_handlers) or (subscriber != self._device._handle_ctl)]
+                if (not subscribers):
+                    return
                 
-                children = xml.getchildren()
-                if children:
-                    result["#children"] = []
-                    for child in xml.getchildren():
-                        result["#children"].append(convert_to_dict(child))
-                        
-                return result
+                resp = to_ozmo_dict(*args)
+                for subscriber in subscribers:
+                    subscriber(resp)
                     
             def custom__handle_ctl_api(_self, action, message):
-                _LOGGER.debug("Handling message with custom logic: %s" , message)
-                # Invoke original handler
-                original_handle_ctl_api(action, message)
+                set_command_responded(action)
                 
-                # handle local commands:
-                if (not self._stopped) and (not message == {}):
-                    xml = ET.fromstring(message['resp'])
-                    resp = convert_to_dict(xml)
-                    resp['event'] = stringcase.snakecase(action.name.replace("Get","",1))
-                    
-                    self._handle_ctl(resp)
-                    
-
+                if (not message):
+                    # Failed or timed out request: let the command caller (and the cloud pacing) know
+                    if (not self._stopped):
+                        set_command_failed(action)
+                    return
+                
+                event = get_command_event_name(action.name)
+                if (self._stopped) or ('resp' not in message) or (event not in self._event_handlers):
+                    self._event_counters.count(event)
+                    original_handle_ctl_api(action, message)
+                    return
+                
+                _LOGGER.debug("Handling %s response with custom logic", event)
+                xml = ET.fromstring(message['resp'])
+                
+                notify_ozmo(_self, get_ozmo_api_event_name(action.name, xml), to_ozmo_api_dict, action.name, xml)
+                
+                resp = element_to_dict(xml)
+                resp['event'] = event
+                
+                # Correlate the response to its request
+                resp['#request'] = action.args
+                
+                self._handle_ctl(resp)
                     
             def custom__handle_ctl_mqtt(_self, client, userdata, message):
-                message_string = str(message.payload.decode("utf-8"))
-                _LOGGER.debug("Handling mqtt message with custom logic: %s" , message_string)
+                td = find_mqtt_td(message.payload)
+                event = get_event_name(td) if (td is not None) else None
+                if (self._stopped) or (event is None) or (event not in self._event_handlers):
+                    if (event is not None):
+                        self._event_counters.count(event)
+                    _self._handle_ctl_mqtt(client, userdata, message)
+                    return
                 
-                # Invoke original handler
-                _self._handle_ctl_mqtt(client, userdata, message)
+                _LOGGER.debug("Handling %s mqtt message with custom logic", event)
+                xml = ET.fromstring(message.payload)
                 
-                # handle local commands:
-                if (not self._stopped):
-                    xml = ET.fromstring(message_string)
-                    
-                    if ('td' in xml.attrib):
-                        resp = convert_to_dict(xml)
-                        resp['event'] = stringcase.snakecase(xml.attrib["td"])
-                        
-                        self._handle_ctl(resp)
+                notify_ozmo(_self, event, to_ozmo_mqtt_dict, xml)
+                
+                resp = element_to_dict(xml)
+                resp['event'] = event
+                
+                self._handle_ctl(resp)
             
             # Use a custom wrapper method to properly handle texts for local event handling forboth API and MQTT.
             self._device.iotmq._handle_ctl_api = types.MethodType(custom__handle_ctl_api, self._device.iotmq)
             self._device.iotmq._on_message = types.MethodType(custom__handle_ctl_mqtt, self._device.iotmq)
             
-        self._map_cache_directory_path = tempfile.mkdtemp(prefix='ecovacs_map_cache_' + self._device.vacuum['did'])
+        self._map_pieces = MapPieceCache(
+            MapPieceStore(hass.config.path(STORAGE_DIR, DOMAIN, 'map_cache', self._device.vacuum['did'])),
+            DeviceExecutor(scheduler.store, did, WORK_STORE))
         
         self._frame_interval = 1 / 2
         self._supported_features = 0
@@ -181,6 +227,9 @@ class EcovacsMapCamera(Camera):
         
         self.updates_executor.shutdown()
         self.pull_executor.shutdown()
+        self.trace_executor.shutdown()
+        
+        self._map_pieces.shutdown()
         
         _LOGGER.debug("Ecovacs map successfully stopped for %s." , self._device)
 
@@ -188,6 +237,8 @@ class EcovacsMapCamera(Camera):
         """Run when entity about to be added."""
         await super().async_added_to_hass()
 
+        await self.hass.async_add_executor_job(self.load_map_pieces)
+        
         self.hass.async_create_task(self.async_check_and_update_map(datetime.now()))
         
         async_track_time_interval(self.hass, self.async_check_and_update_map, timedelta(seconds=self._update_interval))
@@ -215,8 +266,9 @@ class EcovacsMapCamera(Camera):
                     ((self._camera_image_timestamp is None) 
                         or (self._camera_image_timestamp <= self._device_update_timestamp)
                         or (self._camera_image_last_device_pos != self._device_pos))):
-                _LOGGER.debug('Generating camera image. Image last update: %s; Device last update: %s' % (self._camera_image_timestamp, self._device_update_timestamp))
-                self.generate_camera_image_svg()
+                _LOGGER.debug('Generating camera image. Image last update: %s; Device last update: %s', self._camera_image_timestamp, self._device_update_timestamp)
+                with self._stats.timing(TIMING_SVG):
+                    self.generate_camera_image_svg()
             
         return self._camera_image
         
@@ -230,16 +282,16 @@ class EcovacsMapCamera(Camera):
             if not self._stopped:
                 update_futures = []
                 if self._map_info_timestamp is None or time.time() - self._map_info_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetMapM')))
+                    update_futures.append(self._commands.submit(VacBotCommand('GetMapM'), self.updates_executor))
                     
                 if self._trace_info_timestamp is None or time.time() - self._trace_info_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetTrM')))
+                    update_futures.append(self._commands.submit(VacBotCommand('GetTrM'), self.updates_executor))
         
                 if self._device_pos_timestamp is None or time.time() - self._device_pos_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetPos')))
+                    update_futures.append(self._commands.submit(VacBotCommand('GetPos'), self.updates_executor))
         
                 if self._charger_pos_timestamp is None or time.time() - self._charger_pos_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetChargerPos')))
+                    update_futures.append(self._commands.submit(VacBotCommand('GetChargerPos'), self.updates_executor))
                 
                 map_sets_to_update = []
                 for map_set_type in self._map_set_info:
@@ -247,21 +299,25 @@ class EcovacsMapCamera(Camera):
                         map_sets_to_update.append(map_set_type)
                 
                 if (map_sets_to_update):
-                    update_futures.append(self.updates_executor.submit(self.update_map_sets, map_sets_to_update))
+                    update_futures.extend(self.update_map_sets(map_sets_to_update))
                 
-                def job_wait_futures():
-                    for update_future in update_futures:
-                        update_future.result()
+                if (update_futures):
+                    # Wait in the loop, without holding an executor thread: on timeout the queued updates
+                    # are cancelled, and the not updated data is polled again by the next check
+                    try:
+                        await async_wait_command_futures(update_futures)
+                    except CommandError as err:
+                        _LOGGER.warning("Updates of %s not completed: %s", self._device.vacuum['did'], err)
                     
-                    if (update_futures):
-                        self.schedule_update_ha_state()
-                
-                await self.hass.async_add_executor_job(job_wait_futures)
+                    self.schedule_update_ha_state()
                 
     def update_map_sets(self, map_sets):
+        """Queue the requests of the given map set types, returning their futures."""
+        update_futures = []
         for map_set_type in map_sets:
             _LOGGER.debug("Getting map set %s" , map_set_type)
-            self._device.run(VacBotCommand('GetMapSet', {'tp':map_set_type}))
+            update_futures.append(self._commands.submit(VacBotCommand('GetMapSet', {'tp':map_set_type}), self.updates_executor))
+        return update_futures
         
     def update_map(self):
         _LOGGER.debug('Updating ecovacs image.')
@@ -276,73 +332,77 @@ class EcovacsMapCamera(Camera):
         
         clean_empty = True
         
-        if (self._map_image is None) or (self._map_image.size[0] != map_w) or (self._map_image.size[1] != map_h):
-            self._map_image = Image.new('RGBA', (map_w, map_h))
+        if (self._map_canvas is None) or (self._map_canvas.size[0] != map_w) or (self._map_canvas.size[1] != map_h):
+            self._map_canvas = MapCanvas(map_w, map_h, (self._map_canvas.version + 1) if self._map_canvas else 1)
             clean_empty = False
         
-        img = self._map_image
+        canvas = self._map_canvas
         
-        # Pull all missing map pieces (TODO: concurrently)
-        pull_futures = []
-        pulled_hashes = []
-        for grid_idx, grid_hash in enumerate(self._map_info['grid_piece_hashes']):
-            piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + str(self._map_info['id']) + '_' + str(grid_hash))
-            if (not os.path.exists(piece_cache_file)) and (not grid_hash in pulled_hashes):
-                pulled_hashes.append(grid_hash)
-                pull_futures.append(self.pull_executor.submit(self._device.run, VacBotCommand('PullMP', {'pid':str(grid_idx)})))
+        map_id = self._map_info['id']
         
-        # wait pulls to be completed
-        for pull_future in pull_futures:
-            pull_future.result()
-        
-        # Generate the map
+        # Draw the available map pieces, collecting the missing ones by hash (the same piece can be used many times)
+        missing_pieces = {}
         for grid_idx, grid_hash in enumerate(self._map_info['grid_piece_hashes']):
-            piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + str(self._map_info['id']) + '_' + str(grid_hash))
+            piece_data = self._map_pieces.get(map_id, grid_hash)
             
-            if (not os.path.exists(piece_cache_file)):
-                # No map piece, maybe changed recently (in the case it should have been handled by 
-                # the piece patch handler), skip the current grid position
-                _LOGGER.warn('Missing grid piece cache for index %s (hash: %s).' % (grid_idx, grid_hash))
+            if (piece_data is None):
+                missing_pieces.setdefault(grid_hash, []).append(grid_idx)
                 continue
-
-            piece_data = []
-            with open(piece_cache_file, 'rb') as f:
-                piece_data = f.read()
                 
-            self.draw_map_grid_piece(img, piece_data, grid_idx, clean_empty)
+            self.draw_map_grid_piece(canvas, piece_data, grid_idx, clean_empty)
         
-    def draw_map_grid_piece(self, img, piece_data, grid_idx, clean_empty):
-        grid_c = self._map_info['grid_columns']
-        grid_r = self._map_info['grid_rows']
-        piece_w = self._map_info['grid_piece_w']
-        piece_h = self._map_info['grid_piece_h']
-    
-        img_w = img.size[1]
+        if (missing_pieces):
+            with self._map_pull_lock:
+                self._map_pull_pending = {
+                    'map_id': map_id,
+                    'clean_empty': clean_empty,
+                    'pieces': missing_pieces,
+                }
+            
+            # Publish the partial map while the missing pieces are pulled: each one will be drawn as soon 
+            # as it is received
+            self.publish_partial_map()
+            
+            # Pull all missing map pieces (concurrently)
+            pull_futures = []
+            for grid_hash, grid_idxs in missing_pieces.items():
+                pull_futures.append(self._commands.submit(VacBotCommand('PullMP', {'pid':str(grid_idxs[0])}), self.pull_executor))
+            
+            # wait pulls to be completed
+            try:
+                wait_command_futures(pull_futures)
+            finally:
+                with self._map_pull_lock:
+                    pending = self._map_pull_pending
+                    self._map_pull_pending = None
+            
+            for grid_hash, grid_idxs in pending['pieces'].items():
+                for grid_idx in grid_idxs:
+                    # No map piece, maybe changed recently (in the case it should have been handled by 
+                    # the piece patch handler), skip the current grid position
+                    _LOGGER.warn('Missing grid piece cache for index %s (hash: %s).', grid_idx, grid_hash)
+        
+    def publish_partial_map(self):
+        """Notify a map update while it is still being built, at most once per partial update interval."""
+        if time.time() - (self._map_partial_update_timestamp or 0) >= MAP_PARTIAL_UPDATE_INTERVAL:
+            self._map_partial_update_timestamp = time.time()
+            self._device_update_timestamp = time.time()
+            
+            self.schedule_update_ha_state()
     
-        x = int(grid_idx % grid_c) * piece_w
-        y = int(grid_idx / grid_r) * piece_h
-        
-        for idx, value in enumerate(piece_data):
-            lx = int(idx % piece_w)
-            ly = int(idx / piece_h)
-            
-            # The map is bottom, left origin, but PIL is upper left: rotating coordinates by 90° counter-clockwise.
-            mx = y + ly
-            my = img_w - 1 - (x + lx)
-            
-            if value == 0x00:
-                # Empty: empty
-                if clean_empty:
-                    img.putpixel((mx, my), 0)
-            elif value == 0x01:
-                # Floor: light blue
-                img.putpixel((mx, my), (186, 218, 255, 255))
-            elif value == 0x02:
-                # Wall: dark blue
-                img.putpixel((mx, my), (84, 147, 214, 255))
+    def load_map_pieces(self):
+        self._map_pieces.load()
+        
+    def draw_map_grid_piece(self, canvas, piece_data, grid_idx, clean_empty):
+        with self._stats.timing(TIMING_RASTERIZE):
+            if self._offload.enabled:
+                tile_data = self._offload.run(rasterize_map_piece_data, piece_data, self._map_info['grid_piece_w'], self._map_info['grid_piece_h'])
+                canvas.draw_grid_tile(tile_data, self._map_info, grid_idx, clean_empty)
+            else:
+                canvas.draw_grid_piece(piece_data, self._map_info, grid_idx, clean_empty)
         
     def generate_camera_image_svg(self):
-        if (self._map_image is None):
+        if (self._map_canvas is None):
             return
             
         # Map increase scale to improve image resolution
@@ -358,26 +418,41 @@ class EcovacsMapCamera(Camera):
         charger_r = (1 * map_scale)
         
 
-        img = self._map_image
+        canvas = self._map_canvas
         
         # Crop empty spaces
-        image_box = img.getbbox()
+        image_box = canvas.getbbox()
+        
+        # Re-encode only the map tiles changed since the last image
+        map_version = canvas.version
+        dirty_boxes = None
+        if self._map_tiles_version is not None:
+            dirty_boxes = canvas.dirty_boxes(self._map_tiles_version)
+        if dirty_boxes is None:
+            self._map_tiles = {}
+            dirty_boxes = canvas.dirty_boxes(canvas.base_version)
+        
+        for tile_box in dirty_boxes:
+            tile_bbox = canvas.get_tile_bbox(tile_box)
+            if tile_bbox:
+                with self._stats.timing(TIMING_PNG_ENCODE):
+                    tile_png = canvas.encode_png(tile_bbox, self._offload)
+                self._map_tiles[tile_box] = (tile_bbox, base64.b64encode(tile_png).decode("ascii"))
+            else:
+                self._map_tiles.pop(tile_box, None)
+        
+        self._map_tiles_version = map_version
 
         # Calculate the base map center with crop offset 
-        cropped_map_center_x = img.size[0] / 2 - image_box[0]
-        cropped_map_center_y = img.size[1] / 2 - image_box[1]
+        cropped_map_center_x = canvas.size[0] / 2 - image_box[0]
+        cropped_map_center_y = canvas.size[1] / 2 - image_box[1]
         
-        
-        img = img.crop(image_box)
-        
-        img = img.convert(mode='P', palette=Image.ADAPTIVE)
-
-        imgByteArr = io.BytesIO() 
-        img.save(imgByteArr, format='PNG', optimize=True)
+        image_w = image_box[2] - image_box[0]
+        image_h = image_box[3] - image_box[1]
 
         # Calculate scaled full map size with margins
-        map_size_w = (img.size[0] * map_scale) + (map_margin * 2)
-        map_size_h = (img.size[1] * map_scale) + (map_margin * 2)
+        map_size_w = (image_w * map_scale) + (map_margin * 2)
+        map_size_h = (image_h * map_scale) + (map_margin * 2)
         
         # Init map
         svg = ET.Element("svg", xmlns="http://www.w3.org/2000/svg", width = str(map_size_w), height = str(map_size_h), viewBox = "0 0 %g %g" % (map_size_w, map_size_h))
@@ -396,12 +471,15 @@ class EcovacsMapCamera(Camera):
             }
         """
         
-        # Draw png map
-        map_el = ET.SubElement(svg, "image", x = str(map_margin), y = str(map_margin))
-        map_el.attrib['href'] = "data:image/png;base64," + base64.b64encode(imgByteArr.getvalue()).decode("ascii")
-        map_el.attrib['width'] = "%g" % (img.size[0] * map_scale)
-        map_el.attrib['height'] = "%g" % (img.size[1] * map_scale)
-        map_el.attrib['style'] = "image-rendering: pixelated"
+        # Draw png map, one image per non empty tile
+        for tile_bbox, tile_png in self._map_tiles.values():
+            map_el = ET.SubElement(svg, "image", 
+                                   x = "%g" % ((tile_bbox[0] - image_box[0]) * map_scale + map_margin), 
+                                   y = "%g" % ((tile_bbox[1] - image_box[1]) * map_scale + map_margin))
+            map_el.attrib['href'] = "data:image/png;base64," + tile_png
+            map_el.attrib['width'] = "%g" % ((tile_bbox[2] - tile_bbox[0]) * map_scale)
+            map_el.attrib['height'] = "%g" % ((tile_bbox[3] - tile_bbox[1]) * map_scale)
+            map_el.attrib['style'] = "image-rendering: pixelated"
 
         # Draw devices and trace points
         mapMiddleX = (cropped_map_center_x * map_scale) + map_margin
@@ -427,7 +505,7 @@ class EcovacsMapCamera(Camera):
                         posY = round(mapMiddleY - (map_set_element[p_idx + 1] * device_map_scale), 0)
                         points.append("%g,%g"  % (posX, posY))  
                     
-                    _LOGGER.debug('Map data for type %s: %s' % (map_set_type, points))
+                    _LOGGER.debug('Map data for type %s: %s', map_set_type, points)
                     
                     map_element = ET.SubElement(svg, "polygon", id = svg_id, points = ' '.join(points), style = style)
                     if (map_set_type == 'sa'):
@@ -440,7 +518,10 @@ class EcovacsMapCamera(Camera):
             last_rPosX = None
             last_rPosY = None
             current_command  = None
-            for trace in self._trace_points:
+            
+            # Simplify the trace within half a pixel, as the points are rounded to pixels anyway
+            trace_indices, _ = self._trace_points.simplify(0.5 / (device_map_scale * 10))
+            for trace in self._trace_points.points(indices=trace_indices):
                 rPosX = round(mapMiddleX + (trace['y']  * device_map_scale * 10), 0)
                 rPosY = round(mapMiddleY - (trace['x']  * device_map_scale * 10), 0)
                 
@@ -511,7 +592,7 @@ class EcovacsMapCamera(Camera):
                 last_posX = round(mapMiddleX + (self._camera_image_last_device_pos['x'] * device_map_scale), 3)
                 last_posY = round(mapMiddleY - (self._camera_image_last_device_pos['y'] * device_map_scale), 3)
             
-            _LOGGER.debug('Device position: %s, %s' % (posX, posY))
+            _LOGGER.debug('Device position: %s, %s', posX, posY)
             
             
             circle_el = ET.SubElement(svg, "circle", 
@@ -555,7 +636,7 @@ class EcovacsMapCamera(Camera):
             posX = round(mapMiddleX + (self._charger_pos['x'] * device_map_scale), 3)
             posY = round(mapMiddleY - (self._charger_pos['y'] * device_map_scale) - (device_r + 1), 3)
             
-            _LOGGER.debug('Charger position: %s, %s' % (posX, posY))
+            _LOGGER.debug('Charger position: %s, %s', posX, posY)
             
             circle_el = ET.SubElement(svg, "circle", 
                                       cx = str(posX), 
@@ -574,24 +655,27 @@ class EcovacsMapCamera(Camera):
         self._camera_image_timestamp = time.time()
 
     def decompress7zBase64Data(self, data):
-        # Decode Base64
-        data = base64.b64decode(data)
-        
-        # Get lzma output size (Android app handle it as little-endian signed int)
-        length = struct.unpack('<i', data[5:5+4])[0]
-        
-        # Init the LZMA decompressor using the lzma header
-        dec = lzma.LZMADecompressor(lzma.FORMAT_RAW, None, [lzma._decode_filter_properties(lzma.FILTER_LZMA1, data[0:5])])
+        with self._stats.timing(TIMING_DECOMPRESS):
+            return self._offload.run(decompress_7z_base64_data, data)
         
-        # Decompress the lzma stream to get raw data
-        return dec.decompress(data[9:], length)
+    def get_event_counts(self):
+        """Return the number of events received from the device, per event."""
+        return self._event_counters.get_counts()
         
     def _handle_ctl(self, ctl):
-        _LOGGER.debug('Received event: %s (full data: %s)' % (ctl['event'], ctl))
+        event = ctl['event']
+        self._event_counters.count(event)
+        
+        _LOGGER.debug('Received event: %s (full data: %s)', event, ctl)
     
-        method = '_handle_' + ctl['event']
-        if hasattr(self, method):
-            getattr(self, method)(ctl)
+        # Handlers are resolved once per class (see events.register_event_handler for external handlers)
+        handler = self._event_handlers.get(event)
+        if handler is not None:
+            try:
+                handler(self, ctl)
+            except CommandError as err:
+                # Requests made by the handler failed: their data is requested again by the next update
+                _LOGGER.warning('Unable to handle event %s: %s', event, err)
         
     def _handle_map_m(self, event):
         map_info = {
@@ -604,7 +688,7 @@ class EcovacsMapCamera(Camera):
         }
         
         if (self._map_info != map_info):
-            _LOGGER.debug('Updating map info. Old: %s; New: %s' % (self._map_info, map_info))
+            _LOGGER.debug('Updating map info. Old: %s; New: %s', self._map_info, map_info)
             self._map_info = map_info
             
             self.update_map()
@@ -620,11 +704,20 @@ class EcovacsMapCamera(Camera):
         piece_data = self.decompress7zBase64Data(event.get('p'))
         crc = str(zlib.crc32(piece_data) & 0xffffffff)
         
-        piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + map_id + '_' + crc)
-    
-        with open(piece_cache_file, 'w+b') as f:
-            f.write(bytearray(piece_data))
+        self._map_pieces.put(map_id, crc, piece_data)
         
+        # Draw the piece right away if a map update is waiting for it
+        with self._map_pull_lock:
+            grid_idxs = None
+            if (self._map_pull_pending is not None) and (self._map_pull_pending['map_id'] == map_id):
+                grid_idxs = self._map_pull_pending['pieces'].pop(crc, None)
+                clean_empty = self._map_pull_pending['clean_empty']
+        
+        if (grid_idxs) and (self._map_canvas is not None):
+            for grid_idx in grid_idxs:
+                self.draw_map_grid_piece(self._map_canvas, piece_data, grid_idx, clean_empty)
+            
+            self.publish_partial_map()
         
     def _handle_map_p(self, event):
         # Map patched: update the patched piece
@@ -635,38 +728,24 @@ class EcovacsMapCamera(Camera):
         crc = str(zlib.crc32(piece_data) & 0xffffffff)
         
         if (self._map_info is not None) and (self._map_info['id'] == map_id) and (self._map_info['grid_piece_hashes'][piece_idx] != crc):
-            _LOGGER.debug('Updating map piece: %s' % (piece_idx))
-        
-            piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + map_id + '_' + crc)
+            _LOGGER.debug('Updating map piece: %s', piece_idx)
         
-            with open(piece_cache_file, 'w+b') as f:
-                f.write(bytearray(piece_data))
+            self._map_pieces.put(map_id, crc, piece_data)
 
             # Update the map hash if we have cached map info
             if self._map_info is not None:
                 self._map_info['grid_piece_hashes'][piece_idx] = crc
                 
             # Regenerate map piece portion if there is a map image
-            if (not self._map_image is None):
-                self.draw_map_grid_piece(self._map_image, piece_data, piece_idx, True)
+            if (not self._map_canvas is None):
+                self.draw_map_grid_piece(self._map_canvas, piece_data, piece_idx, True)
 
             self._device_update_timestamp = time.time()
             
             self.schedule_update_ha_state()
 
     def add_trace_data(self, trace_data):
-        if (len(trace_data) != 0) and (len(trace_data) % 5 == 0):
-            for trace_group_idx in range(len(trace_data) // 5):
-                trace_idx = trace_group_idx * 5
-                
-                data = trace_data[trace_idx + 4]
-                
-                self._trace_points.append({
-                    'y': struct.unpack('<h', trace_data[trace_idx:trace_idx+2])[0],
-                    'x': struct.unpack('<h', trace_data[trace_idx+2:trace_idx+4])[0],
-                    'connected': not (((data >> 7) & 1) != 0),
-                    'type': data & 1,
-                })
+        self._trace_points.append_records(trace_data)
             
 
     def _handle_tr_m(self, event):
@@ -676,25 +755,18 @@ class EcovacsMapCamera(Camera):
         }
         
         if (self._trace_info != trace_info):
-            _LOGGER.debug('Updating trace info and points. Old: %s; New: %s' % (self._trace_info, trace_info))
+            _LOGGER.debug('Updating trace info and points. Old: %s; New: %s', self._trace_info, trace_info)
             
-            if (self._trace_points is None) or (self._trace_info is None) or (self._trace_info['id'] != trace_info['id']):
+            if (self._trace_points is None) or (self._trace_chunks is None) or (self._trace_chunks.trace_id != trace_info['id']):
                 _LOGGER.debug('Resetting trace points due new or changed trace id')
-                self._trace_points = []
-                
-            self._trace_info = trace_info
+                self._trace_points = TraceStore()
+                self._trace_chunks = TraceChunkAssembler(trace_info['id'], self._trace_points)
             
-            start_idx = len(self._trace_points)
-            while (start_idx < trace_info['count']):
-                end_idx = min(trace_info['count'] - 1, start_idx + 199)
-                self._device.run(
-                    VacBotCommand('GetTr', 
-                        {
-                            'id': trace_info['id'],
-                            'tf': str(start_idx),  
-                            'tt': str(end_idx)
-                        }))
-                start_idx = end_idx + 1
+            self.fetch_trace_chunks(self._trace_chunks, trace_info['count'], 'id')
+            
+            # Stored only once all the chunks are fetched: after a failed request, the next trace info fetches 
+            # the missing ones again
+            self._trace_info = trace_info
             
             self._device_update_timestamp = time.time()
             
@@ -702,8 +774,35 @@ class EcovacsMapCamera(Camera):
             
         self._trace_info_timestamp = time.time()
         
+    def fetch_trace_chunks(self, trace_chunks, end_idx, trace_id_arg):
+        """Fetch the trace points missing before end_idx, keeping a window of chunk requests in flight."""
+        fetch_futures = []
+        for chunk_range in trace_chunks.claim_missing_ranges(end_idx):
+            fetch_future = self._commands.submit(
+                VacBotCommand('GetTr', 
+                    {
+                        trace_id_arg: trace_chunks.trace_id,
+                        'tf': str(chunk_range[0]),
+                        'tt': str(chunk_range[1]),
+                    }), self.trace_executor)
+            
+            # Release the range also when the request is cancelled, so it can be claimed again
+            fetch_future.add_done_callback(lambda _, chunk_range=chunk_range: trace_chunks.release(chunk_range))
+            fetch_futures.append(fetch_future)
+        
+        wait_command_futures(fetch_futures)
+    
     def _handle_tr(self, event):
-        self.add_trace_data(self.decompress7zBase64Data(event.get('tr')))
+        request = event.get('#request')
+        if (request is None) or ('tf' not in request):
+            # Not a response to a chunk request: append as received
+            self.add_trace_data(self.decompress7zBase64Data(event.get('tr')))
+            return
+        
+        # Store the chunk at the requested index, if the trace is still the requested one
+        trace_chunks = self._trace_chunks
+        if (trace_chunks is not None) and (trace_chunks.trace_id == request.get('id', request.get('trid'))):
+            trace_chunks.add_chunk(int(request['tf']), self.decompress7zBase64Data(event.get('tr')))
         
 
     def _handle_trace(self, event):
@@ -713,27 +812,20 @@ class EcovacsMapCamera(Camera):
 
         _LOGGER.debug('Handling points of received trace event')
         
-        if (self._trace_points is None) or (t_from == 0) or ((self._trace_info is not None) and (self._trace_info['id'] != trace_id)):
-            self._trace_points = []
+        if (self._trace_points is None) or (t_from == 0) or (self._trace_chunks is None) or (self._trace_chunks.trace_id != trace_id):
+            self._trace_points = TraceStore()
+            self._trace_chunks = TraceChunkAssembler(trace_id, self._trace_points)
+
+        # Fill the gap before the received points, which are stored only after it
+        trace_chunks = self._trace_chunks
+        self.fetch_trace_chunks(trace_chunks, t_from, 'trid')
+        
+        trace_chunks.add_chunk(t_from, self.decompress7zBase64Data(event.get('tr')))
         
         self._trace_info = {
             'id': trace_id,
             'count': t_to + 1,
         }
-
-        while (len(self._trace_points) < t_from):
-            chunk_idx = len(self._trace_points)
-            self._device.run(
-                VacBotCommand('GetTr', 
-                    {
-                        'trid': trace_id,
-                        'tf': str(chunk_idx), 
-                        'tt': str(min(t_from - 1, chunk_idx + 199)),
-                    }
-                )
-            )
-        
-        self.add_trace_data(self.decompress7zBase64Data(event.get('tr')))
         
         self._trace_info_timestamp = time.time()
         self._device_update_timestamp = time.time()
@@ -750,27 +842,32 @@ class EcovacsMapCamera(Camera):
         }
         
         if (map_set_type in self._map_set_info and self._map_set_info[map_set_type] != map_set_info):
-            _LOGGER.debug('Updating map set info for %s. Old: %s; New: %s' % (map_set_type, self._map_set_info[map_set_type], map_set_info))
+            _LOGGER.debug('Updating map set info for %s. Old: %s; New: %s', map_set_type, self._map_set_info[map_set_type], map_set_info)
             self._map_set_info[map_set_type] = map_set_info
             
-            self._current_map_set_type = map_set_type 
-            
-            self._map_set_data[map_set_type] = {}
+            # Elements are collected apart and published all together, so pulls of any type can overlap
+            map_set_data = {}
+            self._map_set_pulls[(map_set_type, map_set_info['id'])] = map_set_data
 
             pull_futures = []
             for child in (event.get('#children') or []):
-                pull_futures.append(self.pull_executor.submit(
-                    self.start_pull_m,
-                    
-                    map_set_info['id'],
-                    map_set_type, 
-                    str(child.get('mid'))
-                ))
-                
-            for pull_future in pull_futures:
-                pull_future.result()
-                
-            self._current_map_set_type = None
+                pull_futures.append(self._commands.submit(
+                    VacBotCommand('PullM', 
+                        {
+                            'msid': map_set_info['id'],
+                            'tp': map_set_type, 
+                            'mid': str(child.get('mid')),
+                            'seq': '0',
+                        }
+                    ), self.pull_executor))
+            
+            try:
+                wait_command_futures(pull_futures)
+            finally:
+                if (self._map_set_pulls.get((map_set_type, map_set_info['id'])) is map_set_data):
+                    del self._map_set_pulls[(map_set_type, map_set_info['id'])]
+            
+            self._map_set_data[map_set_type] = map_set_data
             
             self._device_update_timestamp = time.time()
             
@@ -778,27 +875,19 @@ class EcovacsMapCamera(Camera):
             
         self._map_set_info_timestamp[map_set_type] = time.time()
         
-    def start_pull_m(self, msid, map_set_type, mid):
-        self._thread_local.mid = mid
-        self._device.run(
-                    VacBotCommand('PullM', 
-                        {
-                            'msid': msid,
-                            'tp': map_set_type, 
-                            'mid': mid,
-                            'seq': '0',
-                        }
-                    ))
-        
-        del self._thread_local.mid
-        
     def _handle_pull_m(self, event):
-        if (self._current_map_set_type):
+        # Find the map set being pulled from the request of the response
+        request = event.get('#request')
+        if (request is None):
+            return
+        
+        map_set_data = self._map_set_pulls.get((request.get('tp'), request.get('msid')))
+        if (map_set_data is not None):
             map_data = event.get('m')
             if (map_data[0] == '['):
-                self._map_set_data[self._current_map_set_type][self._thread_local.mid] = ast.literal_eval(event.get('m'))
+                map_set_data[request.get('mid')] = ast.literal_eval(event.get('m'))
             else:
-                self._map_set_data[self._current_map_set_type][self._thread_local.mid] = list(map(int, re.split(',|;', event.get('m'))))
+                map_set_data[request.get('mid')] = list(map(int, re.split(',|;', event.get('m'))))
         
         
     def _handle_pos(self, event):
@@ -811,7 +900,7 @@ class EcovacsMapCamera(Camera):
         }
         
         if (self._device_pos != device_pos):
-            _LOGGER.debug('Updating pos. Old: %s; New: %s' % (self._device_pos, device_pos))
+            _LOGGER.debug('Updating pos. Old: %s; New: %s', self._device_pos, device_pos)
             
             self._device_pos = device_pos
             self._device_update_timestamp = time.time()
@@ -830,7 +919,7 @@ class EcovacsMapCamera(Camera):
         }
         
         if (self._charger_pos != charger_pos):
-            _LOGGER.debug('Updating charger. Old: %s; New: %s' % (self._charger_pos, charger_pos))
+            _LOGGER.debug('Updating charger. Old: %s; New: %s', self._charger_pos, charger_pos)
             
             self._charger_pos = charger_pos
             self._device_update_timestamp = time.time()
@@ -0,0 +1,19 @@
+"""Decoding of the compressed payloads sent by the Ecovacs devices."""
+import base64
+import lzma
+import struct
+
+
+def decompress_7z_base64_data(data):
+    """Decode a base64 LZMA (7z) payload, as used for map pieces and traces."""
+    # Decode Base64
+    data = base64.b64decode(data)
+
+    # Get lzma output size (Android app handle it as little-endian signed int)
+    length = struct.unpack('<i', data[5:5+4])[0]
+
+    # Init the LZMA decompressor using the lzma header
+    dec = lzma.LZMADecompressor(lzma.FORMAT_RAW, None, [lzma._decode_filter_properties(lzma.FILTER_LZMA1, data[0:5])])
+
+    # Decompress the lzma stream to get raw data
+    return dec.decompress(data[9:], length)
@@ -0,0 +1,218 @@
+"""Awaitable device commands, with deadlines, over the blocking VacBot API."""
+import asyncio
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+
+from homeassistant.exceptions import HomeAssistantError
+
+_LOGGER = logging.getLogger(__name__)
+
+# Max time waited for the response of a single command
+COMMAND_TIMEOUT = 30
+
+# Max time waited for a batch of commands (e.g. all the pieces of a map)
+COMMAND_BATCH_TIMEOUT = 5 * 60
+
+# Idempotent getters: requests made while one with the same arguments is still queued share its device request
+COALESCED_COMMANDS = frozenset((
+    'GetMapM',
+    'GetTrM',
+    'GetTr',
+    'GetPos',
+    'GetChargerPos',
+    'GetMapSet',
+    'PullMP',
+    'PullM',
+))
+
+
+class CommandError(HomeAssistantError):
+    """A device command did not complete."""
+
+
+class CommandTimeoutError(CommandError):
+    """The device did not answer in time."""
+
+
+class CommandFailedError(CommandError):
+    """The cloud returned no response to a background command (failed or timed out request)."""
+
+
+def set_command_failed(command):
+    """Mark a command whose request got no response: its future fails with CommandFailedError, which feeds the
+    cloud pacing and the batches waiting for it. User commands (async_run) only log it.
+    """
+    command.ecovac_ext_failed = True
+
+
+def set_command_responded(command):
+    """Mark the time the response of a command has been received, before handling it (for the round trip time)."""
+    command.ecovac_ext_response_time = time.perf_counter()
+
+
+def wait_command_futures(futures, timeout=COMMAND_BATCH_TIMEOUT):
+    """Wait for command futures with a common deadline, raising the first command error.
+
+    When the deadline expires, the commands not started yet are cancelled and CommandTimeoutError is raised.
+    """
+    done, not_done = concurrent.futures.wait(futures, timeout)
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        raise CommandTimeoutError('%d of %d commands not completed in %s seconds' % (len(not_done), len(futures), timeout))
+
+    for future in done:
+        future.result()
+
+
+async def async_wait_command_futures(futures, timeout=COMMAND_BATCH_TIMEOUT):
+    """Same as wait_command_futures, without blocking the event loop."""
+    if not futures:
+        return
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*[asyncio.wrap_future(future) for future in futures]), timeout)
+    except asyncio.TimeoutError:
+        # Cancelling the wrappers cancels the commands not started yet
+        raise CommandTimeoutError('Commands not completed in %s seconds' % (timeout)) from None
+
+
+def _command_key(command):
+    return (command.name, json.dumps(command.args, sort_keys=True, default=str))
+
+
+class _SharedCommand:
+    """A queued or running command, with a future for each of its callers.
+
+    The command is cancelled only when all its callers cancelled their futures (e.g. on timeout).
+    """
+
+    def __init__(self, future):
+        self.future = future
+
+        self._lock = threading.Lock()
+        self._waiters = set()
+
+    def join(self, queued_only=True):
+        """Return a new future of the command result, or None if the command can not be joined: cancelled, or
+        already sent (unless queued_only is False). A request sent before a change may not reflect it.
+        """
+        waiter = concurrent.futures.Future()
+        with self._lock:
+            if self.future.cancelled() or (queued_only and (self.future.running() or self.future.done())):
+                return None
+            self._waiters.add(waiter)
+
+        waiter.add_done_callback(self._waiter_done)
+        self.future.add_done_callback(lambda future: self._copy_result(future, waiter))
+        return waiter
+
+    def _waiter_done(self, waiter):
+        with self._lock:
+            self._waiters.discard(waiter)
+            if not self._waiters:
+                self.future.cancel()
+
+    @staticmethod
+    def _copy_result(future, waiter):
+        if future.cancelled():
+            waiter.cancel()
+        elif waiter.set_running_or_notify_cancel():
+            if future.exception() is not None:
+                waiter.set_exception(future.exception())
+            else:
+                waiter.set_result(future.result())
+
+
+class DeviceCommands:
+    """Run the commands of a device on the integration workers, never on the HA executor.
+
+    VacBot.run blocks until the response is handled, so a command still uses a worker while running: timeouts
+    release the caller and cancel the queued commands, while a running command is abandoned to the VacBot
+    transport timeout, holding only an integration worker.
+    """
+
+    def __init__(self, device, executor, timeout=COMMAND_TIMEOUT, stats=None):
+        self._device = device
+        self._executor = executor
+        self._timeout = timeout
+        self._stats = stats
+
+        self._lock = threading.Lock()
+
+        # Outstanding coalesced commands, by name and arguments
+        self._in_flight = {}
+
+    def submit(self, command, executor=None):
+        """Queue a command on the given device executor (by default the commands one) and return its future.
+
+        Getters still queued with the same arguments are not requested again: the returned future gets the result
+        of the queued request. Getters already running are requested again, as their response may predate a
+        change made meanwhile (e.g. walls refreshed after being edited).
+        """
+        executor = executor or self._executor
+        if command.name not in COALESCED_COMMANDS:
+            return executor.submit(self._run, command)
+
+        key = _command_key(command)
+        while True:
+            with self._lock:
+                shared = self._in_flight.get(key)
+                created = shared is None
+                if created:
+                    shared = self._in_flight[key] = _SharedCommand(executor.submit(self._run, command))
+
+            if created:
+                shared.future.add_done_callback(lambda _, shared=shared: self._remove_in_flight(key, shared))
+
+            # The request just queued is joined even if already started
+            waiter = shared.join(queued_only=not created)
+            if waiter is not None:
+                if not created:
+                    _LOGGER.debug('Joining the queued %s request', command.name)
+                return waiter
+
+            if created:
+                # Cancelled by the executor shutdown
+                return shared.future
+
+            # Already sent, or cancelled by all its previous callers meanwhile: request it again
+            self._remove_in_flight(key, shared)
+
+    def _run(self, command):
+        start = time.perf_counter()
+        try:
+            result = self._device.run(command)
+        finally:
+            # Only the responses marked on receipt are timed: XMPP devices return once the command is sent
+            end = getattr(command, 'ecovac_ext_response_time', None)
+            if (self._stats is not None) and (end is not None):
+                self._stats.observe_command(command.name, end - start)
+
+        if getattr(command, 'ecovac_ext_failed', False):
+            raise CommandFailedError('No response to %s' % command.name)
+        return result
+
+    def _remove_in_flight(self, key, shared):
+        with self._lock:
+            if self._in_flight.get(key) is shared:
+                del self._in_flight[key]
+
+    async def async_run(self, command, timeout=None):
+        """Run a user command, returning its result once the device answered.
+
+        Some commands normally get no response from the cloud (e.g. Clean, PlaySound): a missing response is not
+        an error, and None is returned.
+        """
+        timeout = timeout or self._timeout
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self.submit(command)), timeout)
+        except CommandFailedError:
+            _LOGGER.debug('No response to %s', command.name)
+            return None
+        except asyncio.TimeoutError:
+            _LOGGER.warning('Command %s not completed in %s seconds', command.name, timeout)
+            raise CommandTimeoutError('Command %s not completed in %s seconds' % (command.name, timeout)) from None
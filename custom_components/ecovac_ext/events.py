@@ -0,0 +1,173 @@
+"""Decoding of the device messages, parsed once for both the local handlers and the ozmo ones."""
+from collections import Counter
+import re
+import threading
+from xml.sax.saxutils import unescape
+
+import stringcase
+
+# Start tag of the root element of a MQTT message, and its td attribute: the event of a message is found
+# without parsing the whole (possibly big) message
+_ROOT_TAG_RE = re.compile(rb'\s*(?:<\?[^>]*\?>\s*)?<[\w:.-]+(\s[^>]*)?>')
+_TD_ATTR_RE = re.compile(rb'\std\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+# Tags of the API responses reported as status events by ozmo
+_OZMO_API_TAG_EVENTS = {
+    'clean': 'CleanReport',
+    'charge': 'ChargeState',
+    'battery': 'BatteryInfo',
+}
+
+# Snake case names of the received events and commands: only a few different ones, received very often
+_event_names = {}
+
+# Methods handling the events, as _handle_<event name>
+_HANDLER_PREFIX = '_handle_'
+
+# Event handler registries, by class
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_event_name(name):
+    """Return the snake case event name of a td or command name."""
+    event_name = _event_names.get(name)
+    if event_name is None:
+        event_name = _event_names[name] = stringcase.snakecase(name)
+    return event_name
+
+
+def get_command_event_name(command_name):
+    """Return the event name of the response to a command."""
+    return get_event_name(command_name.replace('Get', '', 1))
+
+
+def find_mqtt_td(payload):
+    """Return the td of a MQTT message payload, or None if its root element has no td."""
+    match = _ROOT_TAG_RE.match(payload)
+    if match is None or match.group(1) is None:
+        return None
+
+    match = _TD_ATTR_RE.search(match.group(1))
+    if match is None:
+        return None
+
+    td = match.group(1) if match.group(1) is not None else match.group(2)
+    return unescape(td.decode('utf-8'), {'&quot;': '"', '&apos;': "'"})
+
+
+def element_to_dict(xml):
+    """Convert an element to a dict of its attributes, with its children (if any) as a list in '#children'."""
+    result = xml.attrib.copy()
+
+    if len(xml):
+        result['#children'] = [element_to_dict(child) for child in xml]
+
+    return result
+
+
+def _is_int(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+
+def _to_ozmo_dict(attrib, event, keep_lists):
+    # Same conversion of the ozmo iotmq handlers: values are snake cased, but numbers (and lists, for MQTT)
+    result = attrib
+    for key, value in result.items():
+        if not _is_int(value) and not (keep_lists and ',' in value):
+            result[key] = stringcase.snakecase(value)
+
+    result['event'] = event
+    return result
+
+
+def get_ozmo_api_event_name(command_name, xml):
+    """Return the name of the ozmo event of an API response, as handled by VacBot."""
+    if len(xml):
+        event = _OZMO_API_TAG_EVENTS.get(xml[0].tag)
+        if event is not None:
+            return get_event_name(event)
+    elif command_name == 'Charge' and xml.get('ret') == 'fail':
+        return get_event_name('ChargeState')
+
+    return get_command_event_name(command_name)
+
+
+def to_ozmo_api_dict(command_name, xml):
+    """Convert a parsed API response as the ozmo iotmq handler does."""
+    attrib = xml[0].attrib.copy() if len(xml) else xml.attrib.copy()
+    return _to_ozmo_dict(attrib, get_ozmo_api_event_name(command_name, xml), False)
+
+
+def to_ozmo_mqtt_dict(xml):
+    """Convert a parsed MQTT message with a td as the ozmo iotmq handler does."""
+    attrib = xml.attrib.copy()
+    event = get_event_name(attrib.pop('td'))
+    if len(xml):
+        attrib.update(xml[0].attrib)
+    return _to_ozmo_dict(attrib, event, True)
+
+
+class EventHandlerRegistry:
+    """Event handlers of a class: its _handle_<event> methods, plus the handlers registered by other modules.
+
+    Handlers are plain functions, called as handler(instance, event).
+    """
+
+    def __init__(self, cls):
+        self._handlers = {}
+        for name in dir(cls):
+            if name.startswith(_HANDLER_PREFIX) and name != '_handle_ctl':
+                handler = getattr(cls, name)
+                if callable(handler):
+                    self._handlers[name[len(_HANDLER_PREFIX):]] = handler
+
+    def register(self, event, handler):
+        self._handlers[event] = handler
+
+    def get(self, event):
+        """Return the handler of an event, or None if the event is not handled."""
+        return self._handlers.get(event)
+
+    def __contains__(self, event):
+        return event in self._handlers
+
+
+def get_event_handlers(cls):
+    """Return the event handler registry of a class, built on first use."""
+    registry = _registries.get(cls)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.get(cls)
+            if registry is None:
+                registry = _registries[cls] = EventHandlerRegistry(cls)
+    return registry
+
+
+def register_event_handler(cls, event):
+    """Decorator registering a function as the handler of an event for the instances of a class."""
+    def decorator(handler):
+        get_event_handlers(cls).register(event, handler)
+        return handler
+    return decorator
+
+
+class EventCounters:
+    """Number of received events, per event name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def count(self, event):
+        with self._lock:
+            self._counts[event] += 1
+
+    def get_counts(self):
+        """Return the counts, the most received events first."""
+        with self._lock:
+            return dict(self._counts.most_common())
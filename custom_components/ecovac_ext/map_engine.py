@@ -0,0 +1,264 @@
+"""Map raster helpers shared by the Ecovacs map entities."""
+import asyncio
+import io
+import threading
+import uuid
+
+from PIL import Image
+
+# Map piece cell classes
+MAP_VALUE_EMPTY = 0x00
+MAP_VALUE_FLOOR = 0x01
+MAP_VALUE_WALL = 0x02
+
+MAP_COLORS = {
+    # Empty: transparent
+    MAP_VALUE_EMPTY: (0, 0, 0, 0),
+    # Floor: light blue
+    MAP_VALUE_FLOOR: (186, 218, 255, 255),
+    # Wall: dark blue
+    MAP_VALUE_WALL: (84, 147, 214, 255),
+}
+
+# Fixed palette indexed by cell class, used only when encoding the map
+MAP_PALETTE = [band for value in sorted(MAP_COLORS) for band in MAP_COLORS[value][:3]]
+
+# Value used to pad truncated pieces: unknown classes never touch the map
+_MAP_VALUE_UNKNOWN = 0xff
+
+
+def _build_band_luts():
+    """Build one 256 entries lookup table per RGBA band, mapping cell classes to colors."""
+    luts = [[0] * 256 for _ in range(4)]
+    for value, color in MAP_COLORS.items():
+        for band, band_value in enumerate(color):
+            luts[band][value] = band_value
+    return luts
+
+
+def _build_mask_lut(clean_empty):
+    """Build the paste mask lookup table: only known classes are drawn, empty ones only if requested."""
+    lut = [0] * 256
+    lut[MAP_VALUE_FLOOR] = 255
+    lut[MAP_VALUE_WALL] = 255
+    if clean_empty:
+        lut[MAP_VALUE_EMPTY] = 255
+    return lut
+
+
+_BAND_LUTS = _build_band_luts()
+_MASK_LUTS = {
+    True: _build_mask_lut(True),
+    False: _build_mask_lut(False),
+}
+
+
+def get_piece_origin(map_info, grid_idx):
+    """Return the (x, y) map coordinates (bottom-left origin) of a grid piece."""
+    x = (grid_idx % map_info['grid_columns']) * map_info['grid_piece_w']
+    y = (grid_idx // map_info['grid_rows']) * map_info['grid_piece_h']
+    return x, y
+
+
+def rasterize_map_piece(piece_data, piece_w, piece_h):
+    """Convert a raw map piece buffer into a class image, already rotated for PIL coordinates.
+
+    The map is bottom, left origin, but PIL is upper left: the piece is rotated by 90° counter-clockwise,
+    so the resulting image has a (piece_h, piece_w) size.
+    """
+    piece_len = piece_w * piece_h
+    if len(piece_data) != piece_len:
+        # Missing cells are left untouched, exactly as a per-cell drawing would do
+        piece_data = bytes(piece_data[:piece_len]).ljust(piece_len, bytes([_MAP_VALUE_UNKNOWN]))
+
+    piece = Image.frombytes('L', (piece_w, piece_h), bytes(piece_data))
+    return piece.transpose(Image.ROTATE_90)
+
+
+def rasterize_map_piece_data(piece_data, piece_w, piece_h):
+    """Same as rasterize_map_piece, but returning the raw class bytes of the rotated piece."""
+    return rasterize_map_piece(piece_data, piece_w, piece_h).tobytes()
+
+
+def encode_map_png_data(size, data):
+    """Encode raw class bytes of the given size as a palette PNG with the fixed map colors."""
+    img = Image.frombytes('L', size, data)
+    img.putpalette(MAP_PALETTE)
+
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG', optimize=True, transparency=MAP_VALUE_EMPTY)
+    return img_byte_arr.getvalue()
+
+
+def _union_boxes(boxes):
+    """Return the box enclosing all the given (non None) boxes, or None if there are none."""
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return None
+
+    return (
+        min(box[0] for box in boxes),
+        min(box[1] for box in boxes),
+        max(box[2] for box in boxes),
+        max(box[3] for box in boxes),
+    )
+
+
+class MapCanvas:
+    """Class indexed map: one byte per cell, colors are applied only when encoding.
+
+    Every piece drawing increments the canvas version and marks the piece tile as dirty, so consumers can
+    refresh only the tiles changed since the version they already have. Versions are comparable only within
+    the same canvas (identified by canvas_id): the versions of another process restart from the same values.
+    The content bounding box is kept up to date per tile, without scanning the whole map.
+    """
+
+    def __init__(self, width, height, base_version=0):
+        self._image = Image.new('L', (width, height), MAP_VALUE_EMPTY)
+
+        self._lock = threading.Lock()
+
+        self.canvas_id = uuid.uuid4().hex
+
+        # Versions before the base one refer to a previous canvas: they always require a full refresh
+        self.base_version = base_version
+        self.version = base_version
+
+        self._tile_versions = {}
+        self._tile_bboxes = {}
+
+        self._bbox = None
+        self._bbox_version = base_version
+
+        # Grid index -> hash of the piece drawn there, to skip unchanged pieces on map updates
+        self.grid_hashes = {}
+
+    @property
+    def size(self):
+        return self._image.size
+
+    def tobytes(self):
+        """Return the raw class bytes of the map (not torn by pieces drawn meanwhile)."""
+        with self._lock:
+            return self._image.tobytes()
+
+    def load_raster(self, data, map_info):
+        """Replace the map content with raw class bytes (as returned by tobytes), marking all tiles as changed."""
+        with self._lock:
+            self._image = Image.frombytes('L', self._image.size, data)
+
+        for grid_idx in range(map_info['grid_rows'] * map_info['grid_columns']):
+            self._update_tile(self._get_tile_box(map_info, grid_idx))
+
+    def getbbox(self):
+        """Return the bounding box of the non-empty map content."""
+        return self._bbox
+
+    def bbox_changed_since(self, version):
+        """Return True if the content bounding box changed after the given version."""
+        return version < self._bbox_version
+
+    def get_tile_bbox(self, box):
+        """Return the bounding box of the non-empty content of a tile."""
+        return self._tile_bboxes.get(box)
+
+    def dirty_boxes(self, since_version):
+        """Return the boxes of the tiles changed after the given version, or None if a full refresh is needed."""
+        with self._lock:
+            if since_version < self.base_version or since_version > self.version:
+                return None
+
+            return [box for box, version in self._tile_versions.items() if version > since_version]
+
+    def draw_grid_piece(self, piece_data, map_info, grid_idx, clean_empty):
+        """Draw a whole map piece with a single paste operation."""
+        tile = rasterize_map_piece(piece_data, map_info['grid_piece_w'], map_info['grid_piece_h'])
+        self._draw_grid_tile(tile, map_info, grid_idx, clean_empty)
+
+    def draw_grid_tile(self, tile_data, map_info, grid_idx, clean_empty):
+        """Draw a map piece already rasterized by rasterize_map_piece_data."""
+        tile = Image.frombytes('L', (map_info['grid_piece_h'], map_info['grid_piece_w']), tile_data)
+        self._draw_grid_tile(tile, map_info, grid_idx, clean_empty)
+
+    def _get_tile_box(self, map_info, grid_idx):
+        """Return the box of a grid piece in PIL coordinates (the piece is rotated, see rasterize_map_piece)."""
+        x, y = get_piece_origin(map_info, grid_idx)
+
+        left = y
+        top = self._image.size[1] - x - map_info['grid_piece_w']
+        return (left, top, left + map_info['grid_piece_h'], top + map_info['grid_piece_w'])
+
+    def _draw_grid_tile(self, tile, map_info, grid_idx, clean_empty):
+        box = self._get_tile_box(map_info, grid_idx)
+
+        mask = tile.point(_MASK_LUTS[bool(clean_empty)])
+
+        with self._lock:
+            self._image.paste(tile, box[:2], mask)
+
+        self._update_tile(box)
+
+    def _update_tile(self, box):
+        """Bump the canvas version for a changed tile, and update the content bounding box."""
+        tile_bbox = self._image.crop(box).getbbox()
+        if tile_bbox:
+            tile_bbox = (tile_bbox[0] + box[0], tile_bbox[1] + box[1], tile_bbox[2] + box[0], tile_bbox[3] + box[1])
+
+        with self._lock:
+            self.version += 1
+            self._tile_versions[box] = self.version
+
+            if self._tile_bboxes.get(box) != tile_bbox:
+                self._tile_bboxes[box] = tile_bbox
+
+                bbox = _union_boxes(self._tile_bboxes.values())
+                if bbox != self._bbox:
+                    self._bbox = bbox
+                    self._bbox_version = self.version
+
+    def to_rgba(self):
+        """Return an RGBA image of the map, as the legacy map image."""
+        return Image.merge('RGBA', [self._image.point(lut) for lut in _BAND_LUTS])
+
+    def encode_png(self, box=None, offload=None):
+        """Encode the map (or the given box) as a palette PNG, optionally through a CpuOffload."""
+        img = self._image.crop(box) if box else self._image
+
+        if offload is None:
+            return encode_map_png_data(img.size, img.tobytes())
+
+        return offload.run(encode_map_png_data, img.size, img.tobytes())
+
+
+class MapEncodeCache:
+    """Cache of an encoded map per map version, sharing a single in-flight encode between concurrent requests."""
+
+    def __init__(self):
+        self._version = None
+        self._result = None
+        self._pending_version = None
+        self._pending_future = None
+
+    async def async_get(self, hass, version, encode_job):
+        """Return the encoded map for the given version, running the encode job in the executor if needed."""
+        if self._result is not None and self._version == version:
+            return self._result
+
+        if self._pending_future is None or self._pending_version != version:
+            self._pending_version = version
+            self._pending_future = hass.async_add_executor_job(encode_job)
+
+        future = self._pending_future
+        try:
+            # Shield the shared encode from the cancellation of a single requester
+            result = await asyncio.shield(future)
+        finally:
+            if self._pending_future is future and future.done():
+                self._pending_version = None
+                self._pending_future = None
+
+        if self._version is None or version >= self._version:
+            self._version = version
+            self._result = result
+
+        return result
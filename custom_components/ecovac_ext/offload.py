@@ -0,0 +1,38 @@
+"""Optional process pool for the CPU heavy map work."""
+import concurrent.futures
+import logging
+import multiprocessing
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class CpuOffload:
+    """Run pure functions (bytes in, bytes out) in a process pool, outside of the GIL shared with Home Assistant.
+
+    When no worker is configured, functions are run directly in the calling thread, which is already an 
+    executor or a connection thread.
+    """
+
+    def __init__(self, workers=0):
+        self._pool = None
+        if workers > 0:
+            _LOGGER.debug('Starting map process pool with %s workers', workers)
+            # Spawn fresh processes: forking a process running many threads is not safe
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    @property
+    def enabled(self):
+        return self._pool is not None
+
+    def run(self, fn, *args):
+        """Run the function and return its result, blocking the calling thread."""
+        if self._pool is None:
+            return fn(*args)
+
+        return self._pool.submit(fn, *args).result()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
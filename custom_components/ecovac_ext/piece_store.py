@@ -0,0 +1,308 @@
+"""Persistent store and in-memory cache of the decompressed map pieces."""
+from collections import OrderedDict
+import concurrent.futures
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+PIECE_FILE_PREFIX = 'map_cache_'
+
+# Max size of the stored pieces for a single device
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+
+# Map ids not used for this time are removed at startup
+DEFAULT_STALE_MAP_AGE = 60 * 60 * 24 * 30
+
+# Max number of pieces kept in memory for a single device
+DEFAULT_MAX_CACHED_PIECES = 256
+
+# Prefix of the temporary directories used before the persistent store
+_LEGACY_TEMP_DIR_PREFIX = 'vacuum_ecovacs_map_cache_'
+
+
+def _piece_file_name(map_id, crc):
+    return PIECE_FILE_PREFIX + str(map_id) + '_' + str(crc)
+
+
+def _parse_piece_file_name(file_name):
+    """Return the (map id, crc) of a piece file, or None for unknown files."""
+    if not file_name.startswith(PIECE_FILE_PREFIX):
+        return None
+
+    map_id, sep, crc = file_name[len(PIECE_FILE_PREFIX):].rpartition('_')
+    if not sep:
+        return None
+
+    return map_id, crc
+
+
+class MapPieceStore:
+    """Map pieces stored on disk, content addressed by map id and piece CRC.
+
+    The store survives restarts: pieces already known are not pulled again while the map hashes are unchanged.
+    The total size is capped evicting the least recently used pieces, and pieces of maps not used for a long
+    time are removed when the store is loaded.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, stale_map_age=DEFAULT_STALE_MAP_AGE):
+        self._path = path
+        self._max_size = max_size
+        self._stale_map_age = stale_map_age
+
+        self._lock = threading.Lock()
+
+        # Piece file name -> [size, last use time]
+        self._entries = {}
+        self._size = 0
+
+        self._directory_created = False
+
+    @property
+    def size(self):
+        return self._size
+
+    def load(self):
+        """Index the stored pieces and remove the ones of stale maps (blocking I/O)."""
+        self._ensure_directory()
+
+        entries = {}
+        for file_name in os.listdir(self._path):
+            if _parse_piece_file_name(file_name) is None:
+                continue
+
+            try:
+                stat = os.stat(os.path.join(self._path, file_name))
+            except OSError:
+                continue
+            entries[file_name] = [stat.st_size, stat.st_mtime]
+
+        with self._lock:
+            for file_name, entry in entries.items():
+                if file_name not in self._entries:
+                    self._entries[file_name] = entry
+                    self._size += entry[0]
+
+        self.collect_garbage()
+
+        _LOGGER.debug('Loaded map piece store %s: %s pieces, %s bytes', self._path, len(self._entries), self._size)
+
+    def collect_garbage(self):
+        """Remove the pieces of the maps not used for longer than the stale map age."""
+        with self._lock:
+            map_last_use = {}
+            for file_name, (_, last_use) in self._entries.items():
+                map_id = _parse_piece_file_name(file_name)[0]
+                map_last_use[map_id] = max(map_last_use.get(map_id, 0), last_use)
+
+            stale_map_ids = set(
+                map_id for map_id, last_use in map_last_use.items() if time.time() - last_use > self._stale_map_age)
+
+            if stale_map_ids:
+                _LOGGER.debug('Removing pieces of stale maps: %s', stale_map_ids)
+                for file_name in list(self._entries):
+                    if _parse_piece_file_name(file_name)[0] in stale_map_ids:
+                        self._remove(file_name)
+
+    def contains(self, map_id, crc):
+        return _piece_file_name(map_id, crc) in self._entries
+
+    def get(self, map_id, crc):
+        """Return the piece data, or None if the piece is not stored."""
+        file_name = _piece_file_name(map_id, crc)
+        if file_name not in self._entries:
+            return None
+
+        file_path = os.path.join(self._path, file_name)
+        try:
+            with open(file_path, 'rb') as f:
+                piece_data = f.read()
+        except OSError:
+            _LOGGER.warning('Unable to read map piece %s', file_path)
+            with self._lock:
+                self._remove(file_name)
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(file_name)
+            if entry is not None:
+                entry[1] = now
+        try:
+            os.utime(file_path, (now, now))
+        except OSError:
+            pass
+
+        return piece_data
+
+    def put(self, map_id, crc, piece_data):
+        """Store a piece, evicting the least recently used ones if the store is full."""
+        self._ensure_directory()
+
+        file_name = _piece_file_name(map_id, crc)
+        file_path = os.path.join(self._path, file_name)
+
+        # Write to a temporary file first, to never leave partial pieces in the store
+        temp_file_path = file_path + '.tmp' + str(threading.get_ident())
+        with open(temp_file_path, 'w+b') as f:
+            f.write(piece_data)
+        os.replace(temp_file_path, file_path)
+
+        with self._lock:
+            previous_entry = self._entries.get(file_name)
+            if previous_entry is not None:
+                self._size -= previous_entry[0]
+
+            self._entries[file_name] = [len(piece_data), time.time()]
+            self._size += len(piece_data)
+
+            self._evict(keep=file_name)
+
+    def _evict(self, keep):
+        if self._size <= self._max_size:
+            return
+
+        for file_name, _ in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if self._size <= self._max_size:
+                break
+            if file_name != keep:
+                self._remove(file_name)
+
+    def _remove(self, file_name):
+        entry = self._entries.pop(file_name, None)
+        if entry is not None:
+            self._size -= entry[0]
+
+        try:
+            os.remove(os.path.join(self._path, file_name))
+        except OSError:
+            pass
+
+    def _ensure_directory(self):
+        if not self._directory_created:
+            os.makedirs(self._path, exist_ok=True)
+            self._directory_created = True
+
+
+class MapPieceCache:
+    """Bounded in-memory LRU cache of map pieces in front of a MapPieceStore.
+
+    Pieces are served from memory when possible, and new pieces are written behind to the store through the
+    given writer (an executor, usually the device view of the integration store executor): pieces waiting to
+    be written are still served from memory. Without a writer, pieces are written by the calling thread.
+    """
+
+    def __init__(self, store, writer=None, max_pieces=DEFAULT_MAX_CACHED_PIECES):
+        self._store = store
+        self._writer = writer
+        self._max_pieces = max_pieces
+
+        self._lock = threading.Lock()
+
+        # (map id, crc) -> piece data
+        self._pieces = OrderedDict()
+        self._pending_writes = {}
+
+        # Futures of the writes not completed yet
+        self._write_futures = set()
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def store(self):
+        return self._store
+
+    def load(self):
+        """Load the underlying store (blocking I/O)."""
+        self._store.load()
+
+    def contains(self, map_id, crc):
+        key = (str(map_id), str(crc))
+        with self._lock:
+            if key in self._pieces or key in self._pending_writes:
+                return True
+
+        return self._store.contains(map_id, crc)
+
+    def get(self, map_id, crc):
+        """Return the piece data, or None if the piece is neither cached nor stored."""
+        key = (str(map_id), str(crc))
+        with self._lock:
+            piece_data = self._pieces.get(key)
+            if piece_data is None:
+                piece_data = self._pending_writes.get(key)
+
+            if piece_data is not None:
+                self.hits += 1
+                self._cache(key, piece_data)
+                return piece_data
+
+        piece_data = self._store.get(map_id, crc)
+        with self._lock:
+            # Pieces found in the store are hits as well: only the misses are pulled from the cloud
+            if piece_data is not None:
+                self.hits += 1
+                self._cache(key, piece_data)
+            else:
+                self.misses += 1
+
+        return piece_data
+
+    def put(self, map_id, crc, piece_data):
+        """Cache a piece and schedule its write to the store."""
+        key = (str(map_id), str(crc))
+        piece_data = bytes(piece_data)
+
+        with self._lock:
+            self._cache(key, piece_data)
+            self._pending_writes[key] = piece_data
+
+        if self._writer is None:
+            self._write(key, piece_data)
+            return
+
+        future = self._writer.submit(self._write, key, piece_data)
+        with self._lock:
+            self._write_futures.add(future)
+        future.add_done_callback(self._write_done)
+
+    def shutdown(self):
+        """Wait for the pending writes to be completed."""
+        with self._lock:
+            futures = list(self._write_futures)
+
+        concurrent.futures.wait(futures)
+
+    def _write_done(self, future):
+        with self._lock:
+            self._write_futures.discard(future)
+
+    def _write(self, key, piece_data):
+        try:
+            self._store.put(key[0], key[1], piece_data)
+        except OSError as ex:
+            _LOGGER.warning('Unable to store map piece %s: %s', key, ex)
+        finally:
+            with self._lock:
+                if self._pending_writes.get(key) is piece_data:
+                    del self._pending_writes[key]
+
+    def _cache(self, key, piece_data):
+        self._pieces[key] = piece_data
+        self._pieces.move_to_end(key)
+
+        while len(self._pieces) > self._max_pieces:
+            self._pieces.popitem(last=False)
+
+
+def remove_legacy_temp_directories(device_id):
+    """Remove the temporary map cache directories created by the previous versions."""
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), _LEGACY_TEMP_DIR_PREFIX + glob.escape(device_id) + '*')):
+        _LOGGER.debug('Removing legacy map cache directory %s', path)
+        shutil.rmtree(path, ignore_errors=True)
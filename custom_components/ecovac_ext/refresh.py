@@ -0,0 +1,136 @@
+"""State dependent refresh intervals of the data polled from the devices."""
+import logging
+import threading
+import time
+
+from homeassistant.components.vacuum import STATE_CLEANING, STATE_DOCKED, STATE_RETURNING, STATE_IDLE, STATE_PAUSED
+
+_LOGGER = logging.getLogger(__name__)
+
+# Data polled from the devices
+RESOURCE_MAP = 'map'
+RESOURCE_TRACE = 'trace'
+RESOURCE_POS = 'pos'
+RESOURCE_CHARGER_POS = 'charger_pos'
+RESOURCE_MAP_SET = 'map_set'
+
+# Device activities, each one with its own refresh intervals
+ACTIVITY_CLEANING = 'cleaning'
+ACTIVITY_RETURNING = 'returning'
+ACTIVITY_DOCKED = 'docked'
+ACTIVITY_IDLE = 'idle'
+ACTIVITY_UNKNOWN = 'unknown'
+
+_STATE_TO_ACTIVITY = {
+    STATE_CLEANING: ACTIVITY_CLEANING,
+    STATE_RETURNING: ACTIVITY_RETURNING,
+    STATE_DOCKED: ACTIVITY_DOCKED,
+    STATE_IDLE: ACTIVITY_IDLE,
+    STATE_PAUSED: ACTIVITY_IDLE,
+}
+
+_MINUTE = 60
+_HOUR = 60 * _MINUTE
+
+# Refresh intervals (seconds) per activity. While moving, the devices push map, trace and position updates by
+# themselves, so polling is only a fallback for lost pushes. While docked, nothing changes for a long time.
+REFRESH_INTERVALS = {
+    ACTIVITY_CLEANING: {
+        RESOURCE_MAP: 10 * _MINUTE,
+        RESOURCE_TRACE: 10 * _MINUTE,
+        RESOURCE_POS: 10 * _MINUTE,
+        RESOURCE_CHARGER_POS: 1 * _HOUR,
+        RESOURCE_MAP_SET: 30 * _MINUTE,
+    },
+    ACTIVITY_RETURNING: {
+        RESOURCE_MAP: 10 * _MINUTE,
+        RESOURCE_TRACE: 10 * _MINUTE,
+        RESOURCE_POS: 10 * _MINUTE,
+        RESOURCE_CHARGER_POS: 1 * _HOUR,
+        RESOURCE_MAP_SET: 30 * _MINUTE,
+    },
+    ACTIVITY_IDLE: {
+        RESOURCE_MAP: 30 * _MINUTE,
+        RESOURCE_TRACE: 30 * _MINUTE,
+        RESOURCE_POS: 30 * _MINUTE,
+        RESOURCE_CHARGER_POS: 2 * _HOUR,
+        RESOURCE_MAP_SET: 30 * _MINUTE,
+    },
+    ACTIVITY_DOCKED: {
+        RESOURCE_MAP: 6 * _HOUR,
+        RESOURCE_TRACE: 6 * _HOUR,
+        RESOURCE_POS: 6 * _HOUR,
+        RESOURCE_CHARGER_POS: 24 * _HOUR,
+        RESOURCE_MAP_SET: 6 * _HOUR,
+    },
+    # Offline, in error or not known yet: the previous fixed interval
+    ACTIVITY_UNKNOWN: {
+        RESOURCE_MAP: 5 * _MINUTE,
+        RESOURCE_TRACE: 5 * _MINUTE,
+        RESOURCE_POS: 5 * _MINUTE,
+        RESOURCE_CHARGER_POS: 5 * _MINUTE,
+        RESOURCE_MAP_SET: 5 * _MINUTE,
+    },
+}
+
+# Resources refreshed as soon as the device enters an activity, whatever their last update
+FORCED_REFRESHES = {
+    # A new cleaning starts a new trace
+    ACTIVITY_CLEANING: (RESOURCE_TRACE,),
+    # The cleaning is over: get the final map, trace and position
+    ACTIVITY_RETURNING: (RESOURCE_MAP, RESOURCE_TRACE, RESOURCE_POS),
+    ACTIVITY_DOCKED: (RESOURCE_MAP, RESOURCE_TRACE, RESOURCE_POS, RESOURCE_CHARGER_POS, RESOURCE_MAP_SET),
+}
+
+
+def get_activity(state):
+    """Return the refresh activity of a vacuum state."""
+    return _STATE_TO_ACTIVITY.get(state, ACTIVITY_UNKNOWN)
+
+
+class RefreshPolicy:
+    """Decide when each resource has to be polled again, based on the current device activity.
+
+    Activity changes are notified by the device status thread, while resources are checked by the update loop.
+    """
+
+    def __init__(self, intervals=REFRESH_INTERVALS, forced_refreshes=FORCED_REFRESHES):
+        self._intervals = intervals
+        self._forced_refreshes = forced_refreshes
+
+        self._lock = threading.Lock()
+
+        self._activity = ACTIVITY_UNKNOWN
+        self._forced = set()
+
+    @property
+    def activity(self):
+        return self._activity
+
+    def set_activity(self, activity):
+        """Update the current activity. Return True if some resources have to be refreshed immediately."""
+        with self._lock:
+            if activity == self._activity:
+                return False
+
+            _LOGGER.debug('Device activity changed from %s to %s', self._activity, activity)
+            self._activity = activity
+
+            forced = self._forced_refreshes.get(activity, ())
+            self._forced.update(forced)
+            return bool(forced)
+
+    def is_due(self, resource, last_update, now=None):
+        """Return True if the resource, last updated at the given time (or never, if None), has to be polled."""
+        if last_update is None or resource in self._forced:
+            return True
+
+        if now is None:
+            now = time.time()
+
+        return now - last_update >= self._intervals[self._activity][resource]
+
+    def refreshing(self, resource):
+        """Mark a forced refresh as handled."""
+        with self._lock:
+            self._forced.discard(resource)
@@ -0,0 +1,300 @@
+"""Integration wide work scheduler for the blocking device commands."""
+from collections import OrderedDict, deque
+import concurrent.futures
+import logging
+import threading
+import time
+
+from .throttle import AdaptiveConcurrency, CloudAdmission, TokenBucket, INITIAL_CONCURRENCY
+
+_LOGGER = logging.getLogger(__name__)
+
+# Work kinds, each one with its own per-device concurrency limit
+WORK_UPDATES = 'updates'
+WORK_PULL = 'pull'
+WORK_TRACE = 'trace'
+WORK_COMMAND = 'command'
+WORK_STORE = 'store'
+
+# Workers writing the map pieces to disk, for all the devices
+STORE_WORKERS = 1
+
+
+class FairExecutor:
+    """Bounded thread pool shared by all the devices, with fair queuing between devices.
+
+    Work is queued per device and kind of work: idle workers take the next work round-robin over the devices
+    with pending work, then over the kinds of work of the device, so a device pulling a big map can not starve
+    the others. Each (device, kind) can also be limited to a max number of running works.
+
+    Work submitted to an executor must never wait for other work of the same executor, or all the workers
+    may end up waiting: use a different executor for nested work.
+
+    An optional admission (see CloudAdmission) can hold queued work back: held work is skipped, so it never
+    occupies a worker while waiting.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix, admission=None):
+        self._max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._admission = admission
+
+        self._cond = threading.Condition()
+
+        # Device -> kind -> queued work, both in round-robin order
+        self._queues = OrderedDict()
+
+        # (device, kind) -> running work count / max running work count
+        self._running = {}
+        self._limits = {}
+
+        self._threads = []
+        self._idle_workers = 0
+        self._shutdown = False
+
+    def set_limit(self, device, kind, max_running):
+        with self._cond:
+            self._limits[(device, kind)] = max_running
+
+    def submit(self, device, kind, fn, *args):
+        """Queue a call and return its concurrent.futures.Future."""
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new work after shutdown')
+
+            self._queues.setdefault(device, OrderedDict()).setdefault(kind, deque()).append((future, fn, args))
+
+            if self._idle_workers == 0 and len(self._threads) < self._max_workers:
+                thread = threading.Thread(
+                    name='%s_%d' % (self._thread_name_prefix, len(self._threads)), target=self._work, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+            self._cond.notify()
+
+        return future
+
+    def cancel_pending(self, device, kind=None):
+        """Cancel the queued (not running) work of a device, of all kinds or of the given one."""
+        with self._cond:
+            kinds = self._queues.get(device)
+            if kinds is None:
+                return
+
+            for queue_kind in list(kinds):
+                if kind is None or queue_kind == kind:
+                    for future, _, _ in kinds.pop(queue_kind):
+                        future.cancel()
+
+            if not kinds:
+                del self._queues[device]
+
+    def queue_depths(self, kind=None):
+        """Return the number of queued works per device, of the given kind or of all the kinds."""
+        with self._cond:
+            counts = {}
+            for device, kinds in self._queues.items():
+                depth = sum(len(queue) for work_kind, queue in kinds.items() if kind in (None, work_kind))
+                if depth:
+                    counts[device] = depth
+            return counts
+
+    def running_counts(self, kind=None):
+        """Return the number of running works per device, of the given kind or of all the kinds."""
+        with self._cond:
+            counts = {}
+            for (device, work_kind), count in self._running.items():
+                if kind in (None, work_kind):
+                    counts[device] = counts.get(device, 0) + count
+            return counts
+
+    def shutdown(self, wait=True):
+        """Stop the workers after the queued work is completed."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _next_work(self):
+        """Return the next runnable work, or None and whether some work has been held back by the admission."""
+        held = False
+        for device in list(self._queues):
+            kinds = self._queues[device]
+            for kind in list(kinds):
+                key = (device, kind)
+                if self._running.get(key, 0) >= self._limits.get(key, self._max_workers):
+                    continue
+
+                # Work cancelled while queued (e.g. by a batch timeout) is dropped before taking any admission
+                queue = kinds[kind]
+                while queue and queue[0][0].cancelled():
+                    queue.popleft()
+                if not queue:
+                    del kinds[kind]
+                    continue
+
+                if self._admission is not None and not self._admission.try_acquire(kind):
+                    held = True
+                    continue
+
+                work = queue.popleft()
+
+                # Move the served device and kind to the end of the round-robin
+                if queue:
+                    kinds.move_to_end(kind)
+                else:
+                    del kinds[kind]
+
+                if kinds:
+                    self._queues.move_to_end(device)
+                else:
+                    del self._queues[device]
+
+                self._running[key] = self._running.get(key, 0) + 1
+                return (key, work), held
+
+            if not kinds:
+                del self._queues[device]
+
+        return None, held
+
+    def _work(self):
+        while True:
+            with self._cond:
+                next_work, held = self._next_work()
+                while next_work is None:
+                    if self._shutdown and not self._queues:
+                        return
+
+                    # Work held back for missing tokens can be admitted later, without notifications
+                    self._idle_workers += 1
+                    self._cond.wait(self._admission.retry_delay() if held else None)
+                    self._idle_workers -= 1
+
+                    next_work, held = self._next_work()
+
+            key, (future, fn, args) = next_work
+
+            start = time.monotonic()
+            failed = False
+            run = future.set_running_or_notify_cancel()
+            if run:
+                try:
+                    result = fn(*args)
+                except BaseException as ex:
+                    failed = True
+                    future.set_exception(ex)
+                else:
+                    future.set_result(result)
+
+            if self._admission is not None:
+                if run:
+                    self._admission.release(key[1], time.monotonic() - start, failed)
+                else:
+                    self._admission.cancel(key[1])
+
+            with self._cond:
+                self._running[key] -= 1
+                if self._running[key] == 0:
+                    del self._running[key]
+
+                # Work of a limited device kind may be runnable now
+                self._cond.notify_all()
+
+
+class DeviceExecutor:
+    """View of a FairExecutor for a single device and kind of work, with the submit interface of an executor."""
+
+    def __init__(self, executor, device, kind, max_running=None):
+        self._executor = executor
+        self._device = device
+        self._kind = kind
+
+        if max_running is not None:
+            executor.set_limit(device, kind, max_running)
+
+    def submit(self, fn, *args):
+        return self._executor.submit(self._device, self._kind, fn, *args)
+
+    def shutdown(self):
+        """Cancel the queued work: the shared workers are stopped with the integration."""
+        self._executor.cancel_pending(self._device, self._kind)
+
+
+class WorkScheduler:
+    """The integration executors: one for the update works, one for the user commands, one for the works they
+    both wait for (pulls), and one for the local writes behind them (store).
+
+    The response to a user command is handled by the command worker, and it can wait for pulls too (e.g. a
+    GetMapSet sent as a custom command): commands never share the workers of the pulls.
+
+    All the background requests share a token bucket, as the cloud throttles the whole account. Pulls, which
+    fan out, also share an adaptive concurrency limit. User commands are never held back.
+    """
+
+    def __init__(self, update_workers, pull_workers, cloud_rate):
+        self.cloud_bucket = TokenBucket(cloud_rate, 2 * cloud_rate)
+        self.cloud_concurrency = AdaptiveConcurrency(INITIAL_CONCURRENCY, 1, pull_workers)
+
+        self.updates = FairExecutor(update_workers, 'ecovac_ext_updates',
+            CloudAdmission(self.cloud_bucket, (WORK_UPDATES,)))
+        # Commands run one at a time per device, so they need as many workers as the updates at most
+        self.commands = FairExecutor(update_workers, 'ecovac_ext_commands')
+        self.pulls = FairExecutor(pull_workers, 'ecovac_ext_pulls',
+            CloudAdmission(self.cloud_bucket, (WORK_PULL, WORK_TRACE), self.cloud_concurrency))
+        self.store = FairExecutor(STORE_WORKERS, 'ecovac_ext_store')
+
+    def get_queue_metrics(self):
+        """Return the queued and running works per executor and device."""
+        return {
+            'updates': {
+                'queued': self.updates.queue_depths(),
+                'running': self.updates.running_counts(),
+            },
+            'commands': {
+                'queued': self.commands.queue_depths(),
+                'running': self.commands.running_counts(),
+            },
+            'pulls': {
+                'queued': self.pulls.queue_depths(),
+                'running': self.pulls.running_counts(),
+            },
+            'store': {
+                'queued': self.store.queue_depths(),
+                'running': self.store.running_counts(),
+            },
+            'cloud': self.get_cloud_metrics(),
+        }
+
+    def get_cloud_metrics(self):
+        """Return the state of the account wide pacing."""
+        baseline = self.cloud_concurrency.baseline
+        return {
+            'rate': self.cloud_bucket.rate,
+            'tokens': round(self.cloud_bucket.tokens, 2),
+            'concurrency_limit': round(self.cloud_concurrency.limit, 2),
+            'in_flight': self.cloud_concurrency.in_flight,
+            'latency_baseline': round(baseline, 3) if baseline is not None else None,
+        }
+
+    def get_device_queue_metrics(self, device):
+        """Return the queued and running works of a single device."""
+        return {
+            'updates_queued': self.updates.queue_depths().get(device, 0),
+            'updates_running': self.updates.running_counts().get(device, 0),
+            'commands_queued': self.commands.queue_depths().get(device, 0),
+            'commands_running': self.commands.running_counts().get(device, 0),
+            'pulls_queued': self.pulls.queue_depths().get(device, 0),
+            'pulls_running': self.pulls.running_counts().get(device, 0),
+        }
+
+    def shutdown(self):
+        self.updates.shutdown(wait=False)
+        self.commands.shutdown(wait=False)
+        self.pulls.shutdown(wait=False)
+        self.store.shutdown(wait=False)
@@ -0,0 +1,131 @@
+"""Diagnostic sensors of the Ecovacs devices: cloud latency, map work timings and queues."""
+import logging
+
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.entity import Entity
+
+from . import ECOVACS_DEVICES, SIGNAL_ECOVACS_DEVICE_READY
+from .stats import get_device_stats, TIMING_RASTERIZE, TIMING_PNG_ENCODE, GAUGE_TRACE_LENGTH, GAUGE_PULLS_IN_FLIGHT,\
+    GAUGE_PIECE_CACHE_HITS, GAUGE_PIECE_CACHE_MISSES
+
+_LOGGER = logging.getLogger(__name__)
+
+UNIT_MILLISECONDS = "ms"
+UNIT_PERCENTAGE = "%"
+
+
+def _to_ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    """Set up the Ecovacs diagnostic sensors."""
+    sensors = []
+    for device in hass.data[ECOVACS_DEVICES]:
+        sensors.extend(create_device_sensors(hass, device))
+
+    _LOGGER.debug("Adding Ecovacs diagnostic sensors to Hass: %s", sensors)
+    async_add_entities(sensors, True)
+
+    @callback
+    def async_add_ready_device(device):
+        """Add the sensors of a device connected after the platform setup."""
+        async_add_entities(create_device_sensors(hass, device), True)
+
+    async_dispatcher_connect(hass, SIGNAL_ECOVACS_DEVICE_READY, async_add_ready_device)
+
+
+def create_device_sensors(hass, device):
+    stats = get_device_stats(hass, device.vacuum['did'])
+    return [
+        CloudLatencySensor(device, stats),
+        PieceCacheHitRateSensor(device, stats),
+        TimingSensor(device, stats, TIMING_RASTERIZE, "Rasterize Time"),
+        TimingSensor(device, stats, TIMING_PNG_ENCODE, "PNG Encode Time"),
+        GaugeSensor(device, stats, GAUGE_TRACE_LENGTH, "Trace Length", "points"),
+        GaugeSensor(device, stats, GAUGE_PULLS_IN_FLIGHT, "Pulls In Flight", "requests"),
+    ]
+
+
+class EcovacsStatsSensor(Entity):
+    """A polled metric of an Ecovacs device."""
+
+    def __init__(self, device, stats, key, name, unit=None):
+        self._device = device
+        self._stats = stats
+        self._key = key
+        self._unit = unit
+        self._state = None
+
+        nick = device.vacuum.get('nick', None) or device.vacuum['did']
+        self._name = "{} {}".format(nick, name)
+
+    @property
+    def unique_id(self) -> str:
+        """Return an unique ID."""
+        return "{}_{}".format(self._device.vacuum['did'], self._key)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def icon(self):
+        return "mdi:chart-bell-curve"
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def unit_of_measurement(self):
+        return self._unit
+
+
+class CloudLatencySensor(EcovacsStatsSensor):
+    """95th percentile of the cloud round trip time of the commands, with the one of each command as attributes."""
+
+    def __init__(self, device, stats):
+        super().__init__(device, stats, "cloud_latency_p95", "Cloud Latency", UNIT_MILLISECONDS)
+        self._attributes = {}
+
+    @property
+    def device_state_attributes(self):
+        return self._attributes
+
+    def update(self):
+        self._state = _to_ms(self._stats.get_command_quantile(0.95))
+        self._attributes = {
+            name: _to_ms(self._stats.get_command_quantile(0.95, name)) for name in self._stats.get_command_names()}
+
+
+class PieceCacheHitRateSensor(EcovacsStatsSensor):
+    """Share of the map pieces loaded from the local cache (memory or disk) instead of the cloud."""
+
+    def __init__(self, device, stats):
+        super().__init__(device, stats, "piece_cache_hit_rate", "Map Piece Cache Hit Rate", UNIT_PERCENTAGE)
+
+    def update(self):
+        hits = self._stats.get_gauge(GAUGE_PIECE_CACHE_HITS) or 0
+        misses = self._stats.get_gauge(GAUGE_PIECE_CACHE_MISSES) or 0
+
+        self._state = round(100 * hits / (hits + misses), 1) if (hits + misses) else None
+
+
+class TimingSensor(EcovacsStatsSensor):
+    """95th percentile of the duration of some map work."""
+
+    def __init__(self, device, stats, timing, name):
+        super().__init__(device, stats, "{}_p95".format(timing), name, UNIT_MILLISECONDS)
+        self._timing = timing
+
+    def update(self):
+        self._state = _to_ms(self._stats.get_timing_quantile(self._timing, 0.95))
+
+
+class GaugeSensor(EcovacsStatsSensor):
+    """Current value of a gauge of the device."""
+
+    def update(self):
+        self._state = self._stats.get_gauge(self._key)
@@ -0,0 +1,74 @@
+"""Persisted snapshot of the map data of a device, to show the map right after a restart."""
+import base64
+import zlib
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import Store
+
+from . import DOMAIN
+
+SNAPSHOT_VERSION = 1
+
+# Max delay between a change and its snapshot write (pending writes are also flushed at shutdown)
+SNAPSHOT_SAVE_DELAY = 60
+
+
+def encode_snapshot_bytes(data, compress=False):
+    """Encode bytes as a JSON string, optionally compressed."""
+    if compress:
+        data = zlib.compress(data)
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_snapshot_bytes(data, compress=False):
+    data = base64.b64decode(data)
+    if compress:
+        data = zlib.decompress(data)
+    return data
+
+
+class MapSnapshotStore:
+    """HA storage of the snapshot of a single device.
+
+    Changes schedule a delayed write, which is not postponed by further changes: while the device is cleaning
+    the snapshot is written at most once per save delay. The snapshot data is collected only when written, in
+    an executor thread (it encodes the whole map), and pending writes are flushed when HA stops.
+    """
+
+    def __init__(self, hass, device_id):
+        self._hass = hass
+        self._store = Store(hass, SNAPSHOT_VERSION, '%s.snapshot.%s' % (DOMAIN, device_id))
+
+        self._data_func = None
+        self._unsub_save = None
+        self._unsub_stop = None
+
+    async def async_load(self):
+        """Return the stored snapshot, or None."""
+        return await self._store.async_load()
+
+    @callback
+    def async_schedule_save(self, data_func):
+        """Schedule a write of the data returned by data_func (called in an executor thread)."""
+        self._data_func = data_func
+        if self._unsub_save is not None:
+            return
+
+        self._unsub_save = async_call_later(self._hass, SNAPSHOT_SAVE_DELAY, self._async_save)
+        if self._unsub_stop is None:
+            self._unsub_stop = self._hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self._async_save_on_stop)
+
+    async def _async_save(self, _now=None):
+        self._unsub_save = None
+
+        data = await self._hass.async_add_executor_job(self._data_func)
+        await self._store.async_save(data)
+
+    async def _async_save_on_stop(self, _event):
+        self._unsub_stop = None
+
+        if self._unsub_save is not None:
+            self._unsub_save()
+            await self._async_save()
@@ -0,0 +1,161 @@
+"""Per device metrics of the integration: cloud command latencies, timings of the map work and gauges."""
+import bisect
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from . import ECOVACS_STATS
+
+_LOGGER = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the histogram buckets, from fast local work to slow cloud round trips
+HISTOGRAM_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Timed local work
+TIMING_DECOMPRESS = 'decompress'
+TIMING_RASTERIZE = 'rasterize'
+TIMING_PNG_ENCODE = 'png_encode'
+TIMING_SVG = 'svg'
+
+# Gauges, read when the metrics are requested
+GAUGE_TRACE_LENGTH = 'trace_length'
+GAUGE_PULLS_IN_FLIGHT = 'pulls_in_flight'
+GAUGE_PULLS_QUEUED = 'pulls_queued'
+GAUGE_MAP_PIECES_PENDING = 'map_pieces_pending'
+GAUGE_PIECE_CACHE_HITS = 'piece_cache_hits'
+GAUGE_PIECE_CACHE_MISSES = 'piece_cache_misses'
+GAUGE_EVENTS = 'events'
+
+
+class Histogram:
+    """Counts of the observed values per bucket, with their sum and max."""
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self._bounds = bounds
+        self._buckets = [0] * (len(bounds) + 1)
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self._buckets[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket of the q-quantile (the max, for the last bucket)."""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for idx, bucket in enumerate(self._buckets):
+            seen += bucket
+            if seen >= rank and bucket:
+                return min(self._bounds[idx], self.max) if idx < len(self._bounds) else self.max
+
+        return self.max
+
+    def as_dict(self):
+        buckets = {str(bound): count for bound, count in zip(self._bounds, self._buckets)}
+        buckets['+inf'] = self._buckets[-1]
+        return {
+            'count': self.count,
+            'avg': (self.total / self.count) if self.count else None,
+            'max': self.max if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': buckets,
+        }
+
+
+class DeviceStats:
+    """Metrics of a device, shared by its entities and updated from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # Command name -> round trip time histogram, and the histogram of all the commands
+        self._commands = {}
+        self._all_commands = Histogram()
+
+        # Timed work name -> duration histogram
+        self._timings = {}
+
+        # Gauge name -> function returning its current value
+        self._gauges = {}
+
+    def observe_command(self, name, seconds):
+        with self._lock:
+            histogram = self._commands.get(name)
+            if histogram is None:
+                histogram = self._commands[name] = Histogram()
+            histogram.observe(seconds)
+            self._all_commands.observe(seconds)
+
+    def observe_timing(self, name, seconds):
+        with self._lock:
+            histogram = self._timings.get(name)
+            if histogram is None:
+                histogram = self._timings[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timing(self, name):
+        """Context manager timing the work in its block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_timing(name, time.perf_counter() - start)
+
+    def set_gauge(self, name, value_func):
+        self._gauges[name] = value_func
+
+    def get_command_names(self):
+        """Return the names of the timed commands."""
+        with self._lock:
+            return list(self._commands)
+
+    def get_command_quantile(self, q, name=None):
+        """Return the q-quantile of the round trip time of the given command, or of all the commands."""
+        with self._lock:
+            histogram = self._all_commands if name is None else self._commands.get(name)
+            return histogram.quantile(q) if histogram is not None else None
+
+    def get_timing_quantile(self, name, q):
+        with self._lock:
+            histogram = self._timings.get(name)
+            return histogram.quantile(q) if histogram is not None else None
+
+    def get_gauge(self, name):
+        """Return the current value of a gauge, or None if not available."""
+        value_func = self._gauges.get(name)
+        if value_func is None:
+            return None
+
+        try:
+            return value_func()
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.debug('Unable to read gauge %s', name, exc_info=True)
+            return None
+
+    def as_dict(self):
+        with self._lock:
+            result = {
+                'commands': {name: histogram.as_dict() for name, histogram in self._commands.items()},
+                'all_commands': self._all_commands.as_dict(),
+                'timings': {name: histogram.as_dict() for name, histogram in self._timings.items()},
+            }
+
+        result['gauges'] = {name: self.get_gauge(name) for name in list(self._gauges)}
+        return result
+
+
+def get_device_stats(hass, device_id):
+    """Return the metrics of a device, created on first use."""
+    return hass.data[ECOVACS_STATS].setdefault(device_id, DeviceStats())
@@ -0,0 +1,177 @@
+"""Account wide pacing of the cloud requests, adapting to the latency and errors observed."""
+import logging
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Initial concurrency of the adaptive requests, probed up to the max as long as the cloud keeps up
+INITIAL_CONCURRENCY = 2
+
+# A request slower than its baseline by both this factor and this slack (seconds) signals congestion
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.5
+
+# The latency baseline is the fastest request of the last window, so it can also grow (e.g. slower network)
+LATENCY_BASELINE_WINDOW = 60
+
+# Shortest and longest wait of a worker for held work to be admitted
+MIN_RETRY_DELAY = 0.01
+HELD_RECHECK_DELAY = 1
+
+
+class TokenBucket:
+    """Classic token bucket: requests take a token, refilled at a fixed rate up to the burst size."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._timestamp = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._timestamp) * self.rate)
+        self._timestamp = now
+
+    def try_take(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
+
+    def delay(self):
+        """Return the time until the next token is available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0, (1 - self._tokens) / self.rate)
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class AdaptiveConcurrency:
+    """AIMD limit of the requests in flight.
+
+    Every request completed in time raises the limit by 1/limit (about +1 per round of requests), while errors
+    and requests much slower than the latency baseline halve it, at most once per baseline latency.
+    """
+
+    def __init__(self, initial_limit, min_limit, max_limit):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+
+        self._lock = threading.Lock()
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+
+        self._baseline = None
+        self._window_min = None
+        self._window_timestamp = time.monotonic()
+        self._decrease_timestamp = 0
+
+    def try_acquire(self):
+        with self._lock:
+            if self._in_flight >= int(self._limit):
+                return False
+
+            self._in_flight += 1
+            return True
+
+    def cancel(self):
+        """Release a slot without completing a request."""
+        with self._lock:
+            self._in_flight -= 1
+
+    def release(self, latency, failed):
+        with self._lock:
+            self._in_flight -= 1
+
+            now = time.monotonic()
+            if now - self._window_timestamp >= LATENCY_BASELINE_WINDOW:
+                self._baseline = self._window_min
+                self._window_min = None
+                self._window_timestamp = now
+
+            if not failed:
+                if self._window_min is None or latency < self._window_min:
+                    self._window_min = latency
+                if self._baseline is None or latency < self._baseline:
+                    self._baseline = latency
+
+            baseline = self._baseline if self._baseline is not None else latency
+            congested = failed or (latency > baseline * LATENCY_TOLERANCE and latency > baseline + LATENCY_SLACK)
+
+            if congested:
+                if now - self._decrease_timestamp >= baseline:
+                    self._decrease_timestamp = now
+                    self._limit = max(self.min_limit, self._limit / 2)
+                    _LOGGER.debug(
+                        'Cloud congestion (latency: %.2fs, baseline: %.2fs, failed: %s): concurrency limit %.1f',
+                        latency, baseline, failed, self._limit)
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def baseline(self):
+        return self._baseline
+
+
+class CloudAdmission:
+    """Admission of the work of a FairExecutor: work of the paced kinds waits for a token of the shared bucket
+    and, if an adaptive concurrency is given, for a free slot. Other kinds of work are admitted right away.
+    """
+
+    def __init__(self, bucket, kinds, concurrency=None):
+        self._bucket = bucket
+        self._kinds = frozenset(kinds)
+        self._concurrency = concurrency
+
+    def try_acquire(self, kind):
+        if kind not in self._kinds:
+            return True
+
+        if self._concurrency is not None and not self._concurrency.try_acquire():
+            return False
+
+        if not self._bucket.try_take():
+            if self._concurrency is not None:
+                self._concurrency.cancel()
+            return False
+
+        return True
+
+    def release(self, kind, latency, failed):
+        if kind in self._kinds and self._concurrency is not None:
+            self._concurrency.release(latency, failed)
+
+    def cancel(self, kind):
+        """Release admitted work that has not been run (cancelled meanwhile)."""
+        if kind in self._kinds and self._concurrency is not None:
+            self._concurrency.cancel()
+
+    def retry_delay(self):
+        """Return the time to wait before trying again to admit held work.
+
+        Work held for missing tokens is retried as soon as a token is available. Work held by the concurrency
+        limit is retried when some work completes, with a periodic check against missed notifications.
+        """
+        delay = self._bucket.delay()
+        if delay > 0:
+            return max(MIN_RETRY_DELAY, delay)
+        return HELD_RECHECK_DELAY
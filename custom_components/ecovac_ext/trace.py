@@ -0,0 +1,262 @@
+"""Compact storage of the cleaning trace points."""
+from array import array
+from collections import OrderedDict
+import sys
+import threading
+
+# Trace records are 5 bytes: y (int16 LE), x (int16 LE), flags (bit 7: not connected, bit 0: type)
+TRACE_RECORD_SIZE = 5
+
+# Max number of points requested to the device with a single command
+TRACE_CHUNK_SIZE = 200
+
+_TRACE_FLAG_NOT_CONNECTED = 0x80
+_TRACE_FLAG_TYPE = 0x01
+
+# Max number of points checked against a simplified segment: longer segments are split
+_MAX_SIMPLIFIED_SEGMENT_POINTS = 32
+
+# Max number of tolerances (levels of detail) kept up to date at the same time
+_MAX_SIMPLIFIED_LEVELS = 4
+
+
+def _unpack_int16_column(data, offset):
+    """Extract a little-endian int16 column from packed trace records, without per-record Python code."""
+    column_bytes = bytearray(2 * (len(data) // TRACE_RECORD_SIZE))
+    column_bytes[0::2] = data[offset::TRACE_RECORD_SIZE]
+    column_bytes[1::2] = data[offset + 1::TRACE_RECORD_SIZE]
+
+    column = array('h')
+    column.frombytes(bytes(column_bytes))
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+class _TraceSimplifier:
+    """Incremental simplification of a trace for a single tolerance.
+
+    Points are processed once, as they are appended: a point is dropped when all the points since the last
+    kept one lie within the tolerance from the segment joining the kept point to the newest one. Moves and
+    changes of type are always kept. The newest point (tail) is always part of the result, but it may be
+    replaced by the next one: only the kept indices are stable.
+    """
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self._sq_tolerance = tolerance * tolerance
+
+        self.indices = array('I')
+        self.tail = None
+        self._cursor = 0
+
+    def update(self, x, y, flags):
+        """Process the points appended since the last update."""
+        count = len(flags)
+        for idx in range(self._cursor, count):
+            self._add(idx, x, y, flags)
+        self._cursor = count
+
+    def _add(self, idx, x, y, flags):
+        tail = self.tail
+        self.tail = idx
+
+        if tail is None:
+            return
+
+        indices = self.indices
+        if ((not indices)
+                or (flags[idx] & _TRACE_FLAG_NOT_CONNECTED)
+                or (flags[tail] & _TRACE_FLAG_NOT_CONNECTED)
+                or ((flags[idx] ^ flags[tail]) & _TRACE_FLAG_TYPE)
+                or (idx - indices[-1] > _MAX_SIMPLIFIED_SEGMENT_POINTS)):
+            indices.append(tail)
+            return
+
+        anchor = indices[-1]
+        ax = x[anchor]
+        ay = y[anchor]
+        dx = x[idx] - ax
+        dy = y[idx] - ay
+        length = dx * dx + dy * dy
+        sq_tolerance = self._sq_tolerance
+
+        # Squared distance of each point from the segment anchor-idx, inlined as this is the hot loop
+        for mid in range(anchor + 1, idx):
+            px = x[mid] - ax
+            py = y[mid] - ay
+            t = (px * dx + py * dy) / length if length != 0 else 0
+            if t > 1:
+                px -= dx
+                py -= dy
+            elif t > 0:
+                px -= t * dx
+                py -= t * dy
+            if px * px + py * py > sq_tolerance:
+                indices.append(tail)
+                return
+
+    def snapshot(self):
+        """Return the simplified indices (tail included) and the number of the stable ones."""
+        indices = list(self.indices)
+        stable_count = len(indices)
+        if self.tail is not None:
+            indices.append(self.tail)
+        return indices, stable_count
+
+
+class TraceStore:
+    """Trace points held in packed columns (x, y, flags) instead of one dict per point.
+
+    The raw records are kept too, to allow sending them as they are received from the device.
+    """
+
+    def __init__(self):
+        self._records = bytearray()
+        self._x = array('h')
+        self._y = array('h')
+        self._flags = bytearray()
+
+        self._simplifiers_lock = threading.Lock()
+        self._simplifiers = OrderedDict()
+
+    def __len__(self):
+        return len(self._flags)
+
+    def __iter__(self):
+        return self.points()
+
+    def append_records(self, trace_data):
+        """Append packed trace records, ignoring malformed data."""
+        if (len(trace_data) == 0) or (len(trace_data) % TRACE_RECORD_SIZE != 0):
+            return
+
+        trace_data = bytes(trace_data)
+
+        self._y.extend(_unpack_int16_column(trace_data, 0))
+        self._x.extend(_unpack_int16_column(trace_data, 2))
+        self._flags.extend(trace_data[4::TRACE_RECORD_SIZE])
+        self._records.extend(trace_data)
+
+    def points(self, start=0, indices=None):
+        """Iterate the points from the given index as dicts, as they were stored before.
+
+        If indices (as returned by simplify) are given, only those points are iterated, starting from the
+        given position in indices.
+        """
+        x = self._x
+        y = self._y
+        flags = self._flags
+        if indices is None:
+            indices = range(len(flags))
+        for idx in indices[start:]:
+            data = flags[idx]
+            yield {
+                'y': y[idx],
+                'x': x[idx],
+                'connected': not (((data >> 7) & 1) != 0),
+                'type': data & 1,
+            }
+
+    def to_list(self, start=0, indices=None):
+        return list(self.points(start, indices))
+
+    def records(self, start=0, indices=None):
+        """Return the raw packed records from the given index, as received from the device."""
+        if indices is None:
+            return bytes(self._records[start * TRACE_RECORD_SIZE:])
+
+        records = self._records
+        return b''.join(
+            records[idx * TRACE_RECORD_SIZE:(idx + 1) * TRACE_RECORD_SIZE] for idx in indices[start:])
+
+    def simplify(self, tolerance):
+        """Return the indices of the trace simplified with the given tolerance (in trace units), and how many
+        of them are stable, i.e. will not change when new points are appended.
+
+        Each tolerance is a level of detail kept up to date incrementally, so repeated calls only process the
+        points appended in between.
+        """
+        with self._simplifiers_lock:
+            simplifier = self._simplifiers.get(tolerance)
+            if simplifier is None:
+                simplifier = _TraceSimplifier(tolerance)
+                self._simplifiers[tolerance] = simplifier
+                while len(self._simplifiers) > _MAX_SIMPLIFIED_LEVELS:
+                    self._simplifiers.popitem(last=False)
+            else:
+                self._simplifiers.move_to_end(tolerance)
+
+            simplifier.update(self._x, self._y, self._flags)
+            return simplifier.snapshot()
+
+
+class TraceChunkAssembler:
+    """Tracks the index ranges of a trace being fetched, and appends the received chunks to the trace store in
+    index order, whatever the order they are received in.
+
+    Ranges are (first, last) indexes, both included, as requested to the device.
+    """
+
+    def __init__(self, trace_id, store):
+        self.trace_id = trace_id
+        self.store = store
+
+        self._lock = threading.Lock()
+
+        self._in_flight = set()
+
+        # Chunks received ahead of the stored points: first index -> (last index, records)
+        self._received = {}
+
+    def claim_missing_ranges(self, end):
+        """Return the ranges before the end index (excluded) that are neither stored, received nor in flight,
+        split in chunks of at most TRACE_CHUNK_SIZE points. The returned ranges are marked as in flight."""
+        with self._lock:
+            covered = sorted(self._in_flight | set((first, last) for first, (last, _) in self._received.items()))
+
+            ranges = []
+            idx = len(self.store)
+            for first, last in covered + [(end, end)]:
+                gap_end = min(first, end)
+                while idx < gap_end:
+                    chunk_last = min(gap_end, idx + TRACE_CHUNK_SIZE) - 1
+                    ranges.append((idx, chunk_last))
+                    idx = chunk_last + 1
+
+                idx = max(idx, last + 1)
+                if idx >= end:
+                    break
+
+            self._in_flight.update(ranges)
+            return ranges
+
+    def release(self, chunk_range):
+        """Mark a range as no longer in flight, either received or failed."""
+        with self._lock:
+            self._in_flight.discard(chunk_range)
+
+    def add_chunk(self, first, records):
+        """Add the records of a chunk starting at the given index, ignoring malformed data.
+
+        The chunk is kept aside until all the points before it are stored.
+        """
+        if (len(records) == 0) or (len(records) % TRACE_RECORD_SIZE != 0):
+            return
+
+        with self._lock:
+            last = first + len(records) // TRACE_RECORD_SIZE - 1
+            previous = self._received.get(first)
+            if (previous is None) or (previous[0] < last):
+                self._received[first] = (last, bytes(records))
+
+            while self._received:
+                count = len(self.store)
+                first = min(self._received)
+                if first > count:
+                    break
+
+                last, records = self._received.pop(first)
+                if last >= count:
+                    # Skip the points already stored by overlapping chunks
+                    self.store.append_records(records[(count - first) * TRACE_RECORD_SIZE:])
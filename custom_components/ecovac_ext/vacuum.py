@@ -4,31 +4,36 @@ import time
 import voluptuous as vol
 import homeassistant.helpers.config_validation as cv
 import base64
-import struct
-import lzma
-import os
 import zlib
 from ozmo import VacBotCommand
 import ast
 import re
-from threading import local
-import concurrent.futures
+import threading
 import asyncio
-import stringcase
 import xml.etree.cElementTree as ET
-import tempfile
 import types
 from datetime import datetime
 from _datetime import timedelta
-from PIL import Image
 
 from homeassistant.components.vacuum import (
     SUPPORT_FAN_SPEED,
     STATE_CLEANING, STATE_RETURNING, STATE_DOCKED, STATE_ERROR,
     StateVacuumEntity)
 from homeassistant.helpers.icon import icon_for_battery_level
-
-from . import ECOVACS_DEVICES, CONF_SUPPORTED_FEATURES, ECOVACS_CONFIG
+from homeassistant.helpers.storage import STORAGE_DIR
+
+from . import DOMAIN, ECOVACS_DEVICES, CONF_SUPPORTED_FEATURES, CONF_TRACE_FETCH_WINDOW, ECOVACS_CONFIG, ECOVACS_OFFLOAD, ECOVACS_SCHEDULER, SIGNAL_ECOVACS_DEVICE_READY
+from .codec import decompress_7z_base64_data
+from .map_engine import MapCanvas, MapEncodeCache, rasterize_map_piece_data
+from .piece_store import MapPieceCache, MapPieceStore, remove_legacy_temp_directories
+from .snapshot import MapSnapshotStore, encode_snapshot_bytes, decode_snapshot_bytes
+from .commands import CommandError, DeviceCommands, set_command_failed, set_command_responded, async_wait_command_futures, wait_command_futures
+from .events import EventCounters, element_to_dict, find_mqtt_td, get_command_event_name, get_event_handlers, get_event_name, get_ozmo_api_event_name, to_ozmo_api_dict, to_ozmo_mqtt_dict
+from .scheduler import DeviceExecutor, WORK_COMMAND, WORK_UPDATES, WORK_PULL, WORK_TRACE, WORK_STORE
+from .refresh import RefreshPolicy, get_activity, RESOURCE_MAP, RESOURCE_TRACE, RESOURCE_POS, RESOURCE_CHARGER_POS, RESOURCE_MAP_SET
+from .stats import get_device_stats, TIMING_DECOMPRESS, TIMING_RASTERIZE, TIMING_PNG_ENCODE, GAUGE_TRACE_LENGTH,\
+    GAUGE_PULLS_IN_FLIGHT, GAUGE_PULLS_QUEUED, GAUGE_MAP_PIECES_PENDING, GAUGE_PIECE_CACHE_HITS, GAUGE_PIECE_CACHE_MISSES, GAUGE_EVENTS
+from .trace import TraceChunkAssembler, TraceStore, TRACE_RECORD_SIZE
 from homeassistant.const import STATE_IDLE, STATE_PAUSED, STATE_UNAVAILABLE,\
     EVENT_HOMEASSISTANT_STOP
 
@@ -41,6 +46,8 @@ from ozmo import (
     VacBot)
 from homeassistant.helpers.event import async_track_time_interval
 from homeassistant.helpers import entity_platform
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.core import callback
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -60,7 +67,11 @@ STATE_CODE_TO_STATE = {
     'pause': STATE_PAUSED,
 }
 
-UPDATE_INTERVAL = 60 * 5
+# Min interval between map update notifications while a map is being pulled
+MAP_PARTIAL_UPDATE_INTERVAL = 1
+
+# Max number of changed map tiles sent as patches instead of a full map
+MAP_PATCHES_MAX = 16
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the Ecovacs vacuums."""
@@ -71,6 +82,14 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     _LOGGER.debug("Adding Ecovacs Deebot Vacuums to Hass: %s", vacuums)
     async_add_entities(vacuums, True)
     
+    @callback
+    def async_add_ready_device(device):
+        """Add the vacuum of a device connected after the platform setup."""
+        _LOGGER.debug("Adding Ecovacs Deebot Vacuum to Hass: %s", device.vacuum['did'])
+        async_add_entities([LiveMapEcovacsDeebotVacuum(hass, device, hass.data[ECOVACS_CONFIG][0])], True)
+    
+    async_dispatcher_connect(hass, SIGNAL_ECOVACS_DEVICE_READY, async_add_ready_device)
+    
     ## Register custom service for named zone cleaning
     platform = entity_platform.current_platform.get()
     
@@ -103,6 +122,12 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         self._fan_speed = 'normal'
         self._error = None
         self._supported_features = config[CONF_SUPPORTED_FEATURES]
+        
+        self._stats = get_device_stats(hass, device.vacuum['did'])
+        
+        # Commands run in order on the integration workers, never holding an HA executor thread
+        self._commands = DeviceCommands(device, DeviceExecutor(
+            hass.data[ECOVACS_SCHEDULER].commands, device.vacuum['did'], WORK_COMMAND, 1), stats=self._stats)
         _LOGGER.debug("Vacuum initialized: %s with features: %d", self.name, self._supported_features)
 
     async def async_added_to_hass(self) -> None:
@@ -195,7 +220,7 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         """Set the vacuum cleaner to return to the dock."""
         from ozmo import Charge
 
-        self.hass.async_add_executor_job(self.device.run, Charge())
+        await self._commands.async_run(Charge())
 
     @property
     def battery_icon(self):
@@ -223,7 +248,7 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         """Set fan speed."""
         from ozmo import SetCleanSpeed
 
-        self.hass.async_add_executor_job(self.device.run, SetCleanSpeed(fan_speed))
+        await self._commands.async_run(SetCleanSpeed(fan_speed))
         self._fan_speed = fan_speed
         
         await self.async_update_ha_state()
@@ -240,7 +265,7 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         from ozmo import Clean
 
         self.clean_mode = 'auto'
-        self.hass.async_add_executor_job(self.device.run, Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
+        await self._commands.async_run(Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
 
     async def async_turn_off(self, **kwargs):
         """Turn the vacuum off stopping the cleaning and returning home."""
@@ -251,7 +276,7 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         """Stop the vacuum cleaner."""
         from ozmo import Clean
 
-        self.hass.async_add_executor_job(self.device.run, Clean(mode=self.clean_mode, speed=self.fan_speed, action='stop'))
+        await self._commands.async_run(Clean(mode=self.clean_mode, speed=self.fan_speed, action='stop'))
 
     async def async_start(self):
         """Start, pause or resume the cleaning task."""
@@ -264,13 +289,13 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         """Stop the vacuum cleaner."""
         from ozmo import Clean
 
-        self.hass.async_add_executor_job(self.device.run, Clean(mode=self.clean_mode, speed=self.fan_speed, action='pause'))
+        await self._commands.async_run(Clean(mode=self.clean_mode, speed=self.fan_speed, action='pause'))
 
     async def async_resume(self, **kwargs):
         """Stop the vacuum cleaner."""
         from ozmo import Clean
 
-        self.hass.async_add_executor_job(self.device.run, Clean(mode=self.clean_mode, speed=self.fan_speed, action='resume'))
+        await self._commands.async_run(Clean(mode=self.clean_mode, speed=self.fan_speed, action='resume'))
 
     async def async_start_pause(self, **kwargs):
         """Start, pause or resume the cleaning task."""
@@ -284,13 +309,13 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         from ozmo import Clean
 
         self.clean_mode = 'spot'
-        self.hass.async_add_executor_job(self.device.run, Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
+        await self._commands.async_run(Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
 
     async def async_locate(self, **kwargs):
         """Locate the vacuum cleaner."""
         from ozmo import PlaySound
 
-        self.hass.async_add_executor_job(self.device.run, PlaySound())
+        await self._commands.async_run(PlaySound())
 
     async def async_send_command(self, command, params=None, **kwargs):
         """Send a command to a vacuum cleaner."""
@@ -327,7 +352,7 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         from ozmo import Edge
 
         if command == 'clean_edge':
-            self.hass.async_add_executor_job(self.device.run, Edge())
+            await self._commands.async_run(Edge())
 
         if command == 'spot_area':
             if 'area' in params:
@@ -338,32 +363,32 @@ class EcovacsDeebotVacuum(StateVacuumEntity):
         if command == 'set_water_level':
             return await self.async_set_water_level(params['level'])
 
-        self.hass.async_add_executor_job(self.device.run, VacBotCommand(command, params))
+        await self._commands.async_run(VacBotCommand(command, params))
 
     async def async_clean_map(self, map_data, cleanings = '1'):
         from ozmo import Clean, SpotArea
 
         if not map_data:
             self.clean_mode = 'auto'
-            self.hass.async_add_executor_job(self.device.run, Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
+            await self._commands.async_run(Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
         else:
             self.clean_mode = 'spot_area'
-            self.hass.async_add_executor_job(self.device.run, SpotArea(map_position=map_data, speed=self.fan_speed, action='start', cleanings=cleanings))
+            await self._commands.async_run(SpotArea(map_position=map_data, speed=self.fan_speed, action='start', cleanings=cleanings))
 
     async def async_clean_area(self, area):
         from ozmo import Clean, SpotArea
 
         if not area:
             self.clean_mode = 'auto'
-            self.hass.async_add_executor_job(self.device.run, Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
+            await self._commands.async_run(Clean(mode=self.clean_mode, speed=self.fan_speed, action='start'))
         else:
             self.clean_mode = 'spot_area'
-            self.hass.async_add_executor_job(self.device.run, SpotArea(area=area, speed=self.fan_speed, action='start'))
+            await self._commands.async_run(SpotArea(area=area, speed=self.fan_speed, action='start'))
 
     async def async_set_water_level(self, level):
         from ozmo import SetWaterLevel
 
-        self.hass.async_add_executor_job(self.device.run, SetWaterLevel(level=level))
+        await self._commands.async_run(SetWaterLevel(level=level))
 
     @property
     def device_state_attributes(self):
@@ -387,7 +412,7 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         
         self.hass = hass
         
-        self._thread_local = local()
+        self._offload = hass.data[ECOVACS_OFFLOAD]
         
         self._device = device
         
@@ -398,17 +423,30 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         self._update_interval = 30
         self._update_lock = asyncio.Lock()
         
-        self.updates_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="ecovas_ext_updates")
-        self.pull_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="ecovas_ext_pull")
+        # Data is polled at rates depending on what the device is doing
+        self._refresh_policy = RefreshPolicy()
+        
+        # Device views of the integration executors: updates wait for pulls, so they never share the same workers
+        self._scheduler = hass.data[ECOVACS_SCHEDULER]
+        did = self._device.vacuum['did']
+        self.updates_executor = DeviceExecutor(self._scheduler.updates, did, WORK_UPDATES, 2)
+        self.pull_executor = DeviceExecutor(self._scheduler.pulls, did, WORK_PULL, 4)
+        self.trace_executor = DeviceExecutor(self._scheduler.pulls, did, WORK_TRACE, config[CONF_TRACE_FETCH_WINDOW])
         
         self._stopped = False
         
+        # Local and ozmo handlers of the received events, and the received events count
+        self._event_handlers = get_event_handlers(type(self))
+        self._ozmo_event_handlers = get_event_handlers(type(self._device))
+        self._event_counters = EventCounters()
+        
         self._map_info = None
         self._map_info_timestamp = None
         
         self._trace_info = None
         self._trace_info_timestamp = None
         self._trace_points = None
+        self._trace_chunks = None
         
         self._device_pos = None
         self._device_pos_timestamp = None
@@ -416,7 +454,13 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         self._charger_pos = None
         self._charger_pos_timestamp = None
 
-        self._map_image = None
+        self._map_canvas = None
+        self._map_background_cache = MapEncodeCache()
+        
+        # Map pieces being pulled for the current map update
+        self._map_pull_lock = threading.Lock()
+        self._map_pull_pending = None
+        self._map_partial_update_timestamp = None
         
         self._camera_image = b"<svg/>"
         self._camera_image_timestamp = None
@@ -435,7 +479,8 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
             'vw': None,
             'sa': None,
         }
-        self._current_map_set_type = None
+        # (map set type, map set id) -> elements being pulled
+        self._map_set_pulls = {}
         
         self._device_update_timestamp = None
 
@@ -445,60 +490,94 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
             # In case there is no nickname defined, use the device id
             self._name = '{}'.format(self._device.vacuum['did'])
           
+        self._map_pieces = MapPieceCache(
+            MapPieceStore(hass.config.path(STORAGE_DIR, DOMAIN, 'map_cache', self._device.vacuum['did'])),
+            DeviceExecutor(self._scheduler.store, did, WORK_STORE))
+        
+        self._snapshot_store = MapSnapshotStore(hass, self._device.vacuum['did'])
+        
+        # Current values reported with the metrics of the device
+        self._stats.set_gauge(GAUGE_TRACE_LENGTH, lambda: len(self._trace_points) if self._trace_points is not None else 0)
+        # Map piece pulls only: the traces share their executor
+        self._stats.set_gauge(GAUGE_PULLS_IN_FLIGHT, lambda: self._scheduler.pulls.running_counts(WORK_PULL).get(did, 0))
+        self._stats.set_gauge(GAUGE_PULLS_QUEUED, lambda: self._scheduler.pulls.queue_depths(WORK_PULL).get(did, 0))
+        self._stats.set_gauge(GAUGE_MAP_PIECES_PENDING, self.get_map_pieces_pending)
+        self._stats.set_gauge(GAUGE_PIECE_CACHE_HITS, lambda: self._map_pieces.hits)
+        self._stats.set_gauge(GAUGE_PIECE_CACHE_MISSES, lambda: self._map_pieces.misses)
+        self._stats.set_gauge(GAUGE_EVENTS, self.get_event_counts)
+    
+    def install_message_handlers(self):
+        """Handle the device messages with the local handlers (and parse them once for the ozmo ones)."""
         if not self._device.vacuum['iotmq']:
             self._device.xmpp.subscribe_to_ctls(self._handle_ctl)
         else:
-            # Patch api responses handling (disable base64 patching for local logic and implement children handling)
+            # Patch api responses handling (disable base64 patching for local logic and implement children handling).
+            # Messages are parsed once: only the ones with a local handler are parsed here, and shared with the 
+            # ozmo handler when it handles them too. The others are left to the ozmo handler.
             original_handle_ctl_api = self._device.iotmq._handle_ctl_api
             
-            def convert_to_dict(xml):
-                result = xml.attrib.copy()
+            def notify_ozmo(_self, ozmo_event, to_ozmo_dict, *args):
+                # VacBot subscribes its own handler: it is skipped for the events VacBot does not handle, but the
+                # other subscribers get all the events, as from the ozmo handler
+                subscribers = [subscriber for subscriber in _self.ctl_subscribers
+                    if (ozmo_event in self._ozmo_event_handlers) or (subscriber != self._device._handle_ctl)]
+                if (not subscribers):
+                    return
                 
-                children = list(xml)
-                if children:
-                    result["#children"] = []
-                    for child in list(xml):
-                        result["#children"].append(convert_to_dict(child))
-                        
-                return result
+                resp = to_ozmo_dict(*args)
+                for subscriber in subscribers:
+                    subscriber(resp)
                     
             def custom__handle_ctl_api(_self, action, message):
-                _LOGGER.debug("Handling message with custom logic: %s" , message)
-                # Invoke original handler
-                original_handle_ctl_api(action, message)
+                set_command_responded(action)
                 
-                # handle local commands:
-                if (not self._stopped) and (not message == {}):
-                    xml = ET.fromstring(message['resp'])
-                    resp = convert_to_dict(xml)
-                    resp['event'] = stringcase.snakecase(action.name.replace("Get","",1))
-                    
-                    self._handle_ctl(resp)
-                    
-
+                if (not message):
+                    # Failed or timed out request: let the command caller (and the cloud pacing) know
+                    if (not self._stopped):
+                        set_command_failed(action)
+                    return
+                
+                event = get_command_event_name(action.name)
+                if (self._stopped) or ('resp' not in message) or (event not in self._event_handlers):
+                    self._event_counters.count(event)
+                    original_handle_ctl_api(action, message)
+                    return
+                
+                _LOGGER.debug("Handling %s response with custom logic", event)
+                xml = ET.fromstring(message['resp'])
+                
+                notify_ozmo(_self, get_ozmo_api_event_name(action.name, xml), to_ozmo_api_dict, action.name, xml)
+                
+                resp = element_to_dict(xml)
+                resp['event'] = event
+                
+                # Correlate the response to its request
+                resp['#request'] = action.args
+                
+                self._handle_ctl(resp)
                     
             def custom__handle_ctl_mqtt(_self, client, userdata, message):
-                message_string = str(message.payload.decode("utf-8"))
-                _LOGGER.debug("Handling mqtt message with custom logic: %s" , message_string)
+                td = find_mqtt_td(message.payload)
+                event = get_event_name(td) if (td is not None) else None
+                if (self._stopped) or (event is None) or (event not in self._event_handlers):
+                    if (event is not None):
+                        self._event_counters.count(event)
+                    _self._handle_ctl_mqtt(client, userdata, message)
+                    return
                 
-                # Invoke original handler
-                _self._handle_ctl_mqtt(client, userdata, message)
+                _LOGGER.debug("Handling %s mqtt message with custom logic", event)
+                xml = ET.fromstring(message.payload)
                 
-                # handle local commands:
-                if (not self._stopped):
-                    xml = ET.fromstring(message_string)
-                    
-                    if ('td' in xml.attrib):
-                        resp = convert_to_dict(xml)
-                        resp['event'] = stringcase.snakecase(xml.attrib["td"])
-                        
-                        self._handle_ctl(resp)
+                notify_ozmo(_self, event, to_ozmo_mqtt_dict, xml)
+                
+                resp = element_to_dict(xml)
+                resp['event'] = event
+                
+                self._handle_ctl(resp)
             
             # Use a custom wrapper method to properly handle texts for local event handling for both API and MQTT.
             self._device.iotmq._handle_ctl_api = types.MethodType(custom__handle_ctl_api, self._device.iotmq)
             self._device.iotmq._on_message = types.MethodType(custom__handle_ctl_mqtt, self._device.iotmq)
-            
-        self._map_cache_directory_path = tempfile.mkdtemp(prefix='vacuum_ecovacs_map_cache_' + self._device.vacuum['did'])
     
     async def async_clean_zone(self, zone):
         """Set the Flo location to sleep mode."""
@@ -516,40 +595,55 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         """Check if some data needs to be updated."""
         async with self._update_lock:
             if not self._stopped:
+                refresh_policy = self._refresh_policy
+                now = time.time()
+                
                 update_futures = []
-                if self._map_info_timestamp is None or time.time() - self._map_info_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetMapM')))
+                if refresh_policy.is_due(RESOURCE_MAP, self._map_info_timestamp, now):
+                    refresh_policy.refreshing(RESOURCE_MAP)
+                    update_futures.append(self._commands.submit(VacBotCommand('GetMapM'), self.updates_executor))
                     
-                if self._trace_info_timestamp is None or time.time() - self._trace_info_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetTrM')))
+                if refresh_policy.is_due(RESOURCE_TRACE, self._trace_info_timestamp, now):
+                    refresh_policy.refreshing(RESOURCE_TRACE)
+                    update_futures.append(self._commands.submit(VacBotCommand('GetTrM'), self.updates_executor))
         
-                if self._device_pos_timestamp is None or time.time() - self._device_pos_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetPos')))
+                if refresh_policy.is_due(RESOURCE_POS, self._device_pos_timestamp, now):
+                    refresh_policy.refreshing(RESOURCE_POS)
+                    update_futures.append(self._commands.submit(VacBotCommand('GetPos'), self.updates_executor))
         
-                if self._charger_pos_timestamp is None or time.time() - self._charger_pos_timestamp >= UPDATE_INTERVAL:
-                    update_futures.append(self.updates_executor.submit(self._device.run, VacBotCommand('GetChargerPos')))
+                if refresh_policy.is_due(RESOURCE_CHARGER_POS, self._charger_pos_timestamp, now):
+                    refresh_policy.refreshing(RESOURCE_CHARGER_POS)
+                    update_futures.append(self._commands.submit(VacBotCommand('GetChargerPos'), self.updates_executor))
                 
                 map_sets_to_update = []
                 for map_set_type in self._map_set_info:
-                    if self._map_set_info_timestamp[map_set_type] is None or time.time() - self._map_set_info_timestamp[map_set_type] >= UPDATE_INTERVAL:
+                    if refresh_policy.is_due(RESOURCE_MAP_SET, self._map_set_info_timestamp[map_set_type], now):
                         map_sets_to_update.append(map_set_type)
+                refresh_policy.refreshing(RESOURCE_MAP_SET)
                 
-                if (map_sets_to_update):
-                    update_futures.append(self.updates_executor.submit(self.update_map_sets, map_sets_to_update))
+                # One request per type: map sets of different types are pulled concurrently
+                update_futures.extend(self.update_map_sets(map_sets_to_update))
                 
-                def job_wait_futures():
-                    for update_future in update_futures:
-                        update_future.result()
+                if (update_futures):
+                    _LOGGER.debug("Queued updates for %s: %s", self._device.vacuum['did'], 
+                                  self._scheduler.get_device_queue_metrics(self._device.vacuum['did']))
                     
-                    if (update_futures):
-                        self.schedule_update_ha_state()
-                
-                await self.hass.async_add_executor_job(job_wait_futures)
+                    # Wait in the loop, without holding an executor thread: on timeout the queued updates
+                    # are cancelled, and the not updated data is polled again by the next check
+                    try:
+                        await async_wait_command_futures(update_futures)
+                    except CommandError as err:
+                        _LOGGER.warning("Updates of %s not completed: %s", self._device.vacuum['did'], err)
+                    
+                    self.schedule_update_ha_state()
                 
     def update_map_sets(self, map_sets):
+        """Queue the requests of the given map set types, returning their futures."""
+        update_futures = []
         for map_set_type in map_sets:
             _LOGGER.debug("Getting map set %s" , map_set_type)
-            self._device.run(VacBotCommand('GetMapSet', {'tp':map_set_type}))
+            update_futures.append(self._commands.submit(VacBotCommand('GetMapSet', {'tp':map_set_type}), self.updates_executor))
+        return update_futures
         
     def update_map(self):
         _LOGGER.debug('Updating ecovacs image.')
@@ -564,72 +658,90 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         
         clean_empty = True
         
-        if (self._map_image is None) or (self._map_image.size[0] != map_w) or (self._map_image.size[1] != map_h):
-            self._map_image = Image.new('RGBA', (map_w, map_h))
+        if (self._map_canvas is None) or (self._map_canvas.size[0] != map_w) or (self._map_canvas.size[1] != map_h):
+            self._map_canvas = MapCanvas(map_w, map_h, (self._map_canvas.version + 1) if self._map_canvas else 1)
             clean_empty = False
         
-        img = self._map_image
+        canvas = self._map_canvas
         
-        # Pull all missing map pieces (concurrently)
-        pull_futures = []
-        pulled_hashes = []
-        for grid_idx, grid_hash in enumerate(self._map_info['grid_piece_hashes']):
-            piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + str(self._map_info['id']) + '_' + str(grid_hash))
-            if (not os.path.exists(piece_cache_file)) and (not grid_hash in pulled_hashes):
-                pulled_hashes.append(grid_hash)
-                pull_futures.append(self.pull_executor.submit(self._device.run, VacBotCommand('PullMP', {'pid':str(grid_idx)})))
-        
-        # wait pulls to be completed
-        for pull_future in pull_futures:
-            pull_future.result()
+        map_id = self._map_info['id']
         
-        # Generate the map
+        # Draw the available map pieces, collecting the missing ones by hash (the same piece can be used many times).
+        # Pieces are content addressed: the ones already drawn with the same hash are unchanged.
+        missing_pieces = {}
         for grid_idx, grid_hash in enumerate(self._map_info['grid_piece_hashes']):
-            piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + str(self._map_info['id']) + '_' + str(grid_hash))
+            if (canvas.grid_hashes.get(grid_idx) == grid_hash):
+                continue
+            
+            piece_data = self._map_pieces.get(map_id, grid_hash)
             
-            if (not os.path.exists(piece_cache_file)):
-                # No map piece, maybe changed recently (in the case it should have been handled by 
-                # the piece patch handler), skip the current grid position
-                _LOGGER.warn('Missing grid piece cache for index %s (hash: %s).' % (grid_idx, grid_hash))
+            if (piece_data is None):
+                missing_pieces.setdefault(grid_hash, []).append(grid_idx)
                 continue
-
-            piece_data = []
-            with open(piece_cache_file, 'rb') as f:
-                piece_data = f.read()
                 
-            self.draw_map_grid_piece(img, piece_data, grid_idx, clean_empty)
+            self.draw_map_grid_piece(canvas, piece_data, grid_idx, clean_empty, grid_hash)
+        
+        if (missing_pieces):
+            with self._map_pull_lock:
+                self._map_pull_pending = {
+                    'map_id': map_id,
+                    'clean_empty': clean_empty,
+                    'pieces': missing_pieces,
+                }
+            
+            # Publish the partial map while the missing pieces are pulled: each one will be drawn as soon 
+            # as it is received
+            self.publish_partial_map()
+            
+            # Pull all missing map pieces (concurrently)
+            pull_futures = []
+            for grid_hash, grid_idxs in missing_pieces.items():
+                pull_futures.append(self._commands.submit(VacBotCommand('PullMP', {'pid':str(grid_idxs[0])}), self.pull_executor))
+            
+            # wait pulls to be completed
+            try:
+                wait_command_futures(pull_futures)
+            finally:
+                with self._map_pull_lock:
+                    pending = self._map_pull_pending
+                    self._map_pull_pending = None
+            
+            for grid_hash, grid_idxs in pending['pieces'].items():
+                for grid_idx in grid_idxs:
+                    # No map piece, maybe changed recently (in the case it should have been handled by 
+                    # the piece patch handler), skip the current grid position
+                    _LOGGER.warn('Missing grid piece cache for index %s (hash: %s).', grid_idx, grid_hash)
         
         self._map_info_timestamp = time.time()
         
-    def draw_map_grid_piece(self, img, piece_data, grid_idx, clean_empty):
-        grid_c = self._map_info['grid_columns']
-        grid_r = self._map_info['grid_rows']
-        piece_w = self._map_info['grid_piece_w']
-        piece_h = self._map_info['grid_piece_h']
-    
-        img_w = img.size[1]
-    
-        x = int(grid_idx % grid_c) * piece_w
-        y = int(grid_idx / grid_r) * piece_h
+    def get_map_pieces_pending(self):
+        """Return the number of map pieces being pulled."""
+        with self._map_pull_lock:
+            return len(self._map_pull_pending['pieces']) if self._map_pull_pending is not None else 0
         
-        for idx, value in enumerate(piece_data):
-            lx = int(idx % piece_w)
-            ly = int(idx / piece_h)
-            
-            # The map is bottom, left origin, but PIL is upper left: rotating coordinates by 90° counter-clockwise.
-            mx = y + ly
-            my = img_w - 1 - (x + lx)
+    def publish_partial_map(self):
+        """Notify a map update while it is still being built, at most once per partial update interval."""
+        if time.time() - (self._map_partial_update_timestamp or 0) >= MAP_PARTIAL_UPDATE_INTERVAL:
+            self._map_partial_update_timestamp = time.time()
+            self._device_update_timestamp = time.time()
             
-            if value == 0x00:
-                # Empty: empty
-                if clean_empty:
-                    img.putpixel((mx, my), 0)
-            elif value == 0x01:
-                # Floor: light blue
-                img.putpixel((mx, my), (186, 218, 255, 255))
-            elif value == 0x02:
-                # Wall: dark blue
-                img.putpixel((mx, my), (84, 147, 214, 255))
+            self.schedule_update_ha_state()
+    
+    def load_map_pieces(self):
+        self._map_pieces.load()
+        
+        # Cleanup temporary caches left by previous versions
+        remove_legacy_temp_directories(self._device.vacuum['did'])
+        
+    def draw_map_grid_piece(self, canvas, piece_data, grid_idx, clean_empty, grid_hash):
+        with self._stats.timing(TIMING_RASTERIZE):
+            if self._offload.enabled:
+                tile_data = self._offload.run(rasterize_map_piece_data, piece_data, self._map_info['grid_piece_w'], self._map_info['grid_piece_h'])
+                canvas.draw_grid_tile(tile_data, self._map_info, grid_idx, clean_empty)
+            else:
+                canvas.draw_grid_piece(piece_data, self._map_info, grid_idx, clean_empty)
+        
+        canvas.grid_hashes[grid_idx] = grid_hash
         
         self._map_info_timestamp = time.time()
     
@@ -643,16 +755,111 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
             
             self.updates_executor.shutdown()
             self.pull_executor.shutdown()
+            self.trace_executor.shutdown()
+            
+            self._map_pieces.shutdown()
             
             _LOGGER.debug("Ecovacs map successfully stopped for %s." , self._device)
             
         self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, stop)
         
+        self.device.statusEvents.subscribe(self.on_refresh_status_change)
+        self._refresh_policy.set_activity(get_activity(self.state))
+        
+        # Show the last known map right away: the cloud refresh only updates what changed meanwhile. Messages
+        # are handled only once restored, so that the snapshot never replaces newer data pushed meanwhile.
+        snapshot = await self._snapshot_store.async_load()
+        if snapshot is not None:
+            await self.hass.async_add_executor_job(self.restore_snapshot, snapshot)
+        
+        self.install_message_handlers()
+        
+        await self.hass.async_add_executor_job(self.load_map_pieces)
+        
         self.hass.async_create_task(self.async_check_and_update_map(datetime.now()))
         
         async_track_time_interval(self.hass, self.async_check_and_update_map, timedelta(seconds=self._update_interval))
 
     
+    def schedule_update_ha_state(self, force_refresh=False):
+        super().schedule_update_ha_state(force_refresh)
+        
+        # Data changes are always notified: persist them too
+        self.hass.loop.call_soon_threadsafe(self._snapshot_store.async_schedule_save, self.get_snapshot_data)
+    
+    def get_snapshot_data(self):
+        """Collect the snapshot of the map data (called in an executor thread, when the snapshot is written).
+        
+        The snapshot is written after being collected, while the device data keeps changing: it holds only copies
+        (the map set elements and positions are replaced when changed, never updated in place).
+        """
+        snapshot = {
+            'map_set_info': dict(self._map_set_info),
+            'map_set_data': dict(self._map_set_data),
+            'device_pos': self._device_pos,
+            'charger_pos': self._charger_pos,
+        }
+        
+        map_info = self._map_info
+        canvas = self._map_canvas
+        if (map_info is not None) and (canvas is not None):
+            # Store the hashes of the drawn pieces: pieces still missing are pulled again after a restore
+            snapshot['map_info'] = dict(map_info, grid_piece_hashes=[
+                canvas.grid_hashes.get(grid_idx, '') for grid_idx in range(len(map_info['grid_piece_hashes']))])
+            snapshot['map_raster'] = {
+                'width': canvas.size[0],
+                'height': canvas.size[1],
+                'data': encode_snapshot_bytes(canvas.tobytes(), True),
+            }
+        
+        trace_info = self._trace_info
+        trace_points = self._trace_points
+        if (trace_info is not None) and (trace_points is not None):
+            trace_records = trace_points.records()
+            # Store the count of the stored points: points still missing are fetched again after a restore
+            snapshot['trace_info'] = dict(trace_info, count=len(trace_records) // TRACE_RECORD_SIZE)
+            snapshot['trace_records'] = encode_snapshot_bytes(trace_records)
+        
+        return snapshot
+    
+    def restore_snapshot(self, snapshot):
+        """Restore the map data from a snapshot."""
+        _LOGGER.debug('Restoring map snapshot for %s', self._device.vacuum['did'])
+        
+        map_info = snapshot.get('map_info')
+        map_raster = snapshot.get('map_raster')
+        if (map_info is not None) and (map_raster is not None):
+            canvas = MapCanvas(map_raster['width'], map_raster['height'], 1)
+            canvas.load_raster(decode_snapshot_bytes(map_raster['data'], True), map_info)
+            canvas.grid_hashes = {grid_idx: grid_hash for grid_idx, grid_hash in enumerate(map_info['grid_piece_hashes']) if grid_hash}
+            
+            self._map_info = map_info
+            self._map_canvas = canvas
+        
+        for map_set_type in self._map_set_info:
+            self._map_set_info[map_set_type] = (snapshot.get('map_set_info') or {}).get(map_set_type)
+            self._map_set_data[map_set_type] = (snapshot.get('map_set_data') or {}).get(map_set_type)
+        
+        self._device_pos = snapshot.get('device_pos')
+        self._charger_pos = snapshot.get('charger_pos')
+        
+        trace_info = snapshot.get('trace_info')
+        if (trace_info is not None) and (snapshot.get('trace_records') is not None):
+            trace_points = TraceStore()
+            trace_points.append_records(decode_snapshot_bytes(snapshot['trace_records']))
+            
+            self._trace_info = trace_info
+            self._trace_points = trace_points
+            self._trace_chunks = TraceChunkAssembler(trace_info['id'], trace_points)
+        
+        # Timestamps of the restored data are left unset, so that everything is refreshed from the cloud
+        self._device_update_timestamp = time.time()
+    
+    def on_refresh_status_change(self, _):
+        # Refresh immediately the data changed by the new activity (e.g. the final map when docked)
+        if self._refresh_policy.set_activity(get_activity(self.state)) and (not self._stopped):
+            self.hass.add_job(self.async_check_and_update_map, datetime.now())
+    
     @property
     def state_attributes(self):
         data = super().state_attributes or {}
@@ -678,27 +885,111 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         return self._map_info
 
     def get_map_image(self):
-        return self._map_image
+        if self._map_canvas is None:
+            return None
+        
+        return self._map_canvas.to_rgba()
     
-    def decompress7zBase64Data(self, data):
-        # Decode Base64
-        data = base64.b64decode(data)
+    def get_map_version(self):
+        return self._map_canvas.version if self._map_canvas else 0
+    
+    async def async_get_map_background(self):
+        """Return the encoded map background, encoding it off-loop only once per map version."""
+        return await self._map_background_cache.async_get(self.hass, self.get_map_version(), self.encode_map_background)
+    
+    async def async_get_map_patches(self, since_version, canvas_id):
+        """Return the encoded map tiles changed since the given version of a canvas, or None if a full map is needed."""
+        return await self.hass.async_add_executor_job(self.encode_map_patches, since_version, canvas_id)
+    
+    def encode_map_background(self):
+        map_canvas = self._map_canvas
+        
+        map_version = map_canvas.version if map_canvas else 0
+        image_png = b""
+        image_box = None
+        if (map_canvas): 
+            image_box = map_canvas.getbbox()
+            
+            with self._stats.timing(TIMING_PNG_ENCODE):
+                image_png = map_canvas.encode_png(image_box, self._offload)
+        
+        return {
+            "map_canvas_id": map_canvas.canvas_id if map_canvas else None,
+            "map_version": map_version,
+            "map_background_base64": base64.b64encode(image_png).decode("ascii"),
+            "map_background_left": image_box[0] if image_box else 0,
+            "map_background_top": image_box[1] if image_box else 0,
+            "map_background_right": image_box[2] if image_box else 0,
+            "map_background_bottom": image_box[3] if image_box else 0,
+            "map_width": map_canvas.size[0] if map_canvas else 0,
+            "map_height": map_canvas.size[1] if map_canvas else 0,
+        }
+    
+    def encode_map_patches(self, since_version, canvas_id):
+        map_canvas = self._map_canvas
+        if map_canvas is None:
+            return None
+        
+        # The version of a canvas of another process (e.g. before a restart) says nothing of this one
+        if canvas_id != map_canvas.canvas_id:
+            return None
+        
+        map_version = map_canvas.version
+        dirty_boxes = map_canvas.dirty_boxes(since_version)
+        
+        # Patches are usable only if the background placement did not change
+        if (dirty_boxes is None) or (len(dirty_boxes) > MAP_PATCHES_MAX) or map_canvas.bbox_changed_since(since_version):
+            return None
         
-        # Get lzma output size (Android app handle it as little-endian signed int)
-        length = struct.unpack('<i', data[5:5+4])[0]
+        image_box = map_canvas.getbbox()
         
-        # Init the LZMA decompressor using the lzma header
-        dec = lzma.LZMADecompressor(lzma.FORMAT_RAW, None, [lzma._decode_filter_properties(lzma.FILTER_LZMA1, data[0:5])])
+        map_patches = []
+        for patch_box in dirty_boxes:
+            with self._stats.timing(TIMING_PNG_ENCODE):
+                patch_png = map_canvas.encode_png(patch_box, self._offload)
+            
+            map_patches.append({
+                "base64": base64.b64encode(patch_png).decode("ascii"),
+                "left": patch_box[0],
+                "top": patch_box[1],
+                "right": patch_box[2],
+                "bottom": patch_box[3],
+            })
+        
+        return {
+            "map_canvas_id": map_canvas.canvas_id,
+            "map_version": map_version,
+            "map_patches": map_patches,
+            "map_background_left": image_box[0] if image_box else 0,
+            "map_background_top": image_box[1] if image_box else 0,
+            "map_background_right": image_box[2] if image_box else 0,
+            "map_background_bottom": image_box[3] if image_box else 0,
+            "map_width": map_canvas.size[0],
+            "map_height": map_canvas.size[1],
+        }
+    
+    def decompress7zBase64Data(self, data):
+        with self._stats.timing(TIMING_DECOMPRESS):
+            return self._offload.run(decompress_7z_base64_data, data)
         
-        # Decompress the lzma stream to get raw data
-        return dec.decompress(data[9:], length)
+    def get_event_counts(self):
+        """Return the number of events received from the device, per event."""
+        return self._event_counters.get_counts()
         
     def _handle_ctl(self, ctl):
-        _LOGGER.debug('Received event: %s (full data: %s)' % (ctl['event'], ctl))
+        event = ctl['event']
+        self._event_counters.count(event)
+        
+        _LOGGER.debug('Received event: %s (full data: %s)', event, ctl)
     
-        method = '_handle_' + ctl['event']
-        if hasattr(self, method):
-            getattr(self, method)(ctl)
+        # Handlers are resolved once per class (see events.register_event_handler for external handlers)
+        handler = self._event_handlers.get(event)
+        if handler is not None:
+            try:
+                handler(self, ctl)
+            except CommandError as err:
+                # Requests made by the handler failed: their data is requested again by the next update
+                _LOGGER.warning('Unable to handle event %s: %s', event, err)
         
     def _handle_map_m(self, event):
         map_info = {
@@ -711,7 +1002,7 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         }
         
         if (self._map_info != map_info):
-            _LOGGER.debug('Updating map info. Old: %s; New: %s' % (self._map_info, map_info))
+            _LOGGER.debug('Updating map info. Old: %s; New: %s', self._map_info, map_info)
             self._map_info = map_info
             
             self.update_map()
@@ -727,11 +1018,20 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         piece_data = self.decompress7zBase64Data(event.get('p'))
         crc = str(zlib.crc32(piece_data) & 0xffffffff)
         
-        piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + map_id + '_' + crc)
-    
-        with open(piece_cache_file, 'w+b') as f:
-            f.write(bytearray(piece_data))
+        self._map_pieces.put(map_id, crc, piece_data)
         
+        # Draw the piece right away if a map update is waiting for it
+        with self._map_pull_lock:
+            grid_idxs = None
+            if (self._map_pull_pending is not None) and (self._map_pull_pending['map_id'] == map_id):
+                grid_idxs = self._map_pull_pending['pieces'].pop(crc, None)
+                clean_empty = self._map_pull_pending['clean_empty']
+        
+        if (grid_idxs) and (self._map_canvas is not None):
+            for grid_idx in grid_idxs:
+                self.draw_map_grid_piece(self._map_canvas, piece_data, grid_idx, clean_empty, crc)
+            
+            self.publish_partial_map()
         
     def _handle_map_p(self, event):
         # Map patched: update the patched piece
@@ -742,38 +1042,24 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         crc = str(zlib.crc32(piece_data) & 0xffffffff)
         
         if (self._map_info is not None) and (self._map_info['id'] == map_id) and (self._map_info['grid_piece_hashes'][piece_idx] != crc):
-            _LOGGER.debug('Updating map piece: %s' % (piece_idx))
+            _LOGGER.debug('Updating map piece: %s', piece_idx)
         
-            piece_cache_file = os.path.join(self._map_cache_directory_path, 'map_cache_' + map_id + '_' + crc)
-        
-            with open(piece_cache_file, 'w+b') as f:
-                f.write(bytearray(piece_data))
+            self._map_pieces.put(map_id, crc, piece_data)
 
             # Update the map hash if we have cached map info
             if self._map_info is not None:
                 self._map_info['grid_piece_hashes'][piece_idx] = crc
                 
             # Regenerate map piece portion if there is a map image
-            if (not self._map_image is None):
-                self.draw_map_grid_piece(self._map_image, piece_data, piece_idx, True)
+            if (not self._map_canvas is None):
+                self.draw_map_grid_piece(self._map_canvas, piece_data, piece_idx, True, crc)
 
             self._device_update_timestamp = time.time()
             
             self.schedule_update_ha_state()
 
     def add_trace_data(self, trace_data):
-        if (len(trace_data) != 0) and (len(trace_data) % 5 == 0):
-            for trace_group_idx in range(len(trace_data) // 5):
-                trace_idx = trace_group_idx * 5
-                
-                data = trace_data[trace_idx + 4]
-                
-                self._trace_points.append({
-                    'y': struct.unpack('<h', trace_data[trace_idx:trace_idx+2])[0],
-                    'x': struct.unpack('<h', trace_data[trace_idx+2:trace_idx+4])[0],
-                    'connected': not (((data >> 7) & 1) != 0),
-                    'type': data & 1,
-                })
+        self._trace_points.append_records(trace_data)
             
 
     def _handle_tr_m(self, event):
@@ -783,25 +1069,18 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         }
         
         if (self._trace_info != trace_info):
-            _LOGGER.debug('Updating trace info and points. Old: %s; New: %s' % (self._trace_info, trace_info))
+            _LOGGER.debug('Updating trace info and points. Old: %s; New: %s', self._trace_info, trace_info)
             
-            if (self._trace_points is None) or (self._trace_info is None) or (self._trace_info['id'] != trace_info['id']):
+            if (self._trace_points is None) or (self._trace_chunks is None) or (self._trace_chunks.trace_id != trace_info['id']):
                 _LOGGER.debug('Resetting trace points due new or changed trace id')
-                self._trace_points = []
-                
-            self._trace_info = trace_info
+                self._trace_points = TraceStore()
+                self._trace_chunks = TraceChunkAssembler(trace_info['id'], self._trace_points)
             
-            start_idx = len(self._trace_points)
-            while (start_idx < trace_info['count']):
-                end_idx = min(trace_info['count'] - 1, start_idx + 199)
-                self._device.run(
-                    VacBotCommand('GetTr', 
-                        {
-                            'id': trace_info['id'],
-                            'tf': str(start_idx),  
-                            'tt': str(end_idx)
-                        }))
-                start_idx = end_idx + 1
+            self.fetch_trace_chunks(self._trace_chunks, trace_info['count'], 'id')
+            
+            # Stored only once all the chunks are fetched: after a failed request, the next trace info fetches 
+            # the missing ones again
+            self._trace_info = trace_info
             
             self._device_update_timestamp = time.time()
             
@@ -809,8 +1088,35 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
             
         self._trace_info_timestamp = time.time()
         
+    def fetch_trace_chunks(self, trace_chunks, end_idx, trace_id_arg):
+        """Fetch the trace points missing before end_idx, keeping a window of chunk requests in flight."""
+        fetch_futures = []
+        for chunk_range in trace_chunks.claim_missing_ranges(end_idx):
+            fetch_future = self._commands.submit(
+                VacBotCommand('GetTr', 
+                    {
+                        trace_id_arg: trace_chunks.trace_id,
+                        'tf': str(chunk_range[0]),
+                        'tt': str(chunk_range[1]),
+                    }), self.trace_executor)
+            
+            # Release the range also when the request is cancelled, so it can be claimed again
+            fetch_future.add_done_callback(lambda _, chunk_range=chunk_range: trace_chunks.release(chunk_range))
+            fetch_futures.append(fetch_future)
+        
+        wait_command_futures(fetch_futures)
+    
     def _handle_tr(self, event):
-        self.add_trace_data(self.decompress7zBase64Data(event.get('tr')))
+        request = event.get('#request')
+        if (request is None) or ('tf' not in request):
+            # Not a response to a chunk request: append as received
+            self.add_trace_data(self.decompress7zBase64Data(event.get('tr')))
+            return
+        
+        # Store the chunk at the requested index, if the trace is still the requested one
+        trace_chunks = self._trace_chunks
+        if (trace_chunks is not None) and (trace_chunks.trace_id == request.get('id', request.get('trid'))):
+            trace_chunks.add_chunk(int(request['tf']), self.decompress7zBase64Data(event.get('tr')))
         
 
     def _handle_trace(self, event):
@@ -820,27 +1126,20 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
 
         _LOGGER.debug('Handling points of received trace event')
         
-        if (self._trace_points is None) or (t_from == 0) or ((self._trace_info is not None) and (self._trace_info['id'] != trace_id)):
-            self._trace_points = []
+        if (self._trace_points is None) or (t_from == 0) or (self._trace_chunks is None) or (self._trace_chunks.trace_id != trace_id):
+            self._trace_points = TraceStore()
+            self._trace_chunks = TraceChunkAssembler(trace_id, self._trace_points)
+
+        # Fill the gap before the received points, which are stored only after it
+        trace_chunks = self._trace_chunks
+        self.fetch_trace_chunks(trace_chunks, t_from, 'trid')
+        
+        trace_chunks.add_chunk(t_from, self.decompress7zBase64Data(event.get('tr')))
         
         self._trace_info = {
             'id': trace_id,
             'count': t_to + 1,
         }
-
-        while (len(self._trace_points) < t_from):
-            chunk_idx = len(self._trace_points)
-            self._device.run(
-                VacBotCommand('GetTr', 
-                    {
-                        'trid': trace_id,
-                        'tf': str(chunk_idx), 
-                        'tt': str(min(t_from - 1, chunk_idx + 199)),
-                    }
-                )
-            )
-        
-        self.add_trace_data(self.decompress7zBase64Data(event.get('tr')))
         
         self._trace_info_timestamp = time.time()
         self._device_update_timestamp = time.time()
@@ -859,27 +1158,32 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         # Always update map set info, as coordinate updates are not reflected in the map_set.
         #   - Old if content:  and self._map_set_info[map_set_type] != map_set_info
         if (map_set_type in self._map_set_info):
-            _LOGGER.debug('Updating map set info for %s. Old: %s; New: %s' % (map_set_type, self._map_set_info[map_set_type], map_set_info))
+            _LOGGER.debug('Updating map set info for %s. Old: %s; New: %s', map_set_type, self._map_set_info[map_set_type], map_set_info)
             self._map_set_info[map_set_type] = map_set_info
             
-            self._current_map_set_type = map_set_type 
-            
-            self._map_set_data[map_set_type] = {}
+            # Elements are collected apart and published all together, so pulls of any type can overlap
+            map_set_data = {}
+            self._map_set_pulls[(map_set_type, map_set_info['id'])] = map_set_data
 
             pull_futures = []
             for child in (event.get('#children') or []):
-                pull_futures.append(self.pull_executor.submit(
-                    self.start_pull_m,
-                    
-                    map_set_info['id'],
-                    map_set_type, 
-                    str(child.get('mid'))
-                ))
-                
-            for pull_future in pull_futures:
-                pull_future.result()
-                
-            self._current_map_set_type = None
+                pull_futures.append(self._commands.submit(
+                    VacBotCommand('PullM', 
+                        {
+                            'msid': map_set_info['id'],
+                            'tp': map_set_type, 
+                            'mid': str(child.get('mid')),
+                            'seq': '0',
+                        }
+                    ), self.pull_executor))
+            
+            try:
+                wait_command_futures(pull_futures)
+            finally:
+                if (self._map_set_pulls.get((map_set_type, map_set_info['id'])) is map_set_data):
+                    del self._map_set_pulls[(map_set_type, map_set_info['id'])]
+            
+            self._map_set_data[map_set_type] = map_set_data
             
             self._device_update_timestamp = time.time()
             
@@ -889,27 +1193,19 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         
     
         
-    def start_pull_m(self, msid, map_set_type, mid):
-        self._thread_local.mid = mid
-        self._device.run(
-                    VacBotCommand('PullM', 
-                        {
-                            'msid': msid,
-                            'tp': map_set_type, 
-                            'mid': mid,
-                            'seq': '0',
-                        }
-                    ))
-        
-        del self._thread_local.mid
-        
     def _handle_pull_m(self, event):
-        if (self._current_map_set_type):
+        # Find the map set being pulled from the request of the response
+        request = event.get('#request')
+        if (request is None):
+            return
+        
+        map_set_data = self._map_set_pulls.get((request.get('tp'), request.get('msid')))
+        if (map_set_data is not None):
             map_data = event.get('m')
             if (map_data[0] == '['):
-                self._map_set_data[self._current_map_set_type][self._thread_local.mid] = ast.literal_eval(event.get('m'))
+                map_set_data[request.get('mid')] = ast.literal_eval(event.get('m'))
             else:
-                self._map_set_data[self._current_map_set_type][self._thread_local.mid] = list(map(int, re.split(',|;', event.get('m'))))
+                map_set_data[request.get('mid')] = list(map(int, re.split(',|;', event.get('m'))))
         
         
     def _handle_pos(self, event):
@@ -922,7 +1218,7 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         }
         
         if (self._device_pos != device_pos):
-            _LOGGER.debug('Updating pos. Old: %s; New: %s' % (self._device_pos, device_pos))
+            _LOGGER.debug('Updating pos. Old: %s; New: %s', self._device_pos, device_pos)
             
             self._device_pos = device_pos
             self._device_update_timestamp = time.time()
@@ -941,7 +1237,7 @@ class LiveMapEcovacsDeebotVacuum(EcovacsDeebotVacuum):
         }
         
         if (self._charger_pos != charger_pos):
-            _LOGGER.debug('Updating charger. Old: %s; New: %s' % (self._charger_pos, charger_pos))
+            _LOGGER.debug('Updating charger. Old: %s; New: %s', self._charger_pos, charger_pos)
             
             self._charger_pos = charger_pos
             self._device_update_timestamp = time.time()
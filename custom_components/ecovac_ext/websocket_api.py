@@ -1,5 +1,4 @@
 import base64
-import io
 import logging
 
 import voluptuous as vol
@@ -10,23 +9,32 @@ from homeassistant.components import websocket_api
 from homeassistant.core import callback
 
 from homeassistant.components.vacuum import DOMAIN as VACUUM_DOMAIN
-from PIL import Image
 from ozmo import VacBotCommand
 
+from . import ECOVACS_SCHEDULER, ECOVACS_STATS
+from .commands import CommandTimeoutError
+from .trace import TRACE_RECORD_SIZE
+
 _LOGGER = logging.getLogger(__name__)
 
+TRACE_ENCODING_JSON = "json"
+TRACE_ENCODING_PACKED = "packed"
+
 def find_entity(hass, entity_id):
     component = hass.data.get(VACUUM_DOMAIN)
     
     return component.get_entity(entity_id)
 
+@websocket_api.async_response
 @websocket_api.websocket_command( 
     {
         vol.Required("type"): "ecovacs/get_map",
         vol.Required("entity_id"): cv.entity_id,
+        vol.Optional("since_version"): vol.Coerce(int),
+        vol.Optional("canvas_id"): cv.string,
     }
 )
-def websocket_handle_get_map(hass, connection, msg):
+async def websocket_handle_get_map(hass, connection, msg):
     entity = find_entity(hass, msg["entity_id"])
     
     if entity is None:
@@ -35,28 +43,15 @@ def websocket_handle_get_map(hass, connection, msg):
         )
         return
     
-    imgByteArr = io.BytesIO()
-    image_box = None
-    if (entity._map_image): 
-        image_box = entity._map_image.getbbox()
-        
-        img = entity._map_image.crop(image_box)
-        img = img.convert(mode='P', palette=Image.ADAPTIVE)
-        
-        img.save(imgByteArr, format='PNG', optimize=True)
+    # Send only the changed map tiles if the client already has a previous version of the same map canvas
+    result = None
+    if "since_version" in msg:
+        result = await entity.async_get_map_patches(msg["since_version"], msg.get("canvas_id"))
     
-    connection.send_result(
-        msg["id"], 
-        {
-            "map_background_base64": base64.b64encode(imgByteArr.getvalue()).decode("ascii"),
-            "map_background_left": image_box[0] if image_box else 0,
-            "map_background_top": image_box[1] if image_box else 0,
-            "map_background_right": image_box[2] if image_box else 0,
-            "map_background_bottom": image_box[3] if image_box else 0,
-            "map_width": entity._map_image.size[0] if entity._map_image else 0,
-            "map_height": entity._map_image.size[1] if entity._map_image else 0,
-        }
-    )
+    if result is None:
+        result = await entity.async_get_map_background()
+    
+    connection.send_result(msg["id"], result)
     
 @websocket_api.websocket_command( 
     {
@@ -81,13 +76,18 @@ def websocket_handle_get_map_set(hass, connection, msg):
         }
     )
     
+@websocket_api.async_response
 @websocket_api.websocket_command( 
     {
         vol.Required("type"): "ecovacs/get_trace",
         vol.Required("entity_id"): cv.entity_id,
+        vol.Optional("trace_id"): cv.string,
+        vol.Optional("since", default=0): cv.positive_int,
+        vol.Optional("encoding", default=TRACE_ENCODING_JSON): vol.In([TRACE_ENCODING_JSON, TRACE_ENCODING_PACKED]),
+        vol.Optional("tolerance", default=0): vol.All(vol.Coerce(float), vol.Range(min=0)),
     }
 )
-def websocket_handle_get_trace(hass, connection, msg):
+async def websocket_handle_get_trace(hass, connection, msg):
     entity = find_entity(hass, msg["entity_id"])
     
     if entity is None:
@@ -96,12 +96,57 @@ def websocket_handle_get_trace(hass, connection, msg):
         )
         return
     
-    connection.send_result(
-        msg["id"], 
-        {
-            "trace_points": entity._trace_points,
-        }
-    )
+    trace_points = entity._trace_points
+    trace_info = entity._trace_info
+    
+    if trace_points is None:
+        connection.send_result(
+            msg["id"], 
+            {
+                "trace_id": None,
+                "trace_start": 0,
+                "trace_count": 0,
+                "trace_points": None,
+            }
+        )
+        return
+    
+    trace_id = trace_info['id'] if trace_info is not None else None
+    
+    # With a tolerance, the simplified trace is sent: indexes refer to its points, and only the stable ones
+    # are counted, so the last point is sent again on the next request as it may be replaced meanwhile
+    indices = None
+    if msg["tolerance"] > 0:
+        indices, trace_count = await hass.async_add_executor_job(trace_points.simplify, msg["tolerance"])
+    else:
+        trace_count = len(trace_points)
+    
+    # Send only the points after the ones the client already has, or the whole trace if the client
+    # refers to another trace (or to points no longer existing)
+    start = msg["since"]
+    if (msg.get("trace_id") != trace_id) or (start > trace_count):
+        start = 0
+    
+    result = {
+        "trace_id": trace_id,
+        "trace_start": start,
+    }
+    
+    # The count is taken from the sent points, as new points may be appended meanwhile by the update threads
+    if msg["encoding"] == TRACE_ENCODING_PACKED:
+        # Raw 5 bytes records: y (int16 LE), x (int16 LE), flags (bit 7: not connected, bit 0: type)
+        trace_data = trace_points.records(start, indices)
+        result["trace_count"] = start + len(trace_data) // TRACE_RECORD_SIZE
+        result["trace_data"] = base64.b64encode(trace_data).decode('ascii')
+    else:
+        points = trace_points.to_list(start, indices)
+        result["trace_count"] = start + len(points)
+        result["trace_points"] = points
+    
+    if indices is not None:
+        result["trace_count"] = trace_count
+    
+    connection.send_result(msg["id"], result)
     
 @websocket_api.async_response
 @websocket_api.websocket_command( 
@@ -148,6 +193,18 @@ async def async_websocket_handle_clean_rooms(hass, connection, msg):
     connection.send_result(msg["id"], {"success":True})
  
    
+async def async_run_wall_command(connection, msg, entity, command):
+    """Run a command changing the virtual walls, then queue their refresh."""
+    try:
+        await entity._commands.async_run(command)
+    except CommandTimeoutError as err:
+        connection.send_error(msg["id"], "timeout", str(err))
+        return
+    
+    entity.update_map_sets(['vw'])
+    
+    connection.send_result(msg["id"], {"success":True})
+
 @websocket_api.async_response
 @websocket_api.websocket_command( 
     {
@@ -165,9 +222,7 @@ async def async_websocket_handle_add_wall(hass, connection, msg):
         )
         return
     
-    
-    
-    await hass.async_add_executor_job(entity.device.run, 
+    await async_run_wall_command(connection, msg, entity, 
         VacBotCommand("AddM", {
             'tp': 'vw',
             'msid': entity._map_set_info["vw"]["id"],
@@ -175,10 +230,6 @@ async def async_websocket_handle_add_wall(hass, connection, msg):
             'm': '[' + ','.join(map(lambda val: str(round(val)), msg['wall_data'])) + ']',            
         }))
     
-    hass.async_add_executor_job(entity.update_map_sets, ['vw'])
-    
-    connection.send_result(msg["id"], {"success":True})
-    
 @websocket_api.async_response
 @websocket_api.websocket_command( 
     {
@@ -197,7 +248,7 @@ async def async_websocket_handle_edit_wall(hass, connection, msg):
         )
         return
     
-    await hass.async_add_executor_job(entity.device.run, 
+    await async_run_wall_command(connection, msg, entity, 
         VacBotCommand("UpdateM", {
             'tp': 'vw',
             'msid': str(entity._map_set_info["vw"]["id"]),
@@ -209,10 +260,6 @@ async def async_websocket_handle_edit_wall(hass, connection, msg):
                 }
             ],            
         }))
-    
-    hass.async_add_executor_job(entity.update_map_sets, ['vw'])
-    
-    connection.send_result(msg["id"], {"success":True})
    
 @websocket_api.async_response
 @websocket_api.websocket_command( 
@@ -231,16 +278,12 @@ async def async_websocket_handle_remove_wall(hass, connection, msg):
         )
         return
     
-    await hass.async_add_executor_job(entity.device.run, 
+    await async_run_wall_command(connection, msg, entity, 
         VacBotCommand("DelM", {
             'tp': 'vw',
             'msid': str(entity._map_set_info["vw"]["id"]),
             'mid': str(msg['wall']),
         }))
-    
-    hass.async_add_executor_job(entity.update_map_sets, ['vw'])
-    
-    connection.send_result(msg["id"], {"success":True})
 
 @websocket_api.websocket_command( 
     {
@@ -329,6 +372,38 @@ async def async_websocket_handle_remove_custom_zone(hass, connection, msg):
     
     connection.send_result(msg["id"], {"success":True})
 
+    
+@websocket_api.async_response
+@websocket_api.websocket_command( 
+    {
+        vol.Required("type"): "ecovacs/get_stats",
+        vol.Optional("entity_id"): cv.entity_id,
+    }
+)
+async def async_websocket_handle_get_stats(hass, connection, msg):
+    if "entity_id" in msg:
+        entity = find_entity(hass, msg["entity_id"])
+        
+        if entity is None or not hasattr(entity, '_stats'):
+            connection.send_error(
+                msg["id"], "entity_not_found", "Entity not found"
+            )
+            return
+        
+        # Gauges may wait for locks of the map work
+        result = await hass.async_add_executor_job(entity._stats.as_dict)
+        connection.send_result(msg["id"], result)
+        return
+    
+    def get_all_stats():
+        return {
+            "devices": {did: stats.as_dict() for did, stats in list(hass.data[ECOVACS_STATS].items())},
+            "queues": hass.data[ECOVACS_SCHEDULER].get_queue_metrics(),
+        }
+    
+    result = await hass.async_add_executor_job(get_all_stats)
+    connection.send_result(msg["id"], result)
+
 
 @callback
 def async_load_websocket_api(hass):
@@ -346,4 +421,6 @@ def async_load_websocket_api(hass):
     
     websocket_api.async_register_command(hass, async_websocket_handle_add_custom_zone)
     websocket_api.async_register_command(hass, async_websocket_handle_edit_custom_zone)
-    websocket_api.async_register_command(hass, async_websocket_handle_remove_custom_zone)
\ No newline at end of file
+    websocket_api.async_register_command(hass, async_websocket_handle_remove_custom_zone)
+    
+    websocket_api.async_register_command(hass, async_websocket_handle_get_stats)
\ No newline at end of file
@@ -0,0 +1,22 @@
+"""Make the integration modules importable without running the integration setup module.
+
+The package __init__ imports Home Assistant, while the modules tested here (pacing, scheduling) do not need
+it: their package is registered without executing __init__.
+"""
+import os
+import sys
+import types
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_PATH = os.path.join(REPO_PATH, 'custom_components', 'ecovac_ext')
+
+if REPO_PATH not in sys.path:
+    sys.path.insert(0, REPO_PATH)
+
+if 'custom_components.ecovac_ext' not in sys.modules:
+    import custom_components
+
+    package = types.ModuleType('custom_components.ecovac_ext')
+    package.__path__ = [PACKAGE_PATH]
+    sys.modules['custom_components.ecovac_ext'] = package
+    custom_components.ecovac_ext = package
@@ -0,0 +1,166 @@
+"""Tests of the awaitable device commands, and of the coalescing of their getters."""
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip('homeassistant')
+
+from custom_components.ecovac_ext.commands import CommandFailedError, CommandTimeoutError, DeviceCommands,\
+    set_command_failed, wait_command_futures
+from custom_components.ecovac_ext.scheduler import DeviceExecutor, FairExecutor
+
+TIMEOUT = 5
+
+
+class Command:
+    def __init__(self, name, args=None):
+        self.name = name
+        self.args = args or {}
+
+
+class FakeDevice:
+    """VacBot running the commands only when released, and recording them."""
+
+    def __init__(self):
+        self.commands = []
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+        self.failed = set()
+
+        self._lock = threading.Lock()
+
+    def run(self, command):
+        with self._lock:
+            self.commands.append(command.name)
+        self.started.release()
+
+        assert self.release.wait(TIMEOUT)
+        if command.name in self.failed:
+            set_command_failed(command)
+        return command.name
+
+    def wait_started(self):
+        assert self.started.acquire(timeout=TIMEOUT)
+
+
+@pytest.fixture
+def executor():
+    executor = FairExecutor(4, 'test')
+    yield executor
+    executor.shutdown(wait=False)
+
+
+@pytest.fixture
+def device():
+    device = FakeDevice()
+    yield device
+    device.release.set()
+
+
+def new_commands(device, executor):
+    return DeviceCommands(device, DeviceExecutor(executor, 'device', 'command', 1))
+
+
+def test_queued_getters_are_coalesced(device, executor):
+    commands = new_commands(device, executor)
+
+    # The first request is running: the next ones are queued behind it
+    running = commands.submit(Command('GetPos'))
+    device.wait_started()
+
+    first = commands.submit(Command('GetMapSet', {'tp': 'vw'}))
+    second = commands.submit(Command('GetMapSet', {'tp': 'vw'}))
+    other = commands.submit(Command('GetMapSet', {'tp': 'sa'}))
+
+    device.release.set()
+    wait_command_futures([running, first, second, other], TIMEOUT)
+
+    assert first.result() == second.result() == 'GetMapSet'
+    assert device.commands == ['GetPos', 'GetMapSet', 'GetMapSet']
+
+
+def test_running_getters_are_not_joined(device, executor):
+    commands = new_commands(device, executor)
+
+    # A refresh requested while the previous one is running may follow a change: it is sent again
+    first = commands.submit(Command('GetMapSet', {'tp': 'vw'}))
+    device.wait_started()
+    second = commands.submit(Command('GetMapSet', {'tp': 'vw'}))
+    third = commands.submit(Command('GetMapSet', {'tp': 'vw'}))
+
+    device.release.set()
+    wait_command_futures([first, second, third], TIMEOUT)
+
+    assert device.commands == ['GetMapSet', 'GetMapSet']
+
+
+def test_other_commands_are_not_coalesced(device, executor):
+    commands = new_commands(device, executor)
+
+    futures = [commands.submit(Command('Clean')) for _ in range(2)]
+    device.release.set()
+    wait_command_futures(futures, TIMEOUT)
+
+    assert device.commands == ['Clean', 'Clean']
+
+
+def test_shared_command_cancelled_by_all_its_callers(device, executor):
+    commands = new_commands(device, executor)
+
+    running = commands.submit(Command('Clean'))
+    device.wait_started()
+
+    first = commands.submit(Command('GetPos'))
+    second = commands.submit(Command('GetPos'))
+
+    # Still requested for the other caller
+    first.cancel()
+    third = commands.submit(Command('GetPos'))
+    second.cancel()
+    third.cancel()
+
+    # Requested again once cancelled by all its callers
+    fourth = commands.submit(Command('GetPos'))
+
+    device.release.set()
+    wait_command_futures([running, fourth], TIMEOUT)
+
+    assert first.cancelled() and second.cancelled() and third.cancelled()
+    assert device.commands == ['Clean', 'GetPos']
+
+
+def test_failed_command(device, executor):
+    commands = new_commands(device, executor)
+    device.failed.add('GetPos')
+    device.release.set()
+
+    future = commands.submit(Command('GetPos'))
+    with pytest.raises(CommandFailedError):
+        future.result(TIMEOUT)
+
+
+def test_user_command_without_response(device, executor):
+    commands = new_commands(device, executor)
+    device.failed.add('Clean')
+    device.release.set()
+
+    # Commands like Clean normally get no response: not an error for their caller
+    assert asyncio.run(commands.async_run(Command('Clean'), TIMEOUT)) is None
+
+
+def test_batch_timeout_cancels_queued_commands(device, executor):
+    commands = new_commands(device, executor)
+
+    futures = [commands.submit(Command('PullMP', {'pid': str(idx)})) for idx in range(3)]
+    device.wait_started()
+
+    with pytest.raises(CommandTimeoutError):
+        wait_command_futures(futures, 0.1)
+
+    # The callers are released, the running request is left to complete and the queued ones are not sent
+    assert all(future.cancelled() for future in futures)
+
+    device.release.set()
+    assert commands.submit(Command('Clean')).result(TIMEOUT) == 'Clean'
+    assert device.commands == ['PullMP', 'Clean']
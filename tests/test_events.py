@@ -0,0 +1,70 @@
+"""Tests of the decoding of the device messages, pinned to the conversion of the ozmo iotmq handlers."""
+import xml.etree.ElementTree as ET
+
+import pytest
+
+ozmo = pytest.importorskip('ozmo')
+
+from custom_components.ecovac_ext.events import find_mqtt_td, get_ozmo_api_event_name, to_ozmo_api_dict,\
+    to_ozmo_mqtt_dict
+
+TOPIC = 'iot/atr/{td}/did/ls1ok3/res/x'
+
+
+class Command:
+    def __init__(self, name, args=None):
+        self.name = name
+        self.args = args or {}
+
+
+API_RESPONSES = [
+    ('GetCleanState', '<ctl ret="ok"><clean type="auto" speed="standard" st="h" t="1200" a="12" s="0" tr=""/></ctl>'),
+    ('GetChargeState', '<ctl ret="ok"><charge type="SlotCharging" h="" r="a" s="" g="0"/></ctl>'),
+    ('GetBatteryInfo', '<ctl ret="ok"><battery power="100"/></ctl>'),
+    ('Charge', '<ctl ret="fail" errno="8" error="RobotAlreadyCharging"/>'),
+    ('Clean', '<ctl ret="fail" errno="3" error="NotSupported"/>'),
+    ('GetLifeSpan', '<ctl ret="ok" type="SideBrush" left="9394" total="18000"/>'),
+    ('GetPos', '<ctl ret="ok" t="p" p="-1234,56" a="-90" valid="1"/>'),
+    ('GetMapM', '<ctl ret="ok" i="1654563434" w="100" h="100" r="8" c="8" p="50"/>'),
+    ('GetMapSet', '<ctl ret="ok" tp="sa" msid="3"><m mid="0" p="1"/><m mid="1" p="1"/></ctl>'),
+    ('PullMP', '<ctl ret="ok" pid="3" p="XQAABAAQJwAAAABv/f//o7f/Rz5IFXI5YVG4kijmo4YH+e7kHoLTL8U6PAFLsX7Jhrz0KgA="/>'),
+]
+
+MQTT_MESSAGES = [
+    '<ctl td="Pos" t="p" p="-1234,56" a="-90" valid="1"/>',
+    '<ctl td="CleanReport"><clean type="SpotArea" speed="strong" st="s" p="1,2" t="60" a="3"/></ctl>',
+    '<ctl td="ChargeState"><charge type="Going" g="1"/></ctl>',
+    '<ctl td="BatteryInfo"><battery power="080"/></ctl>',
+    '<ctl td="Error" errno="102" error="HostHang"/>',
+    '<ctl td="MapP" i="1654563434" pid="12" p="XQAABAAQJwAAAABv/f//o7f/Rz5IFXI5YVG4kijmo4YH+e7kHoLTL8U6PAFLsX7Jhrz0KgA="/>',
+    '<ctl td="trace" trid="13" tf="0" tt="50" tr="AAAAAAAAAAAAAAAAAAA="/>',
+    '<ctl td="MapSt" st="built" method="" info=""/>',
+]
+
+
+@pytest.mark.parametrize('command_name, message', API_RESPONSES)
+def test_api_dict_matches_ozmo(command_name, message):
+    command = Command(command_name)
+    expected = ozmo.EcoVacsIOTMQ._ctl_to_dict_api(None, command, message)
+    xml = ET.fromstring(message)
+
+    assert to_ozmo_api_dict(command_name, xml) == expected
+    assert get_ozmo_api_event_name(command_name, xml) == expected['event']
+
+
+@pytest.mark.parametrize('message', MQTT_MESSAGES)
+def test_mqtt_dict_matches_ozmo(message):
+    td = ET.fromstring(message).get('td')
+    expected = ozmo.EcoVacsIOTMQ._ctl_to_dict_mqtt(None, TOPIC.format(td=td), message)
+
+    assert to_ozmo_mqtt_dict(ET.fromstring(message.encode('utf-8'))) == expected
+
+
+@pytest.mark.parametrize('payload, td', [
+    (b'<ctl td="Pos" p="1,2"/>', 'Pos'),
+    (b"<?xml version='1.0'?>\n<ctl a='1' td='CleanReport'><clean/></ctl>", 'CleanReport'),
+    (b'<ctl ret="ok"><clean td="NotRoot"/></ctl>', None),
+    (b'<ctl/>', None),
+])
+def test_find_mqtt_td(payload, td):
+    assert find_mqtt_td(payload) == td
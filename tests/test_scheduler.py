@@ -0,0 +1,194 @@
+"""Tests of the integration wide work scheduler."""
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from custom_components.ecovac_ext.scheduler import DeviceExecutor, FairExecutor, WorkScheduler, WORK_COMMAND,\
+    WORK_PULL
+from custom_components.ecovac_ext.throttle import CloudAdmission, TokenBucket
+
+TIMEOUT = 5
+
+
+@pytest.fixture
+def executors():
+    created = []
+
+    def create(*args, **kwargs):
+        executor = FairExecutor(*args, **kwargs)
+        created.append(executor)
+        return executor
+
+    yield create
+
+    for executor in created:
+        executor.shutdown(wait=False)
+
+
+def block(executor, device='blocker', kind='block'):
+    """Occupy a worker until the returned event is set."""
+    release = threading.Event()
+    started = threading.Event()
+
+    def wait():
+        started.set()
+        release.wait(TIMEOUT)
+
+    executor.submit(device, kind, wait)
+    assert started.wait(TIMEOUT)
+    return release
+
+
+def test_submit_returns_results_and_errors(executors):
+    executor = executors(2, 'test')
+
+    assert executor.submit('a', 'pull', lambda x: x * 2, 21).result(TIMEOUT) == 42
+
+    future = executor.submit('a', 'pull', lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        future.result(TIMEOUT)
+
+
+def test_devices_are_served_round_robin(executors):
+    executor = executors(1, 'test')
+    release = block(executor)
+
+    order = []
+    futures = [executor.submit('a', 'pull', order.append, 'a%d' % idx) for idx in range(3)]
+    futures.append(executor.submit('b', 'pull', order.append, 'b0'))
+
+    release.set()
+    concurrent.futures.wait(futures, TIMEOUT)
+
+    assert order == ['a0', 'b0', 'a1', 'a2']
+
+
+def test_device_kind_limit(executors):
+    executor = executors(4, 'test')
+    executor.set_limit('a', 'pull', 1)
+
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    futures = [executor.submit('a', 'pull', work) for _ in range(5)]
+    concurrent.futures.wait(futures, TIMEOUT)
+
+    assert all(future.done() for future in futures)
+    assert max_running[0] == 1
+
+
+def test_cancel_pending(executors):
+    executor = executors(1, 'test')
+    release = block(executor)
+
+    pulls = [executor.submit('a', 'pull', lambda: None) for _ in range(3)]
+    command = executor.submit('a', 'command', lambda: 'done')
+    other = executor.submit('b', 'pull', lambda: 'done')
+
+    executor.cancel_pending('a', 'pull')
+    release.set()
+
+    assert all(future.cancelled() for future in pulls)
+    assert command.result(TIMEOUT) == 'done'
+    assert other.result(TIMEOUT) == 'done'
+
+
+def test_queue_metrics(executors):
+    executor = executors(1, 'test')
+    release = block(executor, 'a')
+
+    executor.submit('a', 'pull', lambda: None)
+    executor.submit('b', 'pull', lambda: None)
+    executor.submit('b', 'pull', lambda: None)
+
+    executor.submit('b', 'trace', lambda: None)
+
+    assert executor.queue_depths() == {'a': 1, 'b': 3}
+    assert executor.queue_depths('pull') == {'a': 1, 'b': 2}
+    assert executor.queue_depths('trace') == {'b': 1}
+    assert executor.running_counts() == {'a': 1}
+    assert executor.running_counts('block') == {'a': 1}
+    assert executor.running_counts('pull') == {}
+    release.set()
+
+
+def test_held_work_waits_for_tokens(executors):
+    bucket = TokenBucket(rate=10, burst=1)
+    executor = executors(2, 'test', CloudAdmission(bucket, ('pull',)))
+
+    start = time.monotonic()
+    futures = [executor.submit('a', 'pull', time.monotonic) for _ in range(3)]
+    times = [future.result(TIMEOUT) - start for future in futures]
+
+    # One token in the bucket, then one every 0.1 seconds
+    assert times[0] < 0.05
+    assert times[2] >= 0.15
+
+
+def test_cancelled_work_takes_no_tokens(executors):
+    bucket = TokenBucket(rate=1, burst=2)
+    executor = executors(1, 'test', CloudAdmission(bucket, ('pull',)))
+    release = block(executor, 'a', 'command')
+
+    # Pulls cancelled while queued, as by a batch timeout
+    for _ in range(20):
+        executor.submit('a', 'pull', lambda: None).cancel()
+
+    release.set()
+
+    start = time.monotonic()
+    executor.submit('a', 'pull', lambda: None).result(TIMEOUT)
+
+    assert time.monotonic() - start < 0.5
+    assert bucket.tokens >= 1
+    assert executor.queue_depths() == {}
+
+
+def test_shutdown_completes_queued_work(executors):
+    executor = executors(1, 'test')
+    release = block(executor)
+
+    futures = [executor.submit('a', 'pull', lambda: 'done') for _ in range(3)]
+    executor.shutdown(wait=False)
+
+    with pytest.raises(RuntimeError):
+        executor.submit('a', 'pull', lambda: None)
+
+    release.set()
+    assert [future.result(TIMEOUT) for future in futures] == ['done'] * 3
+
+
+def test_device_executor(executors):
+    executor = executors(1, 'test')
+    device_executor = DeviceExecutor(executor, 'a', 'pull', 1)
+    release = block(executor)
+
+    future = device_executor.submit(lambda x: x, 'done')
+    device_executor.shutdown()
+    release.set()
+
+    assert future.cancelled()
+    assert device_executor.submit(lambda x: x, 'done').result(TIMEOUT) == 'done'
+
+
+def test_work_scheduler_commands_do_not_wait_for_pulls():
+    scheduler = WorkScheduler(1, 1, 5)
+    try:
+        # A command waiting for a pull, as the handler of a GetMapSet sent as a custom command does
+        def command():
+            return scheduler.pulls.submit('a', WORK_PULL, lambda: 'pulled').result(TIMEOUT)
+
+        assert scheduler.commands.submit('a', WORK_COMMAND, command).result(TIMEOUT) == 'pulled'
+    finally:
+        scheduler.shutdown()
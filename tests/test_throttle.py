@@ -0,0 +1,148 @@
+"""Tests of the account wide pacing of the cloud requests."""
+import pytest
+
+from custom_components.ecovac_ext import throttle
+from custom_components.ecovac_ext.throttle import AdaptiveConcurrency, CloudAdmission, TokenBucket
+
+
+class FakeTime:
+    """Monotonic clock moved only by the tests."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_time = FakeTime()
+    monkeypatch.setattr(throttle, 'time', fake_time)
+    return fake_time
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+
+    assert [bucket.try_take() for _ in range(4)] == [True, True, True, False]
+    assert bucket.delay() == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.try_take()
+    assert not bucket.try_take()
+
+
+def test_token_bucket_refill_is_capped_to_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    bucket.try_take()
+
+    clock.now += 60
+    assert bucket.tokens == 2
+    assert bucket.delay() == 0
+
+
+def test_adaptive_concurrency_limits_in_flight(clock):
+    concurrency = AdaptiveConcurrency(2, 1, 8)
+
+    assert concurrency.try_acquire()
+    assert concurrency.try_acquire()
+    assert not concurrency.try_acquire()
+
+    concurrency.cancel()
+    assert concurrency.in_flight == 1
+    assert concurrency.try_acquire()
+
+
+def test_adaptive_concurrency_increases_on_success(clock):
+    concurrency = AdaptiveConcurrency(2, 1, 3)
+
+    for _ in range(4):
+        concurrency.try_acquire()
+        concurrency.release(0.2, False)
+
+    # +1/limit per completed request, up to the max
+    assert concurrency.limit == 3
+    assert concurrency.in_flight == 0
+
+
+def test_adaptive_concurrency_halves_on_failure_once_per_baseline(clock):
+    concurrency = AdaptiveConcurrency(8, 1, 8)
+    concurrency.try_acquire()
+    concurrency.release(0.5, False)
+    limit = concurrency.limit
+
+    concurrency.try_acquire()
+    concurrency.release(0.5, True)
+    assert concurrency.limit == limit / 2
+
+    # A burst of errors of the same round halves the limit only once
+    concurrency.try_acquire()
+    concurrency.release(0.5, True)
+    assert concurrency.limit == limit / 2
+
+    clock.now += 0.5
+    concurrency.try_acquire()
+    concurrency.release(0.5, True)
+    assert concurrency.limit == limit / 4
+
+
+def test_adaptive_concurrency_halves_on_slow_requests(clock):
+    concurrency = AdaptiveConcurrency(4, 1, 8)
+    concurrency.try_acquire()
+    concurrency.release(0.2, False)
+    limit = concurrency.limit
+
+    # Slower than the baseline, but within the slack
+    clock.now += 1
+    concurrency.try_acquire()
+    concurrency.release(0.6, False)
+    assert concurrency.limit > limit
+
+    limit = concurrency.limit
+    concurrency.try_acquire()
+    concurrency.release(2.0, False)
+    assert concurrency.limit == limit / 2
+    assert concurrency.baseline == 0.2
+
+
+def test_adaptive_concurrency_never_below_min(clock):
+    concurrency = AdaptiveConcurrency(2, 1, 8)
+    for _ in range(5):
+        clock.now += 10
+        concurrency.try_acquire()
+        concurrency.release(1, True)
+
+    assert concurrency.limit == 1
+
+
+def test_admission_of_unpaced_kinds(clock):
+    bucket = TokenBucket(rate=1, burst=1)
+    admission = CloudAdmission(bucket, ('pull',))
+    bucket.try_take()
+
+    assert admission.try_acquire('command')
+    assert not admission.try_acquire('pull')
+
+
+def test_admission_returns_the_slot_without_token(clock):
+    bucket = TokenBucket(rate=1, burst=1)
+    concurrency = AdaptiveConcurrency(2, 1, 2)
+    admission = CloudAdmission(bucket, ('pull',), concurrency)
+
+    assert admission.try_acquire('pull')
+    assert not admission.try_acquire('pull')
+    assert concurrency.in_flight == 1
+
+    admission.release('pull', 0.1, False)
+    assert concurrency.in_flight == 0
+
+
+def test_admission_retry_delay(clock):
+    bucket = TokenBucket(rate=4, burst=1)
+    admission = CloudAdmission(bucket, ('pull',))
+
+    assert admission.retry_delay() == throttle.HELD_RECHECK_DELAY
+
+    bucket.try_take()
+    assert admission.retry_delay() == pytest.approx(0.25)
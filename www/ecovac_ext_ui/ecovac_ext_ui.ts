@@ -21,6 +21,18 @@ import {
 	internalProperty,
   } from "lit-element";
 
+// Default trace simplification tolerance, in trace units (half a map pixel)
+const DEFAULT_TRACE_TOLERANCE = 2.5;
+
+function loadPngImage(base64:string): Promise<HTMLImageElement> {
+	return new Promise((resolve, reject) => {
+		const image = new Image();
+		image.onload = () => resolve(image);
+		image.onerror = reject;
+		image.src = "data:image/png;base64," + base64;
+	});
+}
+
 @customElement('ecovacs-card')
 export class TestCard extends LitElement {
 	@property()
@@ -90,6 +102,13 @@ export class TestCard extends LitElement {
 	device_pos: { x: number; y: number; };
 	charger_pos: { x: number; y: number; };
 	trace_info_timestamp: any;
+	trace_id: any;
+	trace_count: number;
+	trace_path: Array<any>;
+	map_canvas_id: any;
+	map_version: any;
+	map_canvas: any;
+	map_update: Promise<any>;
 	map_set_info_timestamp: any;
 	map_info_timestamp: any;
 	device_update_timestamp: any;
@@ -121,6 +140,9 @@ export class TestCard extends LitElement {
 			y: 0,
 		};
 		this.trace_info_timestamp = null;
+		this.trace_id = null;
+		this.trace_count = 0;
+		this.trace_path = [];
 		this.map_set_info_timestamp = null;
 		this.map_info_timestamp = null;
 
@@ -137,6 +159,11 @@ export class TestCard extends LitElement {
 		this.map_background_left = null;
 		this.map_background_right = null;
 
+		this.map_canvas_id = null;
+		this.map_version = null;
+		this.map_canvas = null;
+		this.map_update = Promise.resolve();
+
 		this.map_width = 0;
 		this.map_height = 0;
 
@@ -235,19 +262,14 @@ export class TestCard extends LitElement {
 		if (attributes['device_update_timestamp'] != this.device_update_timestamp) {
 			this.map_info_timestamp = attributes['map_info_timestamp'];
 			
-			this._hass.callWS({
-				type: 'ecovacs/get_map',
-				entity_id: this.config.entity,
-			}).then(response => {
-				this.map_background_base64 = response["map_background_base64"];
-				this.map_background_top = response["map_background_top"];
-				this.map_background_bottom = response["map_background_bottom"];
-				this.map_background_left = response["map_background_left"];
-				this.map_background_right = response["map_background_right"];
-
-				this.map_width = response["map_width"];
-				this.map_height = response["map_height"];
-			});
+			// Map requests are chained, so that each one is made from the map version of the previous one
+			this.map_update = this.map_update
+				.then(() => this.fetchMap())
+				.catch(err => {
+					// Get the whole map with the next update
+					this.map_version = null;
+					console.error("Unable to update the map", err);
+				});
 		}
 
 		if (attributes['device_update_timestamp'] != this.device_update_timestamp) {
@@ -306,23 +328,46 @@ export class TestCard extends LitElement {
 				&& attributes['trace_info_timestamp'] != this.trace_info_timestamp) {
 			this.trace_info_timestamp = attributes['trace_info_timestamp'];
 
-			this._hass.callWS({
+			const request:any = {
 				type: 'ecovacs/get_trace',
 				entity_id: this.config.entity,
-			}).then(response => {
-				const trace_points = response.trace_points;
-
-				const path_points:Array<String> = [];
-				trace_points.forEach(trace => {
-					if (trace['connected']) {
-						path_points.push("L");
-					} else {
-						path_points.push("M");
-					}
-					path_points.push(trace["x"])
-					path_points.push(trace["y"])
-				});
-				this.path_points = path_points.join(" ");
+				encoding: 'packed',
+				tolerance: this.config.trace_tolerance ?? DEFAULT_TRACE_TOLERANCE,
+			};
+			if (this.trace_id != null) {
+				// Request only the points not received yet
+				request.trace_id = this.trace_id;
+				request.since = this.trace_count;
+			}
+
+			this._hass.callWS(request).then(response => {
+				if (response.trace_id == null) {
+					this.trace_id = null;
+					this.trace_count = 0;
+					this.trace_path = [];
+					this.path_points = "";
+					return;
+				}
+
+				if (response.trace_id != this.trace_id) {
+					this.trace_path = [];
+				}
+				// Drop the points sent again (the last point of a simplified trace may be replaced)
+				this.trace_path.length = Math.min(this.trace_path.length, response.trace_start * 3);
+
+				// Packed 5 bytes records: y (int16 LE), x (int16 LE), flags (bit 7: not connected)
+				const trace_data = atob(response.trace_data);
+				const view = new DataView(Uint8Array.from(trace_data, c => c.charCodeAt(0)).buffer);
+				for (let offset = 0; offset + 5 <= view.byteLength; offset += 5) {
+					const connected = (view.getUint8(offset + 4) & 0x80) == 0;
+					this.trace_path.push(connected ? "L" : "M");
+					this.trace_path.push(view.getInt16(offset + 2, true));
+					this.trace_path.push(view.getInt16(offset, true));
+				}
+
+				this.trace_id = response.trace_id;
+				this.trace_count = response.trace_count;
+				this.path_points = this.trace_path.join(" ");
 			});
 		}
 
@@ -330,6 +375,68 @@ export class TestCard extends LitElement {
 	}
 
 	
+	async fetchMap() {
+		const request:any = {
+			type: 'ecovacs/get_map',
+			entity_id: this.config.entity,
+		};
+		if (this.map_version != null && this.map_background_base64) {
+			// Request only the map tiles changed since the displayed map (of the same server canvas: versions
+			// restart with Home Assistant)
+			request.canvas_id = this.map_canvas_id;
+			request.since_version = this.map_version;
+		}
+
+		const response = await this._hass.callWS(request);
+
+		if (response["map_patches"] != null) {
+			await this.applyMapPatches(response["map_patches"]);
+		} else {
+			this.map_background_base64 = response["map_background_base64"];
+			this.map_canvas = null;
+		}
+
+		this.map_background_top = response["map_background_top"];
+		this.map_background_bottom = response["map_background_bottom"];
+		this.map_background_left = response["map_background_left"];
+		this.map_background_right = response["map_background_right"];
+
+		this.map_width = response["map_width"];
+		this.map_height = response["map_height"];
+
+		this.map_canvas_id = response["map_canvas_id"];
+		this.map_version = response["map_version"];
+	}
+
+	async applyMapPatches(patches) {
+		if (patches.length == 0) {
+			return;
+		}
+
+		// The displayed background, drawn once in a canvas (in map pixels, from the background top left corner)
+		if (this.map_canvas == null) {
+			const background = await loadPngImage(this.map_background_base64);
+			this.map_canvas = document.createElement("canvas");
+			this.map_canvas.width = background.width;
+			this.map_canvas.height = background.height;
+			this.map_canvas.getContext("2d").drawImage(background, 0, 0);
+		}
+
+		const images = await Promise.all(patches.map(patch => loadPngImage(patch["base64"])));
+
+		const context = this.map_canvas.getContext("2d");
+		patches.forEach((patch, idx) => {
+			const x = patch["left"] - this.map_background_left;
+			const y = patch["top"] - this.map_background_top;
+
+			// Empty cells are transparent in the patches: clear the patched area, or they would not erase anything
+			context.clearRect(x, y, patch["right"] - patch["left"], patch["bottom"] - patch["top"]);
+			context.drawImage(images[idx], x, y);
+		});
+
+		this.map_background_base64 = this.map_canvas.toDataURL("image/png").split(",", 2)[1];
+	}
+
 	handleRoomClick(e) {
 		const id = e.target.id;
 		if (this.selectedMode == "rooms") {